@@ -23,7 +23,7 @@ class ConnectomeConfigUI(ConnectomeConfig):
     ----------
     output_types : list of string
         A list of ``output_types``. Valid ``output_types`` are
-        'gpickle', 'mat', 'cff', 'graphml'
+        'gpickle', 'mat', 'cff', 'graphml', 'h5'
 
     connectivity_metrics : list of string
         A list of connectivity metrics to stored. Valid ``connectivity_metrics`` are
@@ -40,7 +40,7 @@ class ConnectomeConfigUI(ConnectomeConfig):
 
     output_types = List(
         ["gpickle"],
-        editor=CheckListEditor(values=["gpickle", "mat", "cff", "graphml"], cols=4),
+        editor=CheckListEditor(values=["gpickle", "mat", "cff", "graphml", "h5"], cols=5),
     )
 
     connectivity_metrics = List(
@@ -72,6 +72,15 @@ class ConnectomeConfigUI(ConnectomeConfig):
         Group(
             Item("connectivity_metrics", label="Metrics", style="custom"),
             Item("compute_curvature"),
+            Item("number_of_processes", label="Number of processes (scales in parallel)"),
+            Item(
+                "streamline_chunk_size",
+                label="Streamlines per chunk (0: load whole tractogram)",
+            ),
+            Item(
+                "endpoint_search_radius",
+                label="Endpoint search radius in mm (0: no assignment to nearest ROI)",
+            ),
             label="Connectivity matrix",
             show_border=True,
         ),
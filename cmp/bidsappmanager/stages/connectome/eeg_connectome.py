@@ -25,7 +25,7 @@ class EEGConnectomeConfigUI(EEGConnectomeConfig):
     ----------
     output_types : list of string
         A list of ``output_types``. Valid ``output_types`` are
-        'gpickle', 'mat', 'cff', 'graphml'
+        'gpickle', 'mat', 'cff', 'graphml', 'h5'
 
     connectivity_metrics : list of string
         A list of time/frequency connectivity metrics to stored. Valid ``connectivity_metrics`` are
@@ -41,7 +41,7 @@ class EEGConnectomeConfigUI(EEGConnectomeConfig):
 
     output_types = List(
         ["gpickle"],
-        editor=CheckListEditor(values=["gpickle", "mat", "cff", "graphml"], cols=4),
+        editor=CheckListEditor(values=["gpickle", "mat", "cff", "graphml", "h5"], cols=5),
     )
 
     connectivity_metrics = List(
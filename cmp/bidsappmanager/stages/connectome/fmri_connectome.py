@@ -22,7 +22,11 @@ class ConnectomeConfigUI(ConnectomeConfig):
     ----------
     output_types : list of string
         A list of ``output_types``. Valid ``output_types`` are
-        'gpickle', 'mat', 'cff', 'graphml'
+        'gpickle', 'mat', 'cff', 'graphml', 'h5'
+
+    fc_measures : list of string
+        A list of functional connectivity measures. Valid ``fc_measures`` are
+        'corr', 'cov', 'partial_corr', 'fisher_z'
 
     traits_view : traits.ui.View
         TraitsUI view that displays the Attributes of this class
@@ -34,7 +38,14 @@ class ConnectomeConfigUI(ConnectomeConfig):
 
     output_types = List(
         ["gpickle"],
-        editor=CheckListEditor(values=["gpickle", "mat", "cff", "graphml"], cols=4),
+        editor=CheckListEditor(values=["gpickle", "mat", "cff", "graphml", "h5"], cols=5),
+    )
+
+    fc_measures = List(
+        ["corr"],
+        editor=CheckListEditor(
+            values=["corr", "cov", "partial_corr", "fisher_z"], cols=4
+        ),
     )
 
     traits_view = View(
@@ -46,6 +57,24 @@ class ConnectomeConfigUI(ConnectomeConfig):
                 visible_when="apply_scrubbing==True",
             ),
         ),
+        Item("roi_summary", label="ROI time-series summary"),
+        Item(
+            "multiscale_timeseries",
+            label="Single pass for all scales",
+            visible_when="roi_summary=='mean'",
+        ),
+        Item("fc_measures", label="Connectivity measures", style="custom"),
+        Item("voxel_block_size", label="Voxels per block (0: load whole volume)"),
+        VGroup(
+            Item("dynamic_fc", label="Dynamic (sliding-window) connectivity"),
+            VGroup(
+                Item("dfc_window_length", label="Window length (time points)"),
+                Item("dfc_window_step", label="Window step (time points)"),
+                Item("dfc_window_taper", label="Window taper"),
+                Item("dfc_upper_triangle", label="Store upper triangle only"),
+                visible_when="dynamic_fc==True",
+            ),
+        ),
         Item("output_types", style="custom"),
     )
 
@@ -31,9 +31,15 @@ class FunctionalMRIConfigUI(FunctionalMRIConfig):
 
     traits_view = View(  # Item('smoothing'),
         # Item('discard_n_volumes'),
+        Item("fused_denoising", label="Denoise in memory (single node)"),
+        Item(
+            "voxel_block_size",
+            label="Voxels per block (0: load whole volume)",
+        ),
         HGroup(
             Item("detrending"),
             Item("detrending_mode", visible_when="detrending"),
+            Item("detrending_order", label="Order (overrides mode if > 0)", visible_when="detrending"),
             label="Detrending",
             show_border=True,
         ),
@@ -42,6 +48,7 @@ class FunctionalMRIConfigUI(FunctionalMRIConfig):
             Item("csf"),
             Item("wm"),
             Item("motion"),
+            Item("save_nuisance_betas", label="Save betas"),
             label="Nuisance factors",
             show_border=True,
         ),
@@ -49,6 +56,12 @@ class FunctionalMRIConfigUI(FunctionalMRIConfig):
             Item("bandpass_filtering", label="Perform bandpass filtering"),
             Item("lowpass_filter", label="Low cutoff (volumes)", visible_when="bandpass_filtering"),
             Item("highpass_filter", label="High cutoff (volumes)", visible_when="bandpass_filtering"),
+            Item("bandpass_method", label="Method", visible_when="bandpass_filtering"),
+            Item(
+                "orthogonalize_bandpass",
+                label="Orthogonalize with nuisance regression",
+                visible_when="bandpass_filtering",
+            ),
             label="Bandpass filtering",
             show_border=True,
         ),
@@ -25,6 +25,54 @@ import matplotlib.patches as m_patches
 
 from mne.viz.utils import plt_show
 
+from cmtklib.network import load_connectome_hdf5
+
+
+def _split_connectome_path(path):
+    """Split a ``<file>.h5:<scale>`` path into the HDF5 filename and the scale name."""
+    if ".h5:" in path:
+        fname, scale = path.rsplit(":", 1)
+        return fname, scale
+    return path, None
+
+
+def connectome_file_exists(path):
+    """Return True if the gpickle or HDF5 (``<file>.h5[:<scale>]``) connectome file exists."""
+    return os.path.exists(_split_connectome_path(path)[0])
+
+
+def load_connectivity_matrix(path, weight):
+    """Load the connectivity matrix of an edge metric and the node names.
+
+    Parameters
+    ----------
+    path : string
+        Path to a connectome file in gpickle format, or in HDF5 format
+        in which case the scale can be specified as ``<file>.h5:<scale>``
+
+    weight : string
+        Edge metric to extract
+
+    Returns
+    -------
+    matrix : numpy.matrix
+        Connectivity matrix of size [#nodes, #nodes]
+
+    node_names : list of string
+        Name (``dn_name``) of each node
+    """
+    fname, scale = _split_connectome_path(path)
+    if fname.endswith(".h5"):
+        # Only the requested scale and metric are read from the file
+        connectome = load_connectome_hdf5(fname, scale=scale, metrics=[weight])
+        matrix = np.asmatrix(connectome.to_matrix(weight))
+        node_names = [d["dn_name"] for d in connectome.node_data]
+    else:
+        a = nx.read_gpickle(fname)
+        matrix = nx.to_numpy_matrix(a, weight=weight, dtype=np.float64)
+        node_names = [d_gml["dn_name"] for _, d_gml in a.nodes(data=True)]
+    return matrix, node_names
+
 
 def _plot_connectivity_circle_onpick(
     event, fig=None, axes=None, indices=None, node_angles=None, ylim=[9, 10]
@@ -419,11 +467,10 @@ def main():
 
             * '1' in case of an error
     """
-    if len(sys.argv) == 5 and os.path.exists(sys.argv[2]):
+    if len(sys.argv) == 5 and connectome_file_exists(sys.argv[2]):
         print("read %s" % sys.argv[2])
-        a = nx.read_gpickle(sys.argv[2])
         print("open %s" % sys.argv[3])
-        bb = nx.to_numpy_matrix(a, weight=sys.argv[3], dtype=np.float64)
+        bb, node_names = load_connectivity_matrix(sys.argv[2], sys.argv[3])
 
         if sys.argv[4] == "True":
             c = np.zeros(bb.shape)
@@ -441,10 +488,6 @@ def main():
             hist(b)
             show()
         elif sys.argv[1] == "circular":
-            node_names = []
-            for _, d_gml in a.nodes(data=True):
-                # node_names.append(d_gml['dn_fsname'])
-                node_names.append(d_gml["dn_name"])
             _, _ = plot_connectivity_circle(
                 b, node_names, title="%s" % (sys.argv[3]), colormap="inferno"
             )
@@ -453,11 +496,10 @@ def main():
             print("Error: invalid layout mode ('matrix' or 'circular')")
             return 1
 
-    elif len(sys.argv) == 6 and os.path.exists(sys.argv[2]):
+    elif len(sys.argv) == 6 and connectome_file_exists(sys.argv[2]):
         print("read %s" % sys.argv[2])
-        a = nx.read_gpickle(sys.argv[2])
         print("open %s" % sys.argv[3])
-        bb = nx.to_numpy_matrix(a, weight=sys.argv[3], dtype=np.float64)
+        bb, node_names = load_connectivity_matrix(sys.argv[2], sys.argv[3])
 
         if sys.argv[4] == "True":
             c = np.zeros(bb.shape)
@@ -477,10 +519,6 @@ def main():
             )
             show()
         elif sys.argv[1] == "circular":
-            node_names = []
-            for _, d_gml in a.nodes(data=True):
-                # node_names.append(d_gml['dn_fsname'])
-                node_names.append(d_gml["dn_name"])
             if sys.argv[3] == "number_of_fibers":
                 title = "%s (#fibers: %i)" % (sys.argv[5], int(0.5 * b.sum()))
             else:
@@ -492,11 +530,10 @@ def main():
             print("Error: invalid layout mode ('matrix' or 'circular')")
             return 1
 
-    elif len(sys.argv) == 7 and os.path.exists(sys.argv[2]):
+    elif len(sys.argv) == 7 and connectome_file_exists(sys.argv[2]):
         print("read %s" % sys.argv[2])
-        a = nx.read_gpickle(sys.argv[2])
         print("open %s" % sys.argv[3])
-        bb = nx.to_numpy_matrix(a, weight=sys.argv[3], dtype=np.float64)
+        bb, node_names = load_connectivity_matrix(sys.argv[2], sys.argv[3])
 
         if sys.argv[4] == "True":
             c = np.zeros(bb.shape)
@@ -532,10 +569,6 @@ def main():
                 )
             show()
         elif sys.argv[1] == "circular":
-            node_names = []
-            for _, d_gml in a.nodes(data=True):
-                # node_names.append(d_gml['dn_fsname'])
-                node_names.append(d_gml["dn_name"])
             if sys.argv[3] == "number_of_fibers":
                 title = "%s (#fibers: %i)" % (sys.argv[5], int(0.5 * b.sum()))
             else:
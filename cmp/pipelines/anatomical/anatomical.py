@@ -144,6 +144,15 @@ class AnatomicalPipeline(cmp_common.Pipeline):
             self._update_parcellation_scheme, "parcellation_scheme"
         )
 
+        self.stages["Parcellation"].config.number_of_threads = self.stages["Segmentation"].config.number_of_threads
+        self.stages["Segmentation"].config.on_trait_change(
+            self._update_number_of_threads, "number_of_threads"
+        )
+
+    def _update_number_of_threads(self, new):
+        """Updates ``number_of_threads`` of the parcellation stage when the one of the segmentation stage is updated."""
+        self.stages["Parcellation"].config.number_of_threads = new
+
     def _update_parcellation_scheme(self):
         """Updates ``parcellation_scheme`` and ``atlas_info`` when ``parcellation_scheme`` is updated."""
         self.parcellation_scheme = self.stages["Parcellation"].config.parcellation_scheme
@@ -818,6 +818,7 @@ class DiffusionPipeline(Pipeline):
             ("5tt_warped.nii.gz", self.subject + "_space-DWI_label-5TT_probseg.nii.gz"),
             ("gmwmi_warped.nii.gz", self.subject + "_space-DWI_label-GMWMI_probseg.nii.gz"),
             ("connectome_freesurferaparc", self.subject + "_label-Desikan_conndata-network_connectivity"),
+            ("connectome.h5", self.subject + f"_atlas-{bids_atlas_label}_conndata-network_connectivity.h5"),
             ("dwi.nii.gz", self.subject + "_dwi.nii.gz"),
             ("dwi.bval", self.subject + "_dwi.bval"),
             ("eddy_corrected.nii.gz.eddy_rotated_bvecs", self.subject + "_desc-eddyrotated.bvec"),
@@ -603,8 +603,11 @@ class fMRIPipeline(Pipeline):
             ("fMRI_despike_st_mcf.nii.gz.par", self.subject + "_motion.tsv"),
             ("FD.npy", self.subject + "_desc-scrubbing_FD.npy"),
             ("DVARS.npy", self.subject + "_desc-scrubbing_DVARS.npy"),
+            ("DVARS_std.npy", self.subject + "_desc-scrubbing_stdDVARS.npy"),
             ("fMRI_bandpass.nii.gz", self.subject + "_task-rest_desc-bandpass_bold.nii.gz"),
-            ("fMRI_discard_mean.nii.gz",  self.subject + "_meanBOLD.nii.gz")
+            ("fMRI_denoised.nii.gz", self.subject + "_task-rest_desc-denoised_bold.nii.gz"),
+            ("fMRI_discard_mean.nii.gz",  self.subject + "_meanBOLD.nii.gz"),
+            ("connectome.h5", self.subject + f"_atlas-{bids_atlas_label}_conndata-network_connectivity.h5")
         ]
         # fmt:on
 
@@ -617,6 +620,7 @@ class fMRIPipeline(Pipeline):
                 ),
                 ("connectome_freesurferaparc", self.subject + "_atlas-Desikan_conndata-network_connectivity"),
                 ("averageTimeseries_freesurferaparc", self.subject + "_atlas-Desikan_timeseries"),
+                ("dynamicFC_freesurferaparc", self.subject + "_atlas-Desikan_desc-dynamic_conndata-network_connectivity"),
             ]
             # fmt:on
         elif self.parcellation_scheme == "Custom":
@@ -630,6 +634,8 @@ class fMRIPipeline(Pipeline):
                 ),
                 (f"connectome_{bids_atlas_name}", self.subject + f"_atlas-{bids_atlas_label}_conndata-network_connectivity"),
                 (f"averageTimeseries_{bids_atlas_name}", self.subject + f"_atlas-{bids_atlas_label}_timeseries"),
+                (f"dynamicFC_{bids_atlas_name}",
+                 self.subject + f"_atlas-{bids_atlas_label}_desc-dynamic_conndata-network_connectivity"),
             ]
             # fmt:on
         else:
@@ -642,7 +648,9 @@ class fMRIPipeline(Pipeline):
                     ),
                     (f'connectome_{scale}',
                      f'{self.subject}_atlas-{bids_atlas_label}_res-{scale}_conndata-network_connectivity'),
-                    (f'averageTimeseries_{scale}', f'{self.subject}_atlas-{bids_atlas_label}_res-{scale}_timeseries')
+                    (f'averageTimeseries_{scale}', f'{self.subject}_atlas-{bids_atlas_label}_res-{scale}_timeseries'),
+                    (f'dynamicFC_{scale}',
+                     f'{self.subject}_atlas-{bids_atlas_label}_res-{scale}_desc-dynamic_conndata-network_connectivity')
                 ]
                 # fmt:on
 
@@ -874,6 +882,15 @@ class fMRIPipeline(Pipeline):
                 ]
             )
             # fmt:on
+            if self.stages["Connectome"].config.dynamic_fc:
+                # fmt:off
+                fMRI_flow.connect(
+                    [
+                        (con_flow, sinker, [("outputnode.dynamic_connectivity_matrices",
+                                             "func.@dynamic_connectivity_matrices")])
+                    ]
+                )
+                # fmt:on
 
         return fMRI_flow
 
@@ -31,12 +31,25 @@ class ConnectomeConfig(HasTraits):
     compute_curvature : traits.Bool
         Compute fiber curvature (Default: False)
 
-    output_types : ['gpickle', 'mat', 'graphml']
+    output_types : ['gpickle', 'mat', 'graphml', 'h5']
         Output connectome format
 
     connectivity_metrics : ['Fiber number', 'Fiber length', 'Fiber density', 'Fiber proportion', 'Normalized fiber density', 'ADC', 'gFA']
         Set of connectome maps to compute
 
+    number_of_processes : traits.Int
+        Number of processes used to build the connectivity matrices
+        of the different parcellation scales in parallel (Default: 1)
+
+    streamline_chunk_size : traits.Int
+        Number of streamlines read at once when the tractogram is
+        read by chunks, 0 to load the whole tractogram (Default: 0)
+
+    endpoint_search_radius : traits.Float
+        Maximal distance (in mm) at which a fiber endpoint in an unlabeled
+        voxel is assigned to the nearest ROI, 0 to count such fibers as
+        orphans (Default: 0)
+
     log_visualization : traits.Bool
         Log visualization that might be obsolete as this has been detached
         after creation of the bidsappmanager (Default: True)
@@ -68,6 +81,9 @@ class ConnectomeConfig(HasTraits):
             "gFA",
         ]
     )
+    number_of_processes = Int(1)
+    streamline_chunk_size = Int(0)
+    endpoint_search_radius = Float(0)
     log_visualization = Bool(True)
     circular_layout = Bool(False)
     subject = Str
@@ -139,6 +155,10 @@ class ConnectomeStage(Stage):
         )
         cmtk_cmat.inputs.compute_curvature = self.config.compute_curvature
         cmtk_cmat.inputs.output_types = self.config.output_types
+        cmtk_cmat.inputs.number_of_processes = self.config.number_of_processes
+        cmtk_cmat.n_procs = self.config.number_of_processes
+        cmtk_cmat.inputs.streamline_chunk_size = self.config.streamline_chunk_size
+        cmtk_cmat.inputs.endpoint_search_radius = self.config.endpoint_search_radius
 
         # Additional maps
         map_merge = pe.Node(interface=util.Merge(9), name="merge_additional_maps")
@@ -40,7 +40,7 @@ class EEGConnectomeConfig(HasTraits):
     connectivity_metrics : ['coh', 'cohy', 'imcoh', 'plv', 'ciplv', 'ppc', 'pli', 'wpli', 'wpli2_debiased']
         Set of frequency- and time-frequency-domain connectivity metrics to compute
 
-    output_types: ['tsv', 'gpickle', 'mat', 'graphml']
+    output_types: ['tsv', 'gpickle', 'mat', 'graphml', 'h5']
         Output connectome file format
 
     See Also
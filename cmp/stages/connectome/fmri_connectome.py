@@ -46,7 +46,44 @@ class ConnectomeConfig(HasTraits):
         DVARS (RMS of variance over voxels) threshold
         (Default: 4.0)
 
-    output_types : ['gpickle', 'mat', 'cff', 'graphml']
+    roi_summary : ['mean', 'median', 'pca']
+        Summary of the voxel time-series of each ROI: the mean, the median
+        or the first principal component (Default: 'mean')
+
+    fc_measures : ['corr', 'cov', 'partial_corr', 'fisher_z']
+        Functional connectivity measures computed between each pair of ROIs:
+        Pearson's correlation, covariance, partial correlation and
+        Fisher z-transformed correlation (Default: ['corr'])
+
+    voxel_block_size : traits.Int
+        Maximal number of voxels of the fMRI volume read at once
+        to extract the ROI time-series, 0 to load the whole volume
+        (Default: 0)
+
+    multiscale_timeseries : traits.Bool
+        Compute the mean time-series of the ROIs of all the scales in a single
+        pass over the fMRI volume, deriving the ROIs of the coarser scales
+        from the voxels they share with the finer ones (only with the 'mean'
+        ROI summary) (Default: False)
+
+    dynamic_fc : traits.Bool
+        Compute sliding-window (dynamic) functional connectivity matrices
+        from the ROI average time-series if True (Default: False)
+
+    dfc_window_length : traits.Int
+        Number of time points of each sliding window (Default: 30)
+
+    dfc_window_step : traits.Int
+        Number of time points between two consecutive windows (Default: 1)
+
+    dfc_window_taper : ['rectangular', 'hamming', 'hann']
+        Weighting of the time points in each window (Default: 'rectangular')
+
+    dfc_upper_triangle : traits.Bool
+        Store only the values above the diagonal of the dynamic
+        connectivity matrices if True (Default: False)
+
+    output_types : ['gpickle', 'mat', 'cff', 'graphml', 'h5']
         Output connectome format
 
     log_visualization : traits.Bool
@@ -69,6 +106,15 @@ class ConnectomeConfig(HasTraits):
     apply_scrubbing = Bool(False)
     FD_thr = Float(0.2)
     DVARS_thr = Float(4.0)
+    roi_summary = Enum("mean", ["mean", "median", "pca"])
+    fc_measures = List(["corr"])
+    voxel_block_size = Int(0)
+    multiscale_timeseries = Bool(False)
+    dynamic_fc = Bool(False)
+    dfc_window_length = Int(30)
+    dfc_window_step = Int(1)
+    dfc_window_taper = Enum("rectangular", ["rectangular", "hamming", "hann"])
+    dfc_upper_triangle = Bool(False)
     output_types = List(["gpickle", "mat", "cff", "graphml"])
     log_visualization = Bool(True)
     circular_layout = Bool(False)
@@ -105,7 +151,11 @@ class ConnectomeStage(Stage):
             "atlas_info",
             "roi_graphMLs",
         ]
-        self.outputs = ["connectivity_matrices", "avg_timeseries"]
+        self.outputs = [
+            "connectivity_matrices",
+            "avg_timeseries",
+            "dynamic_connectivity_matrices",
+        ]
 
     def create_workflow(self, flow, inputnode, outputnode):
         """Create the stage worflow.
@@ -129,6 +179,10 @@ class ConnectomeStage(Stage):
         cmtk_cmat.inputs.apply_scrubbing = self.config.apply_scrubbing
         cmtk_cmat.inputs.FD_th = self.config.FD_thr
         cmtk_cmat.inputs.DVARS_th = self.config.DVARS_thr
+        cmtk_cmat.inputs.roi_summary = self.config.roi_summary
+        cmtk_cmat.inputs.fc_measures = self.config.fc_measures
+        cmtk_cmat.inputs.voxel_block_size = self.config.voxel_block_size
+        cmtk_cmat.inputs.multiscale_timeseries = self.config.multiscale_timeseries
 
         if not isdefined(inputnode.inputs.FD) or not isdefined(inputnode.inputs.DVARS):
             cmtk_cmat.inputs.apply_scrubbing = False
@@ -149,6 +203,24 @@ class ConnectomeStage(Stage):
         )
         # fmt: on
 
+        if self.config.dynamic_fc:
+            cmtk_dcmat = pe.Node(
+                interface=cmtklib.connectome.RsfmriDynamicCmat(),
+                name="compute_dynamic_matrice",
+            )
+            cmtk_dcmat.inputs.window_length = self.config.dfc_window_length
+            cmtk_dcmat.inputs.window_step = self.config.dfc_window_step
+            cmtk_dcmat.inputs.window_taper = self.config.dfc_window_taper
+            cmtk_dcmat.inputs.upper_triangle = self.config.dfc_upper_triangle
+            # fmt: off
+            flow.connect(
+                [
+                    (cmtk_cmat, cmtk_dcmat, [("avg_timeseries", "avg_timeseries")]),
+                    (cmtk_dcmat, outputnode, [("dynamic_connectivity_matrices", "dynamic_connectivity_matrices")]),
+                ]
+            )
+            # fmt: on
+
     def define_inspect_outputs(self):  # pragma: no cover
         """Update the `inspect_outputs` class attribute.
 
@@ -20,7 +20,13 @@ from nipype.interfaces import afni
 
 # Own imports
 from cmp.stages.common import Stage
-from cmtklib.functionalMRI import Scrubbing, Detrending, NuisanceRegression
+from cmtklib.functionalMRI import (
+    Scrubbing,
+    Detrending,
+    NuisanceRegression,
+    BandpassFilter,
+    FunctionalDenoising,
+)
 from cmtklib.interfaces.afni import Bandpass
 
 class FunctionalMRIConfig(HasTraits):
@@ -44,14 +50,23 @@ class FunctionalMRIConfig(HasTraits):
         Perform motion nuisance regression
         (Default: True)
 
+    save_nuisance_betas : traits.Bool
+        Save the coefficients of the nuisance regression fitted for each voxel
+        (Default: False)
+
     detrending = Bool
         Perform detrending
         (Default: True)
 
-    detrending_mode = Enum("linear", "quadratic")
+    detrending_mode = Enum("linear", "quadratic", "cubic")
         Detrending mode
         (Default: "Linear")
 
+    detrending_order = Int
+        Order of the polynomial trend, which overrides ``detrending_mode``
+        if strictly positive
+        (Default: 0)
+
     bandpass_filtering = Bool
         Perform bandpass filtering
         (Default: True)
@@ -64,10 +79,47 @@ class FunctionalMRIConfig(HasTraits):
         Highpass filter frequency
         (Default: 0.1)
 
+    bandpass_method = Enum("afni", "fft")
+        Band-pass filter implementation: AFNI ``3dBandpass`` or
+        the FFT of the time-series of the voxels with a signal in Python
+        (Default: "afni")
+
+    orthogonalize_bandpass = Bool
+        Regress the band-pass filtered nuisance regressors out of the
+        band-pass filtered signals, so that filtering does not reintroduce
+        nuisance signal (only with the "fft" band-pass method or the fused denoising)
+        (Default: False)
+
     scrubbing = Bool
         Perform scrubbing
         (Default: True)
 
+    fd_formula = Enum("sum", "power")
+        Framewise displacement formula: sum of the absolute differences of the
+        raw motion parameters, or with the rotations converted to displacements
+        on a sphere of radius ``head_radius`` (Power et al., 2012)
+        (Default: "sum")
+
+    head_radius = Float
+        Radius of the sphere in mm used by the "power" FD formula
+        (Default: 50.0)
+
+    standardized_dvars = Bool
+        Use the standardized DVARS (Nichols, 2013) for scrubbing
+        (Default: False)
+
+    voxel_block_size = Int
+        Maximal number of voxels of the fMRI volume read and processed at once
+        by the scrubbing, detrending, nuisance regression and FFT band-pass
+        filtering nodes, or by the fused denoising node, 0 to load the whole volume
+        (Default: 0)
+
+    fused_denoising = Bool
+        Apply detrending, nuisance regression, band-pass filtering and
+        the computation of FD / DVARS in memory in a single node,
+        which writes only the denoised fMRI image and the side outputs
+        (Default: False)
+
     See Also
     --------
     cmp.stages.functional.functionalMRI.FunctionalMRIStage
@@ -80,15 +132,26 @@ class FunctionalMRIConfig(HasTraits):
     csf = Bool(True)
     wm = Bool(True)
     motion = Bool(True)
+    save_nuisance_betas = Bool(False)
 
     detrending = Bool(True)
-    detrending_mode = Enum("linear", "quadratic")
+    detrending_mode = Enum("linear", "quadratic", "cubic")
+    detrending_order = Int(0)
 
     bandpass_filtering = Bool(True)
     lowpass_filter = Float(0.01)
     highpass_filter = Float(0.1)
+    bandpass_method = Enum("afni", "fft")
+    orthogonalize_bandpass = Bool(False)
 
     scrubbing = Bool(True)
+    fd_formula = Enum("sum", "power")
+    head_radius = Float(50.0)
+    standardized_dvars = Bool(False)
+
+    voxel_block_size = Int(0)
+
+    fused_denoising = Bool(False)
 
 
 class FunctionalMRIStage(Stage):
@@ -137,8 +200,16 @@ class FunctionalMRIStage(Stage):
         outputnode : nipype.interfaces.utility.IdentityInterface
             Identity interface describing the outputs of the stage
         """
+        if self.config.fused_denoising:
+            self.create_fused_workflow(flow, inputnode, outputnode)
+            return
+
         if self.config.scrubbing and isdefined(inputnode.inputs.motion_par_file):
             scrubbing = pe.Node(interface=Scrubbing(), name="scrubbing")
+            scrubbing.inputs.fd_formula = self.config.fd_formula
+            scrubbing.inputs.head_radius = self.config.head_radius
+            scrubbing.inputs.block_size = self.config.voxel_block_size
+            dvars_output = "dvars_std_npy" if self.config.standardized_dvars else "dvars_npy"
             # fmt:off
             flow.connect(
                 [
@@ -147,7 +218,7 @@ class FunctionalMRIStage(Stage):
                     (inputnode, scrubbing, [("registered_roi_volumes", "gm_file")]),
                     (inputnode, scrubbing, [("motion_par_file", "motion_parameters")]),
                     (scrubbing, outputnode, [("fd_npy", "FD")]),
-                    (scrubbing, outputnode, [("dvars_npy", "DVARS")]),
+                    (scrubbing, outputnode, [(dvars_output, "DVARS")]),
                 ]
             )
             # fmt:on
@@ -159,6 +230,8 @@ class FunctionalMRIStage(Stage):
         if self.config.detrending:
             detrending = pe.Node(interface=Detrending(), name="detrending")
             detrending.inputs.mode = self.config.detrending_mode
+            detrending.inputs.polynomial_order = self.config.detrending_order
+            detrending.inputs.block_size = self.config.voxel_block_size
             # fmt:off
             flow.connect(
                 [
@@ -181,6 +254,13 @@ class FunctionalMRIStage(Stage):
             interface=util.IdentityInterface(fields=["nuisance_output"]),
             name="nuisance_output",
         )
+        # The FFT band-pass filter reads the nuisance design when orthogonalized
+        fft_bandpass = (
+            self.config.bandpass_filtering
+            and (self.config.lowpass_filter > 0 or self.config.highpass_filter > 0)
+            and self.config.bandpass_method == "fft"
+        )
+        nuisance_design = None
         if (
             self.config.wm
             or self.config.global_nuisance
@@ -195,6 +275,10 @@ class FunctionalMRIStage(Stage):
             nuisance.inputs.wm_nuisance = self.config.wm
             nuisance.inputs.motion_nuisance = self.config.motion
             nuisance.inputs.n_discard = self.config.discard_n_volumes
+            nuisance.inputs.save_betas = self.config.save_nuisance_betas
+            nuisance.inputs.save_design = fft_bandpass and self.config.orthogonalize_bandpass
+            nuisance.inputs.block_size = self.config.voxel_block_size
+            nuisance_design = nuisance
             # fmt:off
             flow.connect(
                 [
@@ -221,7 +305,23 @@ class FunctionalMRIStage(Stage):
             interface=util.IdentityInterface(fields=["filter_output"]),
             name="filter_output",
         )
-        if (self.config.bandpass_filtering and
+        if fft_bandpass:
+            filtering = pe.Node(interface=BandpassFilter(), name="temporal_filter")
+            # Same band as the AFNI band-pass filter (see FIXME below)
+            filtering.inputs.highpass = self.config.lowpass_filter
+            filtering.inputs.lowpass = self.config.highpass_filter
+            filtering.inputs.block_size = self.config.voxel_block_size
+            # fmt:off
+            flow.connect(
+                [
+                    (nuisance_output, filtering, [("nuisance_output", "in_file")]),
+                    (filtering, filter_output, [("out_file", "filter_output")]),
+                ]
+            )
+            if self.config.orthogonalize_bandpass and nuisance_design is not None:
+                flow.connect([(nuisance_design, filtering, [("design_file", "design_file")])])
+            # fmt:on
+        elif (self.config.bandpass_filtering and
                 (self.config.lowpass_filter > 0 or self.config.highpass_filter > 0)):
             filtering = pe.Node(interface=Bandpass(), name="temporal_filter")
             # filtering = pe.Node(interface=afni.Bandpass(),name='temporal_filter')
@@ -261,6 +361,66 @@ class FunctionalMRIStage(Stage):
         flow.connect([(filter_output, outputnode, [("filter_output", "func_file")])])
         # fmt:on
 
+    def create_fused_workflow(self, flow, inputnode, outputnode):
+        """Create the stage worflow with a single in-memory denoising node.
+
+        Parameters
+        ----------
+        flow : nipype.pipeline.engine.Workflow
+            The nipype.pipeline.engine.Workflow instance of the fMRI pipeline
+
+        inputnode : nipype.interfaces.utility.IdentityInterface
+            Identity interface describing the inputs of the stage
+
+        outputnode : nipype.interfaces.utility.IdentityInterface
+            Identity interface describing the outputs of the stage
+        """
+        denoising = pe.Node(interface=FunctionalDenoising(), name="denoising")
+        denoising.inputs.detrending = self.config.detrending
+        denoising.inputs.detrending_mode = self.config.detrending_mode
+        denoising.inputs.polynomial_order = self.config.detrending_order
+        denoising.inputs.global_nuisance = self.config.global_nuisance
+        denoising.inputs.csf_nuisance = self.config.csf
+        denoising.inputs.wm_nuisance = self.config.wm
+        denoising.inputs.motion_nuisance = self.config.motion
+        denoising.inputs.save_betas = self.config.save_nuisance_betas
+        # Same band as the AFNI band-pass filter (see FIXME in create_workflow)
+        denoising.inputs.bandpass_filtering = self.config.bandpass_filtering
+        denoising.inputs.highpass = self.config.lowpass_filter
+        denoising.inputs.lowpass = self.config.highpass_filter
+        denoising.inputs.orthogonalize = self.config.orthogonalize_bandpass
+        denoising.inputs.fd_formula = self.config.fd_formula
+        denoising.inputs.head_radius = self.config.head_radius
+        denoising.inputs.block_size = self.config.voxel_block_size
+
+        has_motion = isdefined(inputnode.inputs.motion_par_file)
+        denoising.inputs.scrubbing = self.config.scrubbing and has_motion
+        if not has_motion:
+            denoising.inputs.motion_nuisance = False
+
+        # fmt:off
+        flow.connect(
+            [
+                (inputnode, denoising, [("preproc_file", "in_file"),
+                                        ("registered_roi_volumes", "gm_file"),
+                                        ("registered_wm", "wm_file"),
+                                        ("eroded_csf", "csf_file"),
+                                        ("eroded_brain", "brainfile")]),
+                (denoising, outputnode, [("out_file", "func_file")]),
+            ]
+        )
+        if has_motion:
+            flow.connect([(inputnode, denoising, [("motion_par_file", "motion_file")])])
+        if self.config.scrubbing and has_motion:
+            dvars_output = "dvars_std_npy" if self.config.standardized_dvars else "dvars_npy"
+            flow.connect(
+                [
+                    (denoising, outputnode, [("fd_npy", "FD"),
+                                             (dvars_output, "DVARS")]),
+                ]
+            )
+        # fmt:on
+
     def define_inspect_outputs(self):  # pragma: no cover
         """Update the `inspect_outputs` class attribute.
 
@@ -295,7 +455,10 @@ class FunctionalMRIStage(Stage):
 
         if (self.config.bandpass_filtering and
                 (self.config.lowpass_filter > 0 or self.config.highpass_filter > 0)):
-            res_dir = os.path.join(self.stage_dir, "converter")
+            if self.config.bandpass_method == "fft":
+                res_dir = os.path.join(self.stage_dir, "temporal_filter")
+            else:
+                res_dir = os.path.join(self.stage_dir, "converter")
             filt = os.path.join(res_dir, "fMRI_bandpass.nii.gz")
             if os.path.exists(filt):
                 self.inspect_outputs_dict["Filter output"] = [
@@ -306,6 +469,16 @@ class FunctionalMRIStage(Stage):
                     "brain_colours_blackbdy_iso",
                 ]
 
+        denoised = os.path.join(self.stage_dir, "denoising", "fMRI_denoised.nii.gz")
+        if self.config.fused_denoising and os.path.exists(denoised):
+            self.inspect_outputs_dict["Denoising output"] = [
+                "fsleyes",
+                "-sdefault",
+                denoised,
+                "-cm",
+                "brain_colours_blackbdy_iso",
+            ]
+
         self.inspect_outputs = sorted(
             [key for key in list(self.inspect_outputs_dict.keys())], key=str.lower
         )
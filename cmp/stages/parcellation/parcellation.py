@@ -76,6 +76,19 @@ class ParcellationConfig(HasTraits):
         'Lausanne2018' parcellation
         (Default: True)
 
+    cortical_dilation_distance : traits.Int
+        Maximal distance in voxels along each axis between a cortical voxel
+        and the labeled voxels whose label it can take when the
+        'Lausanne2018' cortical regions are dilated
+        (Default: 12)
+
+    number_of_threads : traits.Int
+        Number of FreeSurfer commands run concurrently to create the
+        'Lausanne2018' parcellation, and number of scales whose ROI
+        volumes are computed concurrently. It is kept in sync with the number
+        of threads of the segmentation stage by the anatomical pipeline
+        (Default: 1)
+
     atlas_info : traits.Dict
         Dictionary storing information of atlases in the form
         >>> atlas_info = {
@@ -103,6 +116,8 @@ class ParcellationConfig(HasTraits):
     ants_precision_type = Enum(["double", "float"])
     segment_hippocampal_subfields = Bool(True)
     segment_brainstem = Bool(True)
+    cortical_dilation_distance = Int(12)
+    number_of_threads = Int(1, desc="Number of FreeSurfer commands or scales processed concurrently")
     # csf_file = File(exists=True)
     # brain_file = File(exists=True)
     graphml_file = File(exists=True)
@@ -183,6 +198,8 @@ class ParcellationStage(Stage):
             )
             parc_node.inputs.parcellation_scheme = self.config.parcellation_scheme
             parc_node.inputs.erode_masks = True
+            parc_node.inputs.dilation_distance = self.config.cortical_dilation_distance
+            parc_node.inputs.number_of_threads = self.config.number_of_threads
             # fmt: off
             flow.connect(
                 [
@@ -303,6 +320,7 @@ class ParcellationStage(Stage):
                 compute_roi_volumetry.inputs.parcellation_scheme = (
                     self.config.parcellation_scheme
                 )
+                compute_roi_volumetry.inputs.number_of_threads = self.config.number_of_threads
                 # fmt: off
                 flow.connect(
                     [
@@ -393,7 +411,8 @@ class ParcellationStage(Stage):
                 # fmt: on
                 compute_roi_volumetry = pe.Node(
                     interface=ComputeParcellationRoiVolumes(
-                        parcellation_scheme=self.config.parcellation_scheme
+                        parcellation_scheme=self.config.parcellation_scheme,
+                        number_of_threads=self.config.number_of_threads
                     ),
                     name="compute_roi_volumetry",
                 )
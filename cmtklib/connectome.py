@@ -7,18 +7,21 @@
 """Module that defines CMTK functions and Nipype interfaces for connectome mapping."""
 
 from os import path as op
-import csv
 import glob
 import os
-import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from traits.api import *
 
 import nibabel as nib
+from nibabel.affines import apply_affine
+from nibabel.streamlines.trk import get_affine_trackvis_to_rasmm
 import numpy as np
 import networkx as nx
 
 import scipy.io as sio
+from scipy import ndimage
 
 from nipype.interfaces.base import (
     traits,
@@ -32,8 +35,27 @@ from nipype.interfaces.base import (
 )
 from nipype.utils.filemanip import split_filename
 
-from .util import mean_curvature, length
-from .parcellation import get_parcellation
+from .streamlines import (
+    compute_endpoints,
+    compute_lengths,
+    compute_mean_curvatures,
+    get_streamline_buffers,
+    iter_streamline_chunks,
+    pack_streamlines,
+    sample_scalar_map,
+)
+from .parcellation import get_parcellation, compute_roi_statistics
+from .network import Connectome, save_connectomes_hdf5
+from .volumes import VoxelBlockReader
+from .timeseries import (
+    compute_roi_timeseries,
+    compute_multiscale_roi_timeseries,
+    compute_functional_connectivity,
+    compute_sliding_window_fc,
+)
+
+# Data shared with the worker processes of cmat()
+_CMAT_CONTEXT = None
 
 
 def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
@@ -42,22 +64,20 @@ def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
 
 
 def compute_curvature_array(fib):
-    """Computes the curvature array."""
-    print("Compute curvature ...")
+    """Computes the curvature array.
 
-    n = len(fib)
-    pc = -1
-    meancurv = np.zeros((n, 1))
-    for i, fi in enumerate(fib):
-        # Percent counter
-        pcN = int(round(float(100 * i) / n))
-        if pcN > pc and pcN % 1 == 0:
-            pc = pcN
-            print("%4.0f%%" % pc)
-        meancurv[i, 0] = mean_curvature(fi[0])
-
-    return meancurv
+    Parameters
+    ----------
+    fib : nibabel.streamlines.ArraySequence or list of arrays
+        The fibers data
 
+    Returns
+    -------
+    meancurv : numpy.ndarray
+        Matrix of size [#fibers, 1] with the mean curvature of each fiber
+    """
+    print("Compute curvature ...")
+    return compute_mean_curvatures(fib).reshape(-1, 1)
 
 
 def create_endpoints_array(fib, voxelSize, print_info):
@@ -65,7 +85,7 @@ def create_endpoints_array(fib, voxelSize, print_info):
 
     Parameters
     ----------
-    fib: list of arrays
+    fib: nibabel.streamlines.ArraySequence or list of arrays
         The fibers data. Each fiber should be a 2D array where rows represent 3D points.
 
     voxelSize: 3-tuple
@@ -85,47 +105,429 @@ def create_endpoints_array(fib, voxelSize, print_info):
         print("========================")
         print("create_endpoints_array")
 
-    # Init
-    n = len(fib)
-    endpoints = np.zeros((n, 2, 3))
-    endpointsmm = np.zeros((n, 2, 3))
-    pc = -1
-
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
-
-        # Percent counter
-        if print_info:
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 20 == 0:
-                pc = pcN
-                print("%4.0f%%" % pc)
-
-        # Ensure fi is a 2D array; otherwise, expand dimensions
-        if fi.ndim == 1:
-            fi = np.expand_dims(fi, axis=0)
-        elif fi.ndim != 2:
-            raise ValueError(f"Unexpected dimensionality for fiber {i}: {fi.ndim}")
-
-        if fi.shape[0] < 2:
-            raise ValueError(f"Fiber {i} does not have enough points to determine endpoints")
-
-        # Store start and endpoint
-        endpoints[i, 0, :] = fi[0, :]
-        endpoints[i, 1, :] = fi[-1, :]
-        endpointsmm[i, 0, :] = fi[0, :]
-        endpointsmm[i, 1, :] = fi[-1, :]
-
-        # Translate from mm to index
-        endpoints[i, 0, 0] = int(endpoints[i, 0, 0] / float(voxelSize[0]))
-        endpoints[i, 0, 1] = int(endpoints[i, 0, 1] / float(voxelSize[1]))
-        endpoints[i, 0, 2] = int(endpoints[i, 0, 2] / float(voxelSize[2]))
-        endpoints[i, 1, 0] = int(endpoints[i, 1, 0] / float(voxelSize[0]))
-        endpoints[i, 1, 1] = int(endpoints[i, 1, 1] / float(voxelSize[1]))
-        endpoints[i, 1, 2] = int(endpoints[i, 1, 2] / float(voxelSize[2]))
-
-    # Return the matrices
-    return endpoints, endpointsmm
+    return compute_endpoints(fib, voxelSize)
+
+
+def get_endpoint_voxel_indices(endpoints, shape):
+    """Check and convert the voxel coordinates of the fiber endpoints into voxel indices.
+
+    Parameters
+    ----------
+    endpoints : numpy.ndarray
+        Matrix of size [#fibers, 2, 3] containing for each fiber the
+        voxel index of its first and last point in the ROI volume
+
+    shape : tuple
+        Shape of the ROI volume
+
+    Returns
+    -------
+    inside : numpy.ndarray
+        Boolean array of size [#fibers], False for fibers whose start or
+        endpoint is outside the volume
+
+    voxels : tuple of numpy.ndarray
+        Tuple of the three matrices of size [#fibers, 2] with the indices
+        along each axis of the start and end voxel of each fiber
+        (0 for fibers outside the volume)
+    """
+    # Voxel indices of both endpoints, shape [#fibers, 2, 3]
+    vox = endpoints.astype(np.int64)
+    shape = np.asarray(shape[:3], dtype=np.int64)
+
+    # Mimic numpy indexing: negative indices wrap around, anything
+    # outside [-shape, shape) raises an IndexError
+    inside = np.all((vox < shape) & (vox >= -shape), axis=(1, 2))
+    vox = np.where(inside[:, None, None], vox, 0) % shape
+
+    return inside, (vox[..., 0], vox[..., 1], vox[..., 2])
+
+
+def compute_nearest_label_map(roi_data, max_distance, voxel_size=(1.0, 1.0, 1.0)):
+    """Assign to each unlabeled voxel the label of the nearest labeled voxel.
+
+    The nearest labeled voxel of every voxel is found with a single Euclidean
+    distance transform of the background, so that fibers terminating in the
+    white matter close to a ROI can be assigned to it by a direct lookup
+    in the returned volume, without dilating the ROIs beforehand.
+
+    Parameters
+    ----------
+    roi_data : numpy.ndarray
+        3D parcellation volume
+
+    max_distance : float
+        Maximal distance (in mm) between an unlabeled voxel and the nearest
+        labeled voxel. Unlabeled voxels farther from any ROI keep the label 0.
+
+    voxel_size : 3-tuple
+        Voxel size of the parcellation volume
+
+    Returns
+    -------
+    label_map : numpy.ndarray
+        Parcellation volume where unlabeled voxels closer than ``max_distance``
+        to a ROI are labeled as their nearest ROI
+    """
+    background = roi_data == 0
+    if max_distance <= 0 or not np.any(background) or np.all(background):
+        return roi_data
+
+    distances, indices = ndimage.distance_transform_edt(
+        background,
+        sampling=np.asarray(voxel_size, dtype=np.float64)[:3],
+        return_indices=True,
+    )
+    label_map = roi_data[tuple(indices)]
+    label_map[distances > max_distance] = 0
+    return label_map
+
+
+def create_fiberlabels_array(endpoints, roiData, nROIs, print_info, voxel_indices=None):
+    """Label the start and end ROI of all the fibers in one batched lookup.
+
+    Parameters
+    ----------
+    endpoints : numpy.ndarray
+        Matrix of size [#fibers, 2, 3] containing for each fiber the
+        voxel index of its first and last point in the ROI volume,
+        as returned by :func:`create_endpoints_array`
+
+    roiData : numpy.ndarray
+        3D parcellation volume
+
+    nROIs : int
+        Number of ROIs expected by the parcellation node information
+
+    print_info : bool
+        If True, print extra information
+
+    voxel_indices : tuple
+        Output of :func:`get_endpoint_voxel_indices` for ``endpoints``,
+        which can be shared by all the ROI volumes of the same shape.
+        If None, it is computed from ``endpoints``.
+
+    Returns
+    -------
+    fiberlabels : numpy.ndarray
+        Matrix of size [#fibers, 2] with the sorted (start, end) ROI labels
+        of each valid fiber, ``-1`` in the first column for orphans and
+        ``0`` for fibers outside the volume or labeled above ``nROIs``
+
+    final_fibers_idx : numpy.ndarray
+        Indices of the valid fibers
+
+    final_fiberlabels : numpy.ndarray
+        Matrix of size [#valid fibers, 2] with the sorted (start, end)
+        ROI labels of the valid fibers
+
+    n_orphans : int
+        Number of fibers that start or terminate in a voxel which is not labeled
+    """
+    n = endpoints.shape[0]
+    fiberlabels = np.zeros((n, 2))
+
+    if voxel_indices is None:
+        voxel_indices = get_endpoint_voxel_indices(endpoints, roiData.shape)
+    inside, voxels = voxel_indices
+
+    if print_info:
+        for i in np.where(~inside)[0]:
+            print(" .. ERROR: An index error occured for fiber %s. " % i)
+            print("           This means that the fiber start or endpoint is outside the volume. Continue.")
+            print("           Continue.")
+
+    labels = roiData[voxels].astype(np.int64)
+    startROI = labels[:, 0]
+    endROI = labels[:, 1]
+
+    # Filter
+    orphans = inside & ((startROI == 0) | (endROI == 0))
+    fiberlabels[orphans, 0] = -1
+    n_orphans = int(np.count_nonzero(orphans))
+
+    above = inside & ~orphans & ((startROI > int(nROIs)) | (endROI > int(nROIs)))
+    if print_info:
+        for i in np.where(above)[0]:
+            print(" .. ERROR: Start or endpoint of fiber terminate in a voxel which is labeled higher")
+            print("           than is expected by the parcellation node information.")
+            print("           Start ROI: %i, End ROI: %i" % (startROI[i], endROI[i]))
+            print("           This needs bugfixing!")
+            print("           Continue.")
+
+    valid = inside & ~orphans & ~above
+    final_fibers_idx = np.where(valid)[0]
+
+    # Switch the rois in order to enforce startROI < endROI
+    final_fiberlabels = np.sort(labels[valid], axis=1).astype(np.int32)
+    fiberlabels[final_fibers_idx] = final_fiberlabels
+
+    return fiberlabels, final_fibers_idx, final_fiberlabels, n_orphans
+
+
+def group_fibers_by_edge(final_fiberlabels):
+    """Group the valid fibers by connected (start, end) ROI pair.
+
+    The (start, end) label pairs are encoded into a single integer key and
+    sorted once, which gives for every edge the list of its fibers in a
+    CSR-like layout (``edge_fibers[edge_offsets[e]:edge_offsets[e + 1]]``).
+
+    Parameters
+    ----------
+    final_fiberlabels : numpy.ndarray
+        Matrix of size [#valid fibers, 2] with the sorted (start, end)
+        ROI labels of the valid fibers
+
+    Returns
+    -------
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] with the (start, end) ROI labels of each
+        edge, ordered by first occurrence in ``final_fiberlabels``
+
+    edge_offsets : numpy.ndarray
+        Array of size [#edges + 1] with the offsets of each edge in ``edge_fibers``
+
+    edge_fibers : numpy.ndarray
+        Row indices in ``final_fiberlabels`` grouped by edge, in increasing
+        order within each edge
+
+    edge_ids : numpy.ndarray
+        Edge index of each valid fiber
+    """
+    labels = np.asarray(final_fiberlabels, dtype=np.int64).reshape(-1, 2)
+    n_labels = labels.max() + 1 if labels.size else 1
+    keys = labels[:, 0] * n_labels + labels[:, 1]
+
+    _, first_idx, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    # Rank the unique keys by first occurrence
+    order = np.argsort(first_idx, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size)
+
+    edge_ids = rank[inverse.reshape(-1)]
+    edges = labels[first_idx[order]]
+    edge_fibers = np.argsort(edge_ids, kind="stable")
+    edge_offsets = np.zeros(edges.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edge_ids, minlength=edges.shape[0]), out=edge_offsets[1:])
+
+    return edges, edge_offsets, edge_fibers, edge_ids
+
+
+def compute_grouped_statistics(values, group_ids, n_groups):
+    """Compute the mean, median and standard deviation of values per group.
+
+    NaN values are ignored, as in :func:`numpy.nanmean`, :func:`numpy.nanmedian`
+    and :func:`numpy.nanstd`. Groups without any finite value get NaN.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        1D array of values
+
+    group_ids : numpy.ndarray
+        1D array of the same size as ``values`` giving the group index of each value
+
+    n_groups : int
+        Number of groups
+
+    Returns
+    -------
+    mean : numpy.ndarray
+        Mean value of each group
+
+    median : numpy.ndarray
+        Median value of each group
+
+    std : numpy.ndarray
+        Standard deviation of each group
+    """
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    group_ids = np.asarray(group_ids, dtype=np.int64).reshape(-1)
+
+    finite = ~np.isnan(values)
+    counts = np.bincount(group_ids[finite], minlength=n_groups)
+    sums = np.bincount(group_ids[finite], weights=values[finite], minlength=n_groups)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+        sq_dev = (values[finite] - mean[group_ids[finite]]) ** 2
+        std = np.sqrt(np.bincount(group_ids[finite], weights=sq_dev, minlength=n_groups) / counts)
+
+    # Sort by group then value (NaNs last within each group) and pick the middle element(s)
+    order = np.lexsort((values, group_ids))
+    sorted_values = values[order]
+    starts = np.zeros(n_groups, dtype=np.int64)
+    np.cumsum(np.bincount(group_ids, minlength=n_groups)[:-1], out=starts[1:])
+    has_values = counts > 0
+    lo = starts + np.maximum(counts - 1, 0) // 2
+    hi = starts + counts // 2
+    median = np.full(n_groups, np.nan)
+    median[has_values] = 0.5 * (
+        sorted_values[lo[has_values]] + sorted_values[hi[has_values]]
+    )
+
+    return mean, median, std
+
+
+def compute_edge_map_statistics(
+    values, point_offsets, n_points, fiber_edge_ids, n_edges, max_points=None
+):
+    """Compute the statistics of a map sampled along the fibers of each edge.
+
+    The fibers are sorted by edge and the samples are gathered by batches
+    of edges so that at most about ``max_points`` samples are loaded at once.
+    This allows ``values`` to be a memory-mapped array.
+
+    Parameters
+    ----------
+    values : numpy.ndarray or numpy.memmap
+        Value of the map at each point of the point buffer of the tractogram
+
+    point_offsets : numpy.ndarray
+        Index in ``values`` of the first point of each fiber
+
+    n_points : numpy.ndarray
+        Number of points of each fiber
+
+    fiber_edge_ids : numpy.ndarray
+        Edge index of each fiber, ``-1`` for the fibers to discard
+
+    n_edges : int
+        Number of edges
+
+    max_points : int
+        Maximal number of samples processed in one batch.
+        If None, all the samples are processed at once.
+
+    Returns
+    -------
+    mean : numpy.ndarray
+        Mean value of each edge
+
+    median : numpy.ndarray
+        Median value of each edge
+
+    std : numpy.ndarray
+        Standard deviation of each edge
+    """
+    mean = np.full(n_edges, np.nan)
+    median = np.full(n_edges, np.nan)
+    std = np.full(n_edges, np.nan)
+
+    fibers = np.where(fiber_edge_ids >= 0)[0]
+    fibers = fibers[np.argsort(fiber_edge_ids[fibers], kind="stable")]
+    if fibers.size == 0:
+        return mean, median, std
+    fiber_edges = fiber_edge_ids[fibers]
+    fiber_counts = n_points[fibers]
+
+    # Split the sorted fibers into batches made of complete edges
+    if max_points is None or max_points <= 0:
+        batch_starts = np.array([0])
+    else:
+        edge_starts = np.flatnonzero(np.r_[True, fiber_edges[1:] != fiber_edges[:-1]])
+        points_before = np.r_[0, np.cumsum(fiber_counts)][edge_starts]
+        batch_ids = points_before // int(max_points)
+        batch_starts = edge_starts[np.r_[True, batch_ids[1:] != batch_ids[:-1]]]
+    batch_ends = np.r_[batch_starts[1:], fibers.size]
+
+    for start, end in zip(batch_starts, batch_ends):
+        counts = fiber_counts[start:end]
+        total = counts.sum()
+        first_edge = fiber_edges[start]
+        last_edge = fiber_edges[end - 1]
+        # Indices of the samples of the fibers of the batch
+        batch_offsets = np.zeros_like(counts)
+        np.cumsum(counts[:-1], out=batch_offsets[1:])
+        idx = np.repeat(point_offsets[fibers[start:end]] - batch_offsets, counts)
+        idx += np.arange(total)
+        groups = np.repeat(fiber_edges[start:end] - first_edge, counts)
+
+        (
+            mean[first_edge:last_edge + 1],
+            median[first_edge:last_edge + 1],
+            std[first_edge:last_edge + 1],
+        ) = compute_grouped_statistics(
+            np.asarray(values[idx]), groups, last_edge - first_edge + 1
+        )
+
+    return mean, median, std
+
+
+def compute_edge_metrics(
+    edges, edge_offsets, edge_ids, fiber_lengths, roi_volumes, node_order=None
+):
+    """Compute the fiber-based connectivity metrics of all edges at once.
+
+    Parameters
+    ----------
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] with the (start, end) ROI labels of each edge
+
+    edge_offsets : numpy.ndarray
+        CSR offsets of the fibers of each edge, as returned by :func:`group_fibers_by_edge`
+
+    edge_ids : numpy.ndarray
+        Edge index of each valid fiber
+
+    fiber_lengths : numpy.ndarray
+        Length of each valid fiber
+
+    roi_volumes : numpy.ndarray
+        Number of voxels of each ROI label (indexed by label)
+
+    node_order : numpy.ndarray
+        Position of each ROI label in the graph node order, used to select
+        the ROIs that count in the total volume of the connected ROIs.
+        If None, the label value is used.
+
+    Returns
+    -------
+    metrics : dict
+        Dictionary of arrays of size [#edges] for ``number_of_fibers``,
+        ``fiber_length_mean``, ``fiber_length_median``, ``fiber_length_std``,
+        ``fiber_proportion``, ``fiber_density`` and ``normalized_fiber_density``
+    """
+    n_edges = edges.shape[0]
+    number_of_fibers = np.diff(edge_offsets)
+    total_fibers = number_of_fibers.sum()
+
+    # Each connected ROI is counted once in the total volume, as the
+    # source node of the edges listed by networkx
+    u, v = edges[:, 0], edges[:, 1]
+    if node_order is None:
+        source = u
+    else:
+        source = np.where(node_order[u] <= node_order[v], u, v)
+    total_volume = roi_volumes[np.unique(source)].sum()
+
+    length_mean, length_median, length_std = compute_grouped_statistics(
+        fiber_lengths, edge_ids, n_edges
+    )
+
+    # Formula: density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
+    volume_pair = (roi_volumes[u] + roi_volumes[v]).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        has_length = length_mean > 0.0
+        fiber_density = np.where(
+            has_length, (number_of_fibers / length_mean) * (2.0 / volume_pair), 0.0
+        )
+        normalized_fiber_density = np.where(
+            has_length,
+            ((number_of_fibers / float(total_fibers)) / length_mean)
+            * ((2.0 * float(total_volume)) / volume_pair),
+            0.0,
+        )
+
+    return {
+        "number_of_fibers": number_of_fibers,
+        "fiber_length_mean": length_mean,
+        "fiber_length_median": length_median,
+        "fiber_length_std": length_std,
+        "fiber_proportion": 100.0 * (number_of_fibers / float(total_fibers)),
+        "fiber_density": fiber_density,
+        "normalized_fiber_density": normalized_fiber_density,
+    }
 
 
 def save_fibers(oldhdr, oldfib, fname, indices):
@@ -162,6 +564,555 @@ def save_fibers(oldhdr, oldfib, fname, indices):
     trk_file.save(fname)
 
 
+def save_fibers_from_file(intrk, fname, indices):
+    """Stores a new trackvis file fname using only given indices, streaming the fibers from intrk.
+
+    Contrary to :func:`save_fibers`, the input tractogram is read lazily
+    and the selected fibers are written one after the other, such that
+    the tractogram is never loaded entirely in memory.
+
+    Parameters
+    ----------
+    intrk : string
+        Input tractogram filename
+
+    fname : string
+        Output tractogram filename
+
+    indices : list
+        Indices of fibers included
+    """
+    trk_file = nib.streamlines.load(intrk, lazy_load=True)
+    hdrnew = trk_file.header.copy()
+    keep = np.zeros(trk_file.header["nb_streamlines"], dtype=bool)
+    keep[np.asarray(indices, dtype=np.int64)] = True
+
+    def _selected_fibers():
+        for i, streamline in enumerate(trk_file.streamlines):
+            if i < keep.size and keep[i]:
+                yield streamline
+
+    hdrnew["n_count"] = int(np.count_nonzero(keep))
+
+    print("Writing final no orphan fibers: %s" % fname)
+    tractogram = nib.streamlines.LazyTractogram(
+        _selected_fibers, affine_to_rasmm=np.eye(4)
+    )
+    out_file = nib.streamlines.TrkFile(tractogram, header=hdrnew)
+
+    out_file.save(fname)
+
+
+def save_edge_streamline_index(scale, edges, edge_offsets, edge_streamlines):
+    """Save the list of streamlines of each edge of a resolution in a compact CSR layout.
+
+    Two ``int32`` arrays are saved in the current directory so that they can be
+    memory-mapped with ``numpy.load(..., mmap_mode="r")``:
+
+    * ``edge_index_<scale>.npy`` of size [#edges, 4] with for each edge its
+      (start, end) ROI labels and the range of its streamlines in the second array,
+
+    * ``edge_streamlines_<scale>.npy`` with the indices in the input tractogram
+      of the streamlines grouped by edge.
+
+    Parameters
+    ----------
+    scale : string
+        Name of the resolution
+
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] with the (start, end) ROI labels of each edge
+
+    edge_offsets : numpy.ndarray
+        Array of size [#edges + 1] with the offsets of each edge in ``edge_streamlines``
+
+    edge_streamlines : numpy.ndarray
+        Indices of the streamlines in the input tractogram grouped by edge
+
+    Returns
+    -------
+    edge_index_fname : string
+        Path to the edge index file
+
+    edge_streamlines_fname : string
+        Path to the edge streamlines file
+    """
+    edge_index = np.zeros((edges.shape[0], 4), dtype=np.int32)
+    edge_index[:, :2] = edges
+    edge_index[:, 2] = edge_offsets[:-1]
+    edge_index[:, 3] = edge_offsets[1:]
+
+    edge_index_fname = op.abspath("edge_index_%s.npy" % scale)
+    edge_streamlines_fname = op.abspath("edge_streamlines_%s.npy" % scale)
+    np.save(edge_index_fname, edge_index)
+    np.save(edge_streamlines_fname, np.asarray(edge_streamlines, dtype=np.int32))
+    return edge_index_fname, edge_streamlines_fname
+
+
+def save_streamline_index(trk_fname, streamline_ids, n_points):
+    """Save the input index and the byte offset of each streamline of a TRK file.
+
+    The array of size [#streamlines, 2] is saved as ``<trk_fname without extension>_index.npy``
+    and allows to read any streamline of the TRK file by seeking, without loading the others.
+
+    Parameters
+    ----------
+    trk_fname : string
+        Path to the TRK file
+
+    streamline_ids : numpy.ndarray
+        Index in the input tractogram of each streamline of the TRK file
+
+    n_points : numpy.ndarray
+        Number of points of each streamline of the TRK file
+
+    Returns
+    -------
+    index_fname : string
+        Path to the index file
+    """
+    header = nib.streamlines.load(trk_fname, lazy_load=True).header
+    n_values = 3 + int(header["nb_scalars_per_point"])
+    n_properties = int(header["nb_properties_per_streamline"])
+
+    # Each streamline is stored as its number of points (int32) followed by
+    # the float32 coordinates and scalars of each point and its properties
+    sizes = 4 * (1 + np.asarray(n_points, dtype=np.int64) * n_values + n_properties)
+    index = np.zeros((sizes.size, 2), dtype=np.int64)
+    index[:, 0] = streamline_ids
+    index[:, 1] = int(header["hdr_size"])
+    index[1:, 1] += np.cumsum(sizes[:-1])
+
+    index_fname = op.splitext(op.abspath(trk_fname))[0] + "_index.npy"
+    np.save(index_fname, index)
+    return index_fname
+
+
+def read_trk_streamlines(trk_fname, byte_offsets):
+    """Read a subset of the streamlines of a TRK file by seeking to their position.
+
+    Parameters
+    ----------
+    trk_fname : string
+        Path to the TRK file
+
+    byte_offsets : numpy.ndarray
+        Position in the file of each streamline to read,
+        as saved by :func:`save_streamline_index`
+
+    Returns
+    -------
+    streamlines : nibabel.streamlines.ArraySequence
+        The streamlines in millimeter (RAS+) coordinates, as loaded by
+        :func:`nibabel.streamlines.load`
+    """
+    header = nib.streamlines.load(trk_fname, lazy_load=True).header
+    endianness = header["endianness"]
+    n_values = 3 + int(header["nb_scalars_per_point"])
+    affine = get_affine_trackvis_to_rasmm(header)
+
+    streamlines = []
+    with open(trk_fname, "rb") as trk_file:
+        for offset in np.asarray(byte_offsets, dtype=np.int64):
+            trk_file.seek(int(offset))
+            n_pts = int(np.frombuffer(trk_file.read(4), dtype=endianness + "i4")[0])
+            points = np.frombuffer(
+                trk_file.read(4 * n_pts * n_values), dtype=endianness + "f4"
+            ).reshape(n_pts, n_values)
+            streamlines.append(points[:, :3])
+
+    streamlines = pack_streamlines(streamlines)
+    streamlines._data = apply_affine(affine, streamlines._data).astype(np.float32)
+    return streamlines
+
+
+def load_edge_streamline_index(scale, directory=".", mmap_mode="r"):
+    """Load the edge / streamline index of a resolution saved by :func:`cmat`.
+
+    Parameters
+    ----------
+    scale : string
+        Name of the resolution
+
+    directory : string
+        Directory where the index files are stored (Default: current directory)
+
+    mmap_mode : {None, 'r', 'r+', 'c'}
+        Memory-map mode of :func:`numpy.load` (Default: 'r')
+
+    Returns
+    -------
+    edge_index : numpy.ndarray
+        Array of size [#edges, 4] with the (start, end) ROI labels of each edge
+        and the range of its streamlines in ``edge_streamlines``
+
+    edge_streamlines : numpy.ndarray
+        Indices of the streamlines in the input tractogram grouped by edge
+    """
+    edge_index = np.load(op.join(directory, "edge_index_%s.npy" % scale), mmap_mode=mmap_mode)
+    edge_streamlines = np.load(
+        op.join(directory, "edge_streamlines_%s.npy" % scale), mmap_mode=mmap_mode
+    )
+    return edge_index, edge_streamlines
+
+
+def get_edge_streamline_ids(source, target, edge_index, edge_streamlines):
+    """Return the indices in the input tractogram of the streamlines connecting two ROIs.
+
+    Parameters
+    ----------
+    source : int
+        Label of the first ROI
+
+    target : int
+        Label of the second ROI
+
+    edge_index : numpy.ndarray
+        Edge index loaded by :func:`load_edge_streamline_index`
+
+    edge_streamlines : numpy.ndarray
+        Edge streamlines loaded by :func:`load_edge_streamline_index`
+
+    Returns
+    -------
+    streamline_ids : numpy.ndarray
+        Indices of the streamlines of the edge (empty if the ROIs are not connected)
+    """
+    u, v = min(int(source), int(target)), max(int(source), int(target))
+    match = np.flatnonzero((edge_index[:, 0] == u) & (edge_index[:, 1] == v))
+    if match.size == 0:
+        return np.zeros(0, dtype=np.int32)
+    start, stop = edge_index[match[0], 2:4]
+    return np.asarray(edge_streamlines[start:stop])
+
+
+def extract_edge_streamlines(
+    source, target, scale, directory=".", trk_fname="streamline_final.trk"
+):
+    """Read the streamlines connecting two ROIs from the final tractogram of :func:`cmat`.
+
+    Only the streamlines of the edge are read from the TRK file, using the
+    edge / streamline index of the resolution and the streamline index of
+    the TRK file saved by :func:`cmat`.
+
+    Parameters
+    ----------
+    source : int
+        Label of the first ROI
+
+    target : int
+        Label of the second ROI
+
+    scale : string
+        Name of the resolution
+
+    directory : string
+        Directory where the outputs of :func:`cmat` are stored (Default: current directory)
+
+    trk_fname : string
+        Name of the TRK file in ``directory`` (Default: "streamline_final.trk")
+
+    Returns
+    -------
+    streamlines : nibabel.streamlines.ArraySequence
+        The streamlines of the edge in millimeter (RAS+) coordinates
+
+    Examples
+    --------
+    >>> from cmtklib.connectome import extract_edge_streamlines
+    >>> bundle = extract_edge_streamlines(12, 45, 'scale1', directory='/path/to/compute_matrice')  # doctest: +SKIP
+    """
+    edge_index, edge_streamlines = load_edge_streamline_index(scale, directory)
+    streamline_ids = get_edge_streamline_ids(source, target, edge_index, edge_streamlines)
+
+    trk_path = op.join(directory, trk_fname)
+    trk_index = np.load(op.splitext(trk_path)[0] + "_index.npy", mmap_mode="r")
+    # Streamlines of the edge can be absent from the TRK file
+    # if it was saved for another resolution
+    trk_ids = np.asarray(trk_index[:, 0])
+    pos = np.minimum(np.searchsorted(trk_ids, streamline_ids), max(trk_ids.size - 1, 0))
+    found = np.zeros(streamline_ids.size, dtype=bool)
+    if trk_ids.size > 0:
+        found = trk_ids[pos] == streamline_ids
+    if not np.all(found):
+        print(
+            "  ... WARNING - %i streamlines of the edge are not in %s"
+            % (np.count_nonzero(~found), trk_fname)
+        )
+
+    return read_trk_streamlines(trk_path, trk_index[pos[found], 1])
+
+
+def _read_tractogram_by_chunks(intrk, chunk_size, voxel_size, compute_curvature, maps):
+    """Compute the per-fiber data needed by :func:`cmat` reading the tractogram by chunks.
+
+    Endpoints, lengths and curvatures are accumulated chunk by chunk while the
+    samples of the additional maps are appended to temporary files in the
+    current directory, which are then memory-mapped.
+
+    Parameters
+    ----------
+    intrk : string
+        Path to the tractogram file
+
+    chunk_size : int
+        Number of streamlines read at once
+
+    voxel_size : 3-tuple
+        Voxel size of the ROI volumes
+
+    compute_curvature : bool
+        If True, compute the mean curvature of the fibers
+
+    maps : dict
+        Dictionary of (map data, map voxel size) of each additional map
+
+    Returns
+    -------
+    result : dict
+        Dictionary with the ``endpoints``, ``endpointsmm``, ``fiberlength_array``,
+        ``meancurv`` (None if not computed) and ``n_points`` arrays, the
+        ``mmapdata`` dictionary of (samples, inside) of each additional map
+        and the list of temporary ``sample_files`` to delete once done
+    """
+    endpoints_list = []
+    endpointsmm_list = []
+    lengths_list = []
+    curv_list = []
+    n_points_list = []
+    inside_lists = {k: [] for k in maps}
+    sample_fnames = {k: op.abspath("tmp_%s_samples.dat" % k) for k in maps}
+    sample_files = {k: open(f, "wb") for k, f in sample_fnames.items()}
+
+    try:
+        for chunk_n, chunk in enumerate(iter_streamline_chunks(intrk, chunk_size)):
+            print("  ... Process chunk %i (%i fibers)" % (chunk_n, len(chunk)))
+            endpoints, endpointsmm = compute_endpoints(chunk, voxel_size)
+            endpoints_list.append(endpoints)
+            endpointsmm_list.append(endpointsmm)
+            lengths_list.append(compute_lengths(chunk))
+            if compute_curvature:
+                curv_list.append(compute_mean_curvatures(chunk))
+            n_points_list.append(get_streamline_buffers(chunk)[2])
+            for k, (mdata, map_voxel_size) in list(maps.items()):
+                values, inside = sample_scalar_map(chunk, mdata, map_voxel_size)
+                np.asarray(values, dtype=np.float64).tofile(sample_files[k])
+                inside_lists[k].append(inside)
+    finally:
+        for f in sample_files.values():
+            f.close()
+
+    def _concatenate(arrays, shape):
+        return np.concatenate(arrays) if arrays else np.zeros(shape)
+
+    n_points = _concatenate(n_points_list, (0,)).astype(np.int64)
+    mmapdata = {}
+    for k, fname in list(sample_fnames.items()):
+        if n_points.sum() > 0:
+            values = np.memmap(fname, dtype=np.float64, mode="r")
+        else:
+            values = np.zeros(0)
+        mmapdata[k] = (values, _concatenate(inside_lists[k], (0,)).astype(bool))
+
+    return {
+        "endpoints": _concatenate(endpoints_list, (0, 2, 3)),
+        "endpointsmm": _concatenate(endpointsmm_list, (0, 2, 3)),
+        "fiberlength_array": _concatenate(lengths_list, (0,)),
+        "meancurv": _concatenate(curv_list, (0,)) if compute_curvature else None,
+        "n_points": n_points,
+        "mmapdata": mmapdata,
+        "sample_files": list(sample_fnames.values()),
+    }
+
+
+def _create_scale_connectome(parkey, parval, context=None):
+    """Build and save the structural connectome of one resolution.
+
+    Worker function of :func:`cmat`, that can be run in a separate process.
+
+    Parameters
+    ----------
+    parkey : string
+        Name of the resolution (parcellation scale)
+
+    parval : dict
+        Atlas information of the resolution
+
+    context : dict
+        Data shared by all the resolutions (ROI volumes, endpoints, fiber lengths,
+        samples of the additional maps, ...), prepared by :func:`cmat`.
+        If None, the context of the parent process is used (``fork`` start method).
+
+    Returns
+    -------
+    final_fibers_idx : numpy.ndarray
+        Indices of the valid fibers of this resolution
+
+    connectome : cmtklib.network.Connectome
+        The connectome of this resolution
+    """
+    if context is None:
+        context = _CMAT_CONTEXT
+    roiData = context["roi_data"][parkey]
+    endpoints = context["endpoints"]
+    voxel_indices = context["voxel_indices"]
+    fiberlength_array = context["fiberlength_array"]
+    mmapdata = context["mmapdata"]
+    n_points = context["n_points"]
+    point_offsets = context["point_offsets"]
+    max_points = context.get("max_points")
+    output_types = context["output_types"]
+    n = endpoints.shape[0]
+
+    print("------------------------------------------------")
+    print("Resolution = " + parkey)
+    print("------------------------------------------------")
+
+    # Create the matrix
+    print(
+        "  >> Create the connection matrix (%s rois)" % parval["number_of_regions"]
+    )
+
+    nROIs = int(parval["number_of_regions"])
+
+    # Add node information from parcellation
+    gp = nx.read_graphml(parval["node_information_graphml"])
+    roi_voxel_counts, roi_positions = compute_roi_statistics(roiData, nROIs + 1)
+    # Position of each label in the node order of the graph
+    n_labels = max([roi_voxel_counts.size] + [int(u) + 1 for u in gp.nodes()])
+    node_order = np.full(n_labels, n_labels, dtype=np.int64)
+
+    nodes = []
+    node_data = []
+    for node_n, (u, d) in enumerate(gp.nodes(data=True)):
+        nodes.append(int(u))
+        d = dict(d)
+        # compute a position for the node based on the mean position of the
+        # ROI in voxel coordinates (segmentation volume )
+        roi_label = int(d["dn_multiscaleID"])
+        d["dn_position"] = tuple(roi_positions[roi_label])
+        d["roi_volume"] = roi_voxel_counts[roi_label]
+        node_data.append(d)
+        node_order[int(u)] = node_n
+
+    # Fibers terminating in the white matter close to a ROI are assigned to it
+    label_map = roiData
+    endpoint_radius = context["endpoint_search_radius"]
+    if endpoint_radius > 0:
+        print("  >> Assign unlabeled endpoints to the nearest ROI within %g mm" % endpoint_radius)
+        label_map = compute_nearest_label_map(
+            roiData, endpoint_radius, context["roi_voxel_size"]
+        )
+
+    print("  ************************")
+    print("  >> Processing fibers and computing metrics (%s fibers)" % n)
+    (
+        fiberlabels,
+        final_fibers_idx,
+        final_fiberlabels_array,
+        dis,
+    ) = create_fiberlabels_array(
+        endpoints, label_map, nROIs, True, voxel_indices=voxel_indices
+    )
+
+    # Group the valid fibers by edge (CSR layout)
+    edges, edge_offsets, edge_fibers, edge_ids = group_fibers_by_edge(
+        final_fiberlabels_array
+    )
+
+    print(
+        "  ... INFO - Found %i (%f percent out of %i fibers) fibers " % (dis, dis * 100.0 / n, n) +
+        "that start or terminate in a voxel which is not labeled. (orphans)"
+    )
+    print(
+        "  ... INFO - Valid fibers: %i (%f percent)"
+        % (n - dis, 100 - dis * 100.0 / n)
+    )
+
+    # create a final fiber length array
+    final_fiberlength_array = fiberlength_array[final_fibers_idx]
+
+    # Compute the connectivity measures of all edges at once
+    # New connectivity measures can be added here
+    # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
+    edge_metrics = compute_edge_metrics(
+        edges,
+        edge_offsets,
+        edge_ids,
+        final_fiberlength_array,
+        roi_voxel_counts,
+        node_order=node_order,
+    )
+
+    # Compute the statistics of the additional maps along the fibers of each edge.
+    # This is indexed into the fibers that are valid in the sense of touching start
+    # and end roi and not going out of the volume
+    fiber_edge_ids = np.full(n, -1, dtype=np.int64)
+    fiber_edge_ids[final_fibers_idx] = edge_ids
+    map_metrics = {}
+    for k, (values, inside) in list(mmapdata.items()):
+        n_discarded = np.count_nonzero(~inside[final_fibers_idx])
+        if n_discarded > 0:
+            print(
+                "  ... ERROR - Index error occured when trying extract scalar values for measure",
+                k,
+            )
+            print(
+                "  ... ERROR - Discard %i fibers that leave the volume of the map" % n_discarded
+            )
+        map_metrics[k] = compute_edge_map_statistics(
+            values,
+            point_offsets,
+            n_points,
+            np.where(inside, fiber_edge_ids, -1),
+            edges.shape[0],
+            max_points=max_points,
+        )
+
+    # Edges without any sample of a map (all fibers discarded) get NaN,
+    # which is not stored as an edge attribute in the graph formats
+    for k, (mean, median, std) in list(map_metrics.items()):
+        edge_metrics[k + "_mean"] = mean
+        edge_metrics[k + "_std"] = std
+        edge_metrics[k + "_median"] = median
+
+    connectome = Connectome(
+        nodes=nodes,
+        sources=edges[:, 0],
+        targets=edges[:, 1],
+        edge_metrics=edge_metrics,
+        node_data=node_data,
+    )
+
+    print("  ************************************************")
+    print("  >> Save structural connectome maps as :")
+    # Storing network/graph in TSV format (by default to be BIDS compliant)
+    # and in other formats that might be prefered by the user
+    connectome.save("connectome_%s" % parkey, output_types=output_types)
+
+    # Storing final fiber length array
+    fiberlabels_fname = "final_fiberslength_%s.npy" % str(parkey)
+    np.save(fiberlabels_fname, final_fiberlength_array)
+
+    # Storing all fiber labels (with orphans)
+    fiberlabels_fname = "filtered_fiberslabel_%s.npy" % str(parkey)
+    np.save(
+        fiberlabels_fname,
+        np.array(fiberlabels, dtype=np.int32),
+    )
+
+    # Storing final fiber labels (no orphans)
+    fiberlabels_noorphans_fname = "final_fiberlabels_%s.npy" % str(parkey)
+    np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
+
+    # Storing the streamlines of each edge (indices in the input tractogram)
+    save_edge_streamline_index(
+        parkey, edges, edge_offsets, final_fibers_idx[edge_fibers]
+    )
+
+    return final_fibers_idx, connectome
+
+
 def cmat(
     intrk,
     roi_volumes=None,
@@ -171,6 +1122,9 @@ def cmat(
     additional_maps=None,
     output_types=None,
     atlas_info=None,
+    n_procs=1,
+    chunk_size=0,
+    endpoint_search_radius=0,
 ):
     """Create the connection matrix for each resolution using fibers and ROIs.
 
@@ -193,11 +1147,28 @@ def cmat(
         A dictionary of key/value for each additional map where the value
         is the path to the map
 
-    output_types : ['gpickle','mat','graphml']
+    output_types : ['gpickle','mat','graphml','h5']
+        With 'h5', the connectomes and fiber arrays of all the resolutions
+        are also saved in the single compressed file ``connectome.h5``
 
     atlas_info : dict
         Dictionary storing information such as path to files related to a
         parcellation atlas / scheme.
+
+    n_procs : int
+        Number of processes used to build and save the connectomes of
+        the different resolutions in parallel (Default: 1)
+
+    chunk_size : int
+        If strictly positive, the tractogram is read lazily by chunks of
+        ``chunk_size`` streamlines and is never loaded entirely in memory.
+        Samples of the additional maps are then stored in temporary
+        memory-mapped files (Default: 0, the whole tractogram is loaded)
+
+    endpoint_search_radius : float
+        If strictly positive, fiber endpoints in unlabeled voxels are assigned
+        to the nearest ROI within this distance (in mm) instead of being
+        counted as orphans (Default: 0)
     """
     if additional_maps is None:
         additional_maps = {}
@@ -217,33 +1188,31 @@ def cmat(
     en_fnamemm = "endpointsmm.npy"
     curv_fname = "meancurvature.npy"
 
-    trk_file = nib.streamlines.TrkFile.load(intrk)
-    fib = trk_file.streamlines
-    hdr = trk_file.header
-    n = len(fib)  # number of fibersk
     if parcellation_scheme != "Custom":
-        if parcellation_scheme != "Lausanne2018":
-            resolutions = get_parcellation(parcellation_scheme)
-        else:
-            resolutions = get_parcellation(parcellation_scheme)
-            for parkey, parval in list(resolutions.items()):
-                for vol, graphml in zip(roi_volumes, roi_graphmls):
-                    if parkey in vol:
-                        roi_fname = vol
-                    if parkey in graphml:
-                        roi_graphml_fname = graphml
-
-                roi = nib.load(roi_fname)
-                roiData = roi.get_fdata()
-                resolutions[parkey]["number_of_regions"] = roiData.max()
-                resolutions[parkey]["node_information_graphml"] = op.abspath(
-                    roi_graphml_fname
-                )
-
-            del roi, roiData
+        resolutions = get_parcellation(parcellation_scheme)
     else:
         resolutions = atlas_info
 
+    # Load the ROI volume of each resolution once:
+    # scale1 for lausanne2008/18
+    # first volume for nativefreesurfer
+    roi_data = {}
+    for parkey, parval in list(resolutions.items()):
+        for vol in roi_volumes:
+            if (parkey in vol) or (len(roi_volumes) == 1):
+                roi_fname = vol
+        # Integer labels (rather than a float64 copy of each volume)
+        roi_data[parkey] = np.asarray(nib.load(roi_fname).dataobj).astype(np.int32)
+
+        if parcellation_scheme == "Lausanne2018":
+            for graphml in roi_graphmls:
+                if parkey in graphml:
+                    roi_graphml_fname = graphml
+            resolutions[parkey]["number_of_regions"] = int(roi_data[parkey].max())
+            resolutions[parkey]["node_information_graphml"] = op.abspath(
+                roi_graphml_fname
+            )
+
     # Previously, load_endpoints_from_trk() used the voxel size stored
     # in the track hdr to transform the endpoints to ROI voxel space.
     # This only works if the ROI voxel size is the same as the DSI/DTI
@@ -255,419 +1224,148 @@ def cmat(
     firstROI = nib.load(firstROIFile)
     roiVoxelSize = firstROI.header.get_zooms()
 
-
-    (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize, True)
-    np.save(en_fname, endpoints)
-    np.save(en_fnamemm, endpointsmm)
-
-    # Only compute curvature if required
-    if compute_curvature:
-        meancurv = compute_curvature_array(fib)
-        np.save(curv_fname, meancurv)
-
-    streamline_wrote = False
-    for parkey, parval in list(resolutions.items()):
-        print("------------------------------------------------")
-        print("Resolution = " + parkey)
-        print("------------------------------------------------")
-
-        # create empty fiber label array
-        fiberlabels = np.zeros((n, 2))
-        final_fiberlabels = []
-        final_fibers_idx = []
-
-        # Open the corresponding ROI:
-        # scale1 for lausanne2008/18
-        # first volume for nativefreesurfer
-        for vol in roi_volumes:
-            if (parkey in vol) or (len(roi_volumes) == 1):
-                roi_fname = vol
-        roi = nib.load(roi_fname)
-        roiData = roi.get_fdata()
-
-        # Create the matrix
-        print(
-            "  >> Create the connection matrix (%s rois)" % parval["number_of_regions"]
+    # Load the additional maps once
+    mmap = additional_maps
+    maps = {}
+    print("  >> Maps to be processed :")
+    for k, v in list(mmap.items()):
+        print("     - %s map" % k)
+        da = nib.load(v)
+        mdata = np.nan_to_num(da.get_fdata())
+        maps[k] = (mdata, da.header.get_zooms())
+        del da
+
+    sample_files = []
+    if chunk_size > 0:
+        print("  >> Read the tractogram by chunks of %i fibers" % chunk_size)
+        fib = None
+        tract_data = _read_tractogram_by_chunks(
+            intrk, chunk_size, roiVoxelSize, compute_curvature, maps
         )
+        endpoints = tract_data["endpoints"]
+        endpointsmm = tract_data["endpointsmm"]
+        fiberlength_array = tract_data["fiberlength_array"]
+        n_points = tract_data["n_points"]
+        mmapdata = tract_data["mmapdata"]
+        sample_files = tract_data["sample_files"]
+        if compute_curvature:
+            meancurv = tract_data["meancurv"].reshape(-1, 1)
+        del tract_data
+        # Process the samples of the additional maps by batches of the size of a chunk
+        max_points = chunk_size * max(1, int(np.ceil(n_points.mean()))) if n_points.size else None
+    else:
+        trk_file = nib.streamlines.TrkFile.load(intrk)
+        fib = trk_file.streamlines
+        hdr = trk_file.header
 
-        nROIs = int(parval["number_of_regions"])
-        G = nx.Graph()
-
-        # Add node information from parcellation
-        gp = nx.read_graphml(parval["node_information_graphml"])
-        n_nodes = len(gp)
-        pc = -1
-        cnt = -1
-
-        for u, d in gp.nodes(data=True):
-
-            # Percent counter
-            cnt += 1
-            pcN = int(round(float(100 * cnt) / n_nodes))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print("%4.0f%%" % pc)
-
-            G.add_node(int(u))
-            for key in d:
-                G.nodes[int(u)][key] = d[key]
-            # compute a position for the node based on the mean position of the
-            # ROI in voxel coordinates (segmentation volume )
-            G.nodes[int(u)]["dn_position"] = tuple(
-                np.mean(np.where(roiData == int(d["dn_multiscaleID"])), axis=1)
-            )
-            G.nodes[int(u)]["roi_volume"] = np.sum(
-                roiData == int(d["dn_multiscaleID"])
-            )
+        (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize, True)
 
-        dis = 0
+        # Compute the length of all the fibers once
+        fiberlength_array = compute_lengths(fib)
 
-        # Prepare: compute the measures
-        t = [c[0] for c in fib]
-        h = np.array(t, dtype=object)
+        # Only compute curvature if required
+        if compute_curvature:
+            meancurv = compute_curvature_array(fib)
 
-        mmap = additional_maps
+        # Sample the additional maps once at every streamline point
         mmapdata = {}
-        print("  >> Maps to be processed :")
-        for k, v in list(mmap.items()):
-            print("     - %s map" % k)
-            da = nib.load(v)
-            mdata = da.get_fdata()
-            print(mdata.max())
-            mdata = np.nan_to_num(mdata)
-            print(mdata.max())
-            mmapdata[k] = (mdata, da.header.get_zooms())
-
-        print("  ************************")
-        print("  >> Processing fibers and computing metrics (%s fibers)" % n)
-        pc = -1
-        for i in range(n):  # n: number of fibers
-            # Percent counter
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print("%4.0f%%" % pc)
-
-            # ROI start => ROI end
-            try:
-                startvox = np.zeros((3, 1)).astype(int)
-                startvox[0] = int(endpoints[i, 0, 0])
-                startvox[1] = int(endpoints[i, 0, 1])
-                startvox[2] = int(endpoints[i, 0, 2])
-
-                endvox = np.zeros((3, 1)).astype(int)
-                endvox[0] = int(endpoints[i, 1, 0])
-                endvox[1] = int(endpoints[i, 1, 1])
-                endvox[2] = int(endpoints[i, 1, 2])
-
-                # Endpoints from create_endpoints_array
-                startROI = int(roiData[startvox[0], startvox[1], startvox[2]])
-                endROI = int(roiData[endvox[0], endvox[1], endvox[2]])
-
-            except IndexError:
-                print(" .. ERROR: An index error occured for fiber %s. " % i)
-                print("           This means that the fiber start or endpoint is outside the volume. Continue.")
-                print("           Continue.")
-                continue
-
-            # Filter
-            if startROI == 0 or endROI == 0:
-                dis += 1
-                fiberlabels[i, 0] = -1
-                continue
-
-            if startROI > int(nROIs) or endROI > int(nROIs):
-                print(" .. ERROR: Start or endpoint of fiber terminate in a voxel which is labeled higher")
-                print("           than is expected by the parcellation node information.")
-                print("           Start ROI: %i, End ROI: %i" % (startROI, endROI))
-                print("           This needs bugfixing!")
-                print("           Continue.")
-                continue
-
-            # Switch the rois in order to enforce startROI < endROI
-            if endROI < startROI:
-                tmp = startROI
-                startROI = endROI
-                endROI = tmp
-
-            # TODO: Refine fibers ending in thalamus
-            # if (startROI in thalamic_labels) or (endROI in thalamic_labels):
-            # Extract all thalamic nuclei the fiber is passing through
-            # Refine start/endROI connecting to the most probable nucleus
-
-            # Update fiber label
-            fiberlabels[i, 0] = startROI
-            fiberlabels[i, 1] = endROI
+        for k, (mdata, map_voxel_size) in list(maps.items()):
+            mmapdata[k] = sample_scalar_map(fib, mdata, map_voxel_size)
+        n_points = get_streamline_buffers(fib)[2]
+        max_points = None
+    del maps
 
-            final_fiberlabels.append([startROI, endROI])
-            final_fibers_idx.append(i)
-
-            # Add edge to graph
-            if G.has_edge(startROI, endROI):
-                G[startROI][endROI]["fiblist"].append(i)
-            else:
-                G.add_edge(startROI, endROI, fiblist=[i])
+    np.save(en_fname, endpoints)
+    np.save(en_fnamemm, endpointsmm)
+    if compute_curvature:
+        np.save(curv_fname, meancurv)
 
-        print(
-            "  ... INFO - Found %i (%f percent out of %i fibers) fibers " % (dis, dis * 100.0 / n, n) +
-            "that start or terminate in a voxel which is not labeled. (orphans)"
-        )
-        print(
-            "  ... INFO - Valid fibers: %i (%f percent)"
-            % (n - dis, 100 - dis * 100.0 / n)
+    # Index of the first point of each fiber in the map samples
+    point_offsets = np.zeros_like(n_points)
+    np.cumsum(n_points[:-1], out=point_offsets[1:])
+
+    # Label the endpoints of all the resolutions with the same voxel indices
+    voxel_indices = get_endpoint_voxel_indices(endpoints, firstROI.shape)
+
+    context = {
+        "roi_data": roi_data,
+        "endpoints": endpoints,
+        "voxel_indices": voxel_indices,
+        "fiberlength_array": fiberlength_array,
+        "mmapdata": mmapdata,
+        "n_points": n_points,
+        "point_offsets": point_offsets,
+        "max_points": max_points,
+        "output_types": output_types,
+        "roi_voxel_size": roiVoxelSize,
+        "endpoint_search_radius": float(endpoint_search_radius),
+    }
+
+    n_procs = max(1, min(int(n_procs), len(resolutions)))
+    if n_procs > 1 and "fork" in multiprocessing.get_all_start_methods():
+        print("  >> Create the connectomes of %i resolutions with %i processes" % (len(resolutions), n_procs))
+        # Worker processes inherit the shared data from the parent (fork)
+        global _CMAT_CONTEXT
+        _CMAT_CONTEXT = context
+        try:
+            with ProcessPoolExecutor(
+                max_workers=n_procs, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                futures = [
+                    executor.submit(_create_scale_connectome, parkey, parval)
+                    for parkey, parval in list(resolutions.items())
+                ]
+                results = [future.result() for future in futures]
+        finally:
+            _CMAT_CONTEXT = None
+    else:
+        results = [
+            _create_scale_connectome(parkey, parval, context)
+            for parkey, parval in list(resolutions.items())
+        ]
+    final_fibers_idx_list = [final_fibers_idx for final_fibers_idx, _ in results]
+
+    if "h5" in output_types:
+        print("  >> Save structural connectomes of all resolutions as :")
+        print("    - connectome.h5")
+        fiber_arrays = {}
+        for parkey in resolutions:
+            fiber_arrays[parkey] = {
+                name: np.load("%s_%s.npy" % (name, parkey))
+                for name in [
+                    "final_fiberslength",
+                    "filtered_fiberslabel",
+                    "final_fiberlabels",
+                    "edge_index",
+                    "edge_streamlines",
+                ]
+            }
+        save_connectomes_hdf5(
+            "connectome.h5",
+            {parkey: connectome for parkey, (_, connectome) in zip(resolutions, results)},
+            arrays=fiber_arrays,
         )
 
-        # create a final fiber length array
-        finalfiberlength = []
-        for idx in final_fibers_idx:
-            fiber_segment = fib[idx][0]
-
-            if fiber_segment.ndim == 1:
-        # Expand the dimension if it's 1D
-                fiber_segment = np.expand_dims(fiber_segment, axis=0)
-            elif fiber_segment.ndim != 2:
-                raise ValueError(f"Unexpected dimensionality for fiber segment: {fiber_segment.ndim}")
-
-# Now pass the correctly shaped fiber segment to the length function
-            finalfiberlength.append(length(fiber_segment))
-
-        # convert to array
-        final_fiberlength_array = np.array(finalfiberlength)
-
-        # make final fiber labels as array
-        final_fiberlabels_array = np.array(final_fiberlabels, dtype=np.int32)
-
-        total_fibers = 0
-        total_volume = 0
-        u_old = -1
-        for u, v, d in G.edges(data=True):
-            total_fibers += len(d["fiblist"])
-            if u != u_old:
-                total_volume += G.nodes[int(u)]["roi_volume"]
-            u_old = u
-
-        G_out = copy.deepcopy(G)
-
-        # Update edges
-        # New connectivity measures can be added here
-        # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
-        for u, v, d in G.edges(data=True):
-            # Check for diagonal elements that raise an error when the edge is visited a second time
-            G_out.remove_edge(u, v)
-
-            if len(list(G[u][v].keys())) == 1:
-                di = {"number_of_fibers": len(G[u][v]["fiblist"])}
-
-                # additional measures
-                # compute mean/std of fiber measure
-                if u <= v:
-                    idx = np.where(
-                        (final_fiberlabels_array[:, 0] == int(u))
-                        & (final_fiberlabels_array[:, 1] == int(v))
-                    )[0]
-                else:
-                    idx = np.where(
-                        (final_fiberlabels_array[:, 0] == int(v))
-                        & (final_fiberlabels_array[:, 1] == int(u))
-                    )[0]
-
-                di["fiber_length_mean"] = float(
-                    np.nanmean(final_fiberlength_array[idx])
-                )
-                di["fiber_length_median"] = float(
-                    np.nanmedian(final_fiberlength_array[idx])
-                )
-                di["fiber_length_std"] = float(np.nanstd(final_fiberlength_array[idx]))
-
-                di["fiber_proportion"] = float(
-                    100.0 * (di["number_of_fibers"] / float(total_fibers))
-                )
-
-                # Compute density
-                # Formula: density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
-                if di["fiber_length_mean"] > 0.0:
-                    di["fiber_density"] = float(
-                        (float(di["number_of_fibers"]) / float(di["fiber_length_mean"]))
-                        * float(
-                            2.0
-                            / (
-                                G.nodes[int(u)]["roi_volume"]
-                                + G.nodes[int(v)]["roi_volume"]
-                            )
-                        )
-                    )
-                    di["normalized_fiber_density"] = float(
-                        (
-                            (float(di["number_of_fibers"]) / float(total_fibers))
-                            / float(di["fiber_length_mean"])
-                        )
-                        * (
-                            (2.0 * float(total_volume))
-                            / (
-                                G.nodes[int(u)]["roi_volume"]
-                                + G.nodes[int(v)]["roi_volume"]
-                            )
-                        )
-                    )
-                else:
-                    di["fiber_density"] = 0.0
-                    di["normalized_fiber_density"] = 0.0
-                # This is indexed into the fibers that are valid in the sense of touching start
-                # and end roi and not going out of the volume
-                if u <= v:
-                    idx_valid = np.where(
-                        (fiberlabels[:, 0] == int(u)) & (fiberlabels[:, 1] == int(v))
-                    )[0]
-                else:
-                    idx_valid = np.where(
-                        (fiberlabels[:, 0] == int(v)) & (fiberlabels[:, 1] == int(u))
-                    )[0]
-
-                for k, vv in list(mmapdata.items()):
-                    val = []
-                    for i in idx_valid:
-                        # retrieve indices
-                        try:
-                            idx2 = (h[i] / vv[1]).astype(np.uint32)
-                            val.append(vv[0][idx2[:, 0], idx2[:, 1], idx2[:, 2]])
-                        except IndexError as e:
-                            print(
-                                "  ... ERROR - Index error occured when trying extract scalar values for measure",
-                                k,
-                            )
-                            print(
-                                "  ... ERROR - Discard fiber with index ",
-                                i,
-                                "Exception: ",
-                                e,
-                            )
-
-                    if len(val) > 0:
-                        da = np.concatenate(val)
-
-                        if k == "shore_rtop":
-                            di[k + "_mean"] = da.astype(np.float64).mean()
-                            di[k + "_std"] = da.astype(np.float64).std()
-                            di[k + "_median"] = np.median(da.astype(np.float64))
-                        else:
-                            di[k + "_mean"] = da.mean().astype(np.float)
-                            di[k + "_std"] = da.std().astype(np.float)
-                            di[k + "_median"] = np.median(da).astype(np.float)
-
-                        del da
-                        del val
-
-                G_out.add_edge(u, v)
-                for key in di:
-                    G_out[u][v][key] = di[key]
-
-        del G
-
-        print("  ************************************************")
-        print("  >> Save structural connectome maps as :")
-        # Get the edge attributes/keys/weights from the first edge and then break.
-        # Change w.r.t networkx2
-        edge_keys = []
-        for u, v, d in G_out.edges(data=True):
-            edge_keys = list(d.keys())
-            break
-
-        # Storing network/graph in TSV format (by default to be BIDS compliant)
-        print("    - connectome_%s.tsv" % parkey)
-        # Write header fields
-        with open("connectome_%s.tsv" % parkey, "w") as out_file:
-            tsv_writer = csv.writer(out_file, delimiter="\t")
-            header = ["source", "target"]
-            header = header + [key for key in edge_keys]
-            tsv_writer.writerow(header)
-        # Write list of graph edges with all connectivity metrics (edge_keys)
-        with open("connectome_%s.tsv" % parkey, "ab") as out_file:
-            nx.write_edgelist(
-                G_out,
-                out_file,
-                comments="#",
-                delimiter="\t",
-                data=edge_keys,
-                encoding="utf-8",
-            )
-
-        # Storing network/graph in other formats that might be prefered by the user
-        if "gpickle" in output_types:
-            print("    - connectome_%s.gpickle" % parkey)
-            nx.write_gpickle(G_out, "connectome_%s.gpickle" % parkey)
-
-        if "mat" in output_types:
-            edge_struct = {}
-            for edge_key in edge_keys:
-                if edge_key != "fiblist":
-                    edge_struct[edge_key] = nx.to_numpy_matrix(G_out, weight=edge_key)
-
-            # nodes
-            size_nodes = len(list(G_out.nodes(data=True)))
-
-            # Get the node attributes/keys from the first node and then break.
-            # Change w.r.t networkx2
-            for u, d in G_out.nodes(data=True):
-                node_keys = list(d.keys())
-                break
-
-            node_struct = {}
-            for node_key in node_keys:
-                if node_key == "dn_position":
-                    node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                else:
-                    node_arr = np.zeros(size_nodes, dtype=object)
-
-                node_n = 0
-                for _, node_data in G_out.nodes(data=True):
-                    node_arr[node_n] = node_data[node_key]
-                    node_n += 1
-                node_struct[node_key] = node_arr
-            print("    - connectome_%s.mat" % parkey)
-            sio.savemat(
-                "connectome_%s.mat" % parkey,
-                long_field_names=True,
-                mdict={"sc": edge_struct, "nodes": node_struct},
-            )
-
-        if "graphml" in output_types:
-            g2 = nx.Graph()
-            for u_gml, v_gml, d_gml in G_out.edges(data=True):
-                g2.add_edge(u_gml, v_gml)
-                for key in d_gml:
-                    g2[u_gml][v_gml][key] = d_gml[key]
-            for u_gml, d_gml in G_out.nodes(data=True):
-                g2.add_node(u_gml)
-                g2.nodes[u_gml]["dn_multiscaleID"] = d_gml["dn_multiscaleID"]
-                g2.nodes[u_gml]["dn_fsname"] = d_gml["dn_fsname"]
-                g2.nodes[u_gml]["dn_hemisphere"] = d_gml["dn_hemisphere"]
-                g2.nodes[u_gml]["dn_name"] = d_gml["dn_name"]
-                g2.nodes[u_gml]["dn_position_x"] = d_gml["dn_position"][0]
-                g2.nodes[u_gml]["dn_position_y"] = d_gml["dn_position"][1]
-                g2.nodes[u_gml]["dn_position_z"] = d_gml["dn_position"][2]
-                g2.nodes[u_gml]["dn_region"] = d_gml["dn_region"]
-            print("    - connectome_%s.graphml" % parkey)
-            nx.write_graphml(g2, "connectome_%s.graphml" % parkey)
-
-        # Storing final fiber length array
-        fiberlabels_fname = "final_fiberslength_%s.npy" % str(parkey)
-        np.save(fiberlabels_fname, final_fiberlength_array)
-
-        # Storing all fiber labels (with orphans)
-        fiberlabels_fname = "filtered_fiberslabel_%s.npy" % str(parkey)
-        np.save(
-            fiberlabels_fname,
-            np.array(fiberlabels, dtype=np.int32),
+    # The final tractogram keeps the valid fibers of the last resolution
+    if final_fibers_idx_list:
+        print("  > Filtering tractography - keeping only no orphan fibers")
+        finalfibers_fname = "streamline_final.trk"
+        if fib is None:
+            save_fibers_from_file(intrk, finalfibers_fname, final_fibers_idx_list[-1])
+        else:
+            save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx_list[-1])
+        # Position of each streamline in the file to extract edges without loading it
+        save_streamline_index(
+            finalfibers_fname,
+            final_fibers_idx_list[-1],
+            n_points[final_fibers_idx_list[-1]],
         )
 
-        # Storing final fiber labels (no orphans)
-        fiberlabels_noorphans_fname = "final_fiberlabels_%s.npy" % str(parkey)
-        np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
-
-        if not streamline_wrote:
-            print("  > Filtering tractography - keeping only no orphan fibers")
-            finalfibers_fname = "streamline_final.trk"
-            save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
+    # Remove the temporary files of the map samples
+    del mmapdata, context
+    for fname in sample_files:
+        if op.exists(fname):
+            os.remove(fname)
 
     print("Done.")
     print("========================")
@@ -700,6 +1398,28 @@ class DmriCmatInputSpec(BaseInterfaceInputSpec):
 
     output_types = traits.List(Str, desc="Output types of the connectivity matrices")
 
+    number_of_processes = traits.Int(
+        1,
+        usedefault=True,
+        desc="Number of processes used to build the connectivity matrices "
+             "of the different scales in parallel",
+    )
+
+    streamline_chunk_size = traits.Int(
+        0,
+        usedefault=True,
+        desc="Number of streamlines read at once to process the tractogram "
+             "by chunks without loading it entirely in memory "
+             "(0: load the whole tractogram)",
+    )
+
+    endpoint_search_radius = traits.Float(
+        0,
+        usedefault=True,
+        desc="Maximal distance (mm) to the nearest ROI of fiber endpoints "
+             "in unlabeled voxels (0: such fibers are orphans)",
+    )
+
     voxel_connectivity = InputMultiPath(
         File(exists=True),
         desc="ProbtrackX connectivity matrices (# seed voxels x # target ROIs)",
@@ -727,6 +1447,11 @@ class DmriCmatOutputSpec(TraitedSpec):
         desc="Final tractogram of fibers considered in the creation of connectivity matrices"
     )
 
+    streamline_index_files = OutputMultiPath(
+        File(),
+        desc="Numpy files indexing the streamlines of each edge and their position in the final tractogram",
+    )
+
     connectivity_matrices = OutputMultiPath(File(), desc="Connectivity matrices")
 
 
@@ -777,6 +1502,9 @@ class DmriCmat(BaseInterface):
             compute_curvature=self.inputs.compute_curvature,
             additional_maps=additional_maps,
             output_types=self.inputs.output_types,
+            n_procs=self.inputs.number_of_processes,
+            chunk_size=self.inputs.streamline_chunk_size,
+            endpoint_search_radius=self.inputs.endpoint_search_radius,
         )
 
         return runtime
@@ -795,6 +1523,11 @@ class DmriCmat(BaseInterface):
             os.path.abspath("final_fiberlabels*")
         )
         outputs["streamline_final_file"] = os.path.abspath("streamline_final.trk")
+        outputs["streamline_index_files"] = (
+            glob.glob(os.path.abspath("edge_index_*"))
+            + glob.glob(os.path.abspath("edge_streamlines_*"))
+            + glob.glob(os.path.abspath("streamline_final_index.npy"))
+        )
         outputs["connectivity_matrices"] = glob.glob(os.path.abspath("connectome*"))
 
         return outputs
@@ -831,6 +1564,37 @@ class RsfmriCmatInputSpec(BaseInterfaceInputSpec):
 
     DVARS_th = Float(desc="DVARS threshold")
 
+    roi_summary = traits.Enum(
+        "mean",
+        ["mean", "median", "pca"],
+        usedefault=True,
+        desc="Summary of the voxel time-series of each ROI: "
+             "mean, median or first principal component",
+    )
+
+    fc_measures = traits.List(
+        traits.Enum("corr", "cov", "partial_corr", "fisher_z"),
+        ["corr"],
+        usedefault=True,
+        desc="Functional connectivity measures: Pearson's correlation (corr), "
+             "covariance (cov), partial correlation (partial_corr) and "
+             "Fisher z-transformed correlation (fisher_z)",
+    )
+
+    voxel_block_size = traits.Int(
+        0,
+        usedefault=True,
+        desc="Maximal number of voxels of the fMRI volume read at once (0: whole volume)",
+    )
+
+    multiscale_timeseries = traits.Bool(
+        False,
+        usedefault=True,
+        desc="If `True` and the ROI summary is the mean, compute the time-series of "
+             "all the resolutions in a single pass over the fMRI volume, "
+             "deriving the coarser ROIs from the voxels they share with the finer ones",
+    )
+
     output_types = traits.List(Str, desc="Output types of the connectivity matrices")
 
 
@@ -848,7 +1612,8 @@ class RsfmriCmat(BaseInterface):
     """Creates the functional connectivity matrices for a given parcellation scheme.
 
     It applies scrubbing (if enabled), computes the average GM ROI time-series and computes
-        the Pearson's correlation coefficient between each GM ROI time-series poir.
+        the Pearson's correlation coefficient (and optionally the covariance, partial correlation
+        and Fisher z-transformed correlation) between each GM ROI time-series pair.
 
     Examples
     --------
@@ -883,8 +1648,7 @@ class RsfmriCmat(BaseInterface):
         print("   .. parcellation : %s" % self.inputs.parcellation_scheme)
         print("================================================")
 
-        fdata = nib.load(self.inputs.func_file).get_fdata()
-        tp = fdata.shape[3]
+        fdata = VoxelBlockReader(self.inputs.func_file, self.inputs.voxel_block_size)
 
         if self.inputs.parcellation_scheme != "Custom":
             if self.inputs.parcellation_scheme == "NativeFreesurfer":
@@ -906,6 +1670,23 @@ class RsfmriCmat(BaseInterface):
         else:
             resolutions = self.inputs.atlas_info
 
+        connectomes = {}
+        timeseries = {}
+
+        # Mean time-series of all the resolutions computed in a single pass
+        multiscale_ts = {}
+        if (self.inputs.multiscale_timeseries and self.inputs.roi_summary == "mean"
+                and len(resolutions) > 1 and len(self.inputs.roi_volumes) > 1):
+            print("  ************************************************")
+            print("  >> Compute mean rs-fMRI signal for each ROI of all resolutions")
+            parkeys = list(resolutions.keys())
+            multiscale_ts = compute_multiscale_roi_timeseries(
+                fdata,
+                [nib.load(self._get_roi_volume(parkey)).get_fdata() for parkey in parkeys],
+                [int(resolutions[parkey]["number_of_regions"]) for parkey in parkeys],
+            )
+            multiscale_ts = dict(zip(parkeys, multiscale_ts))
+
         # loop throughout all the resolutions ('scale33', ..., 'scale500')
         for parkey, parval in list(resolutions.items()):
             print("------------------------------------------------")
@@ -913,24 +1694,23 @@ class RsfmriCmat(BaseInterface):
             print("------------------------------------------------")
 
             # Open the corresponding ROI
-            for vol in self.inputs.roi_volumes:
-                if (parkey in vol) or (len(self.inputs.roi_volumes) == 1):
-                    roi_fname = vol
-
-            roi = nib.load(roi_fname)
+            roi = nib.load(self._get_roi_volume(parkey))
             mask = roi.get_fdata()
-
-            # Compute average time-series
-            print("  ************************************************")
-            print("  >> Compute average rs-fMRI signal for each cortical ROI ")
             nROIs = int(parval["number_of_regions"])  # number of ROIs for current resolution
 
-            # matrix number of rois vs timepoints
-            ts = np.zeros((int(nROIs), int(tp)), dtype=np.float32)
-
-            # loop throughout all the ROIs (current resolution)
-            for i in range(1, int(nROIs) + 1):
-                ts[i - 1, :] = fdata[mask == i].mean(axis=0)
+            if parkey in multiscale_ts:
+                ts = multiscale_ts[parkey]
+            else:
+                # Compute average time-series
+                print("  ************************************************")
+                print(
+                    "  >> Compute %s rs-fMRI signal for each cortical ROI "
+                    % self.inputs.roi_summary
+                )
+                # matrix number of rois vs timepoints, computed for all the ROIs at once
+                ts = compute_roi_timeseries(
+                    fdata, mask, nROIs, summary=self.inputs.roi_summary
+                )
 
             # Save average roi time-series
             np.save(os.path.abspath("averageTimeseries_%s.npy" % parkey), ts)
@@ -939,18 +1719,16 @@ class RsfmriCmat(BaseInterface):
             # Create graph, add node information from parcellation and recover ROI indexes
             print("  ************************************************")
             print("  >> Load %s to initialize graph " % parval["node_information_graphml"])
-            G = nx.Graph()
             gp = nx.read_graphml(parval["node_information_graphml"])
+            _, roi_positions = compute_roi_statistics(mask, nROIs + 1)
             ROI_idx = []
+            node_data = []
             for u, d in gp.nodes(data=True):
-                G.add_node(int(u))
-                for key in d:
-                    G.nodes[int(u)][key] = d[key]
+                d = dict(d)
                 # Compute a position for the node based on the mean position of the
                 # ROI in voxel coordinates (segmentation volume )
-                G.nodes[int(u)]["dn_position"] = tuple(
-                    np.mean(np.where(mask == int(d["dn_multiscaleID"])), axis=1)
-                )
+                d["dn_position"] = tuple(roi_positions[int(d["dn_multiscaleID"])])
+                node_data.append(d)
                 ROI_idx.append(int(d["dn_multiscaleID"]))
 
             # Apply scrubbing (if enabled)
@@ -991,105 +1769,44 @@ class RsfmriCmat(BaseInterface):
                 )
                 ts = ts_after_scrubbing
 
-            # Compute pairwise ROI time-series correlation
+            # Compute all the ROI time-series connectivity matrices at once
             print("  ************************************************")
-            print("  >> Compute pairwise ROI time-series correlation")
-            nnodes = ts.shape[0]
-            i = -1
-            for i_signal in ts:
-                i += 1
-                for j in range(i, nnodes):
-                    j_signal = ts[j, :]
-                    value = np.corrcoef(i_signal, j_signal)[0, 1]
-                    G.add_edge(ROI_idx[i], ROI_idx[j])
-                    G[ROI_idx[i]][ROI_idx[j]]["corr"] = value
-
-            # Get the edge attributes/keys/weights from the first edge and then break.
-            # Change w.r.t networkx2
-            edge_keys = []
-            for _, _, d in G.edges(data=True):
-                edge_keys = list(d.keys())
-                break
+            print(
+                "  >> Compute ROI time-series connectivity (%s)"
+                % ", ".join(self.inputs.fc_measures)
+            )
+            matrices = compute_functional_connectivity(ts, self.inputs.fc_measures)
+
+            connectome = Connectome.from_matrices(
+                nodes=ROI_idx, matrices=matrices, node_data=node_data
+            )
 
             # Save the computed connectivity matrix
             print("  ************************************************")
             print("  >> Save functional connectome map as:")
+            connectome.save(
+                "connectome_%s" % parkey, output_types=self.inputs.output_types
+            )
+            connectomes[parkey] = connectome
+            timeseries[parkey] = {"average_timeseries": ts}
 
-            print("    - connectome_%s.tsv" % parkey)
-            with open("connectome_%s.tsv" % parkey, "w") as out_file:
-                tsv_writer = csv.writer(out_file, delimiter="\t")
-                header = ["source", "target"]
-                header = header + [key for key in edge_keys]
-                tsv_writer.writerow(header)
-
-            with open("connectome_%s.tsv" % parkey, "ab") as out_file:
-                nx.write_edgelist(
-                    G,
-                    out_file,
-                    comments="#",
-                    delimiter="\t",
-                    data=edge_keys,
-                    encoding="utf-8",
-                )
-
-            # storing network
-            if "gpickle" in self.inputs.output_types:
-                print("    - connectome_%s.gpickle" % parkey)
-                nx.write_gpickle(G, "connectome_%s.gpickle" % parkey)
-
-            if "mat" in self.inputs.output_types:
-                print("    - connectome_%s.mat" % parkey)
-                edge_struct = {}
-                for edge_key in edge_keys:
-                    edge_struct[edge_key] = nx.to_numpy_matrix(G, weight=edge_key)
-
-                # Number of ROIs (nodes)
-                size_nodes = len(list(G.nodes()))
-
-                # Get the node attributes/keys from the first node and then break.
-                # Change w.r.t networkx2
-                for u, d in G.nodes(data=True):
-                    node_keys = list(d.keys())
-                    break
-
-                node_struct = {}
-                for node_key in node_keys:
-                    if node_key == "dn_position":
-                        node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                    else:
-                        node_arr = np.zeros(size_nodes, dtype=object)
-                    node_n = 0
-                    for _, node_data in G.nodes(data=True):
-                        node_arr[node_n] = node_data[node_key]
-                        node_n += 1
-                    node_struct[node_key] = node_arr
-
-                sio.savemat("connectome_%s.mat" % parkey, mdict={"sc": edge_struct, "nodes": node_struct})
-
-            if "graphml" in self.inputs.output_types:
-                print("    - connectome_%s.graphml" % parkey)
-                g2 = nx.Graph()
-                # Create graph nodes
-                for u_gml, d_gml in G.nodes(data=True):
-                    g2.add_node(u_gml)
-                    g2.nodes[u_gml]["dn_multiscaleID"] = d_gml["dn_multiscaleID"]
-                    g2.nodes[u_gml]["dn_fsname"] = d_gml["dn_fsname"]
-                    g2.nodes[u_gml]["dn_hemisphere"] = d_gml["dn_hemisphere"]
-                    g2.nodes[u_gml]["dn_name"] = d_gml["dn_name"]
-                    g2.nodes[u_gml]["dn_position_x"] = d_gml["dn_position"][0]
-                    g2.nodes[u_gml]["dn_position_y"] = d_gml["dn_position"][1]
-                    g2.nodes[u_gml]["dn_position_z"] = d_gml["dn_position"][2]
-                    g2.nodes[u_gml]["dn_region"] = d_gml["dn_region"]
-                # Create graph edges
-                for u_gml, v_gml, d_gml in G.edges(data=True):
-                    g2.add_edge(u_gml, v_gml)
-                    g2[u_gml][v_gml]["corr"] = float(d_gml["corr"])
-                # Save the graph
-                nx.write_graphml(g2, "connectome_%s.graphml" % parkey)
+        if "h5" in self.inputs.output_types:
+            print("  ************************************************")
+            print("  >> Save functional connectomes of all resolutions as:")
+            print("    - connectome.h5")
+            save_connectomes_hdf5("connectome.h5", connectomes, arrays=timeseries)
 
+        fdata.close()
         print("[ DONE ]")
         return runtime
 
+    def _get_roi_volume(self, parkey):
+        """Return the ROI volume of a resolution."""
+        for vol in self.inputs.roi_volumes:
+            if (parkey in vol) or (len(self.inputs.roi_volumes) == 1):
+                roi_fname = vol
+        return roi_fname
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs["connectivity_matrices"] = glob.glob(os.path.abspath("connectome*"))
@@ -1097,3 +1814,104 @@ class RsfmriCmat(BaseInterface):
         if self.inputs.apply_scrubbing:
             outputs["scrubbed_idx"] = os.path.abspath("tp_after_scrubbing.npy")
         return outputs
+
+
+class RsfmriDynamicCmatInputSpec(BaseInterfaceInputSpec):
+    avg_timeseries = InputMultiPath(
+        File(exists=True),
+        mandatory=True,
+        desc="ROI average timeseries saved by RsfmriCmat (averageTimeseries_<scale>.npy)",
+    )
+
+    window_length = traits.Int(
+        30, usedefault=True, desc="Number of time points of each window"
+    )
+
+    window_step = traits.Int(
+        1, usedefault=True, desc="Number of time points between two consecutive windows"
+    )
+
+    window_taper = traits.Enum(
+        "rectangular",
+        ["rectangular", "hamming", "hann"],
+        usedefault=True,
+        desc="Weighting of the time points in each window",
+    )
+
+    upper_triangle = traits.Bool(
+        False,
+        usedefault=True,
+        desc="Store only the values above the diagonal of each matrix",
+    )
+
+
+class RsfmriDynamicCmatOutputSpec(TraitedSpec):
+    dynamic_connectivity_matrices = OutputMultiPath(
+        File(exists=True),
+        desc="Sliding-window functional connectivity matrices of each resolution",
+    )
+
+
+class RsfmriDynamicCmat(BaseInterface):
+    """Creates sliding-window (dynamic) functional connectivity matrices.
+
+    For each resolution, the Pearson's correlation coefficients between the
+    ROI average time-series are computed in windows sliding over time and saved in
+    a ``dynamicFC_<scale>.npy`` float32 array of size [#windows, #rois, #rois]
+    (or [#windows, #rois * (#rois - 1) / 2] with ``upper_triangle``) that can be
+    memory-mapped with ``numpy.load(..., mmap_mode='r')``.
+
+    Examples
+    --------
+    >>> from cmtklib.connectome import RsfmriDynamicCmat
+    >>> dcmat = RsfmriDynamicCmat()
+    >>> dcmat.inputs.avg_timeseries = ['/path/to/averageTimeseries_scale1.npy',
+    >>>                                '/path/to/averageTimeseries_scale2.npy']
+    >>> dcmat.inputs.window_length = 30
+    >>> dcmat.inputs.window_step = 2
+    >>> dcmat.run() # doctest: +SKIP
+
+    """
+
+    input_spec = RsfmriDynamicCmatInputSpec
+    output_spec = RsfmriDynamicCmatOutputSpec
+
+    def _run_interface(self, runtime):
+        print("================================================")
+        print(" > Creation of rs-fMRI dynamic connectome maps")
+        print(
+            "   .. window : %i time points, step %i, %s taper"
+            % (self.inputs.window_length, self.inputs.window_step, self.inputs.window_taper)
+        )
+        print("================================================")
+
+        for ts_file in self.inputs.avg_timeseries:
+            # Windows are computed on the continuous (not scrubbed) time-series
+            fname = os.path.basename(ts_file)
+            if not fname.endswith(".npy") or fname.endswith("_after_scrubbing.npy"):
+                continue
+            parkey = fname[len("averageTimeseries_"):-len(".npy")]
+
+            ts = np.load(ts_file)
+            print("  >> Resolution %s: %i ROIs, %i time points" % ((parkey,) + ts.shape))
+            out_file = os.path.abspath("dynamicFC_%s.npy" % parkey)
+            dfc = compute_sliding_window_fc(
+                ts,
+                window_length=self.inputs.window_length,
+                step=self.inputs.window_step,
+                taper=self.inputs.window_taper,
+                upper_triangle=self.inputs.upper_triangle,
+                out_file=out_file,
+            )
+            print("    - %s (%i windows)" % (out_file, dfc.shape[0]))
+            del dfc
+
+        print("[ DONE ]")
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["dynamic_connectivity_matrices"] = glob.glob(
+            os.path.abspath("dynamicFC_*.npy")
+        )
+        return outputs
@@ -24,7 +24,7 @@ from nipype.interfaces.base import (
 
 from traits.trait_types import List, Str, Int, Enum
 
-from .util import length
+from .streamlines import compute_lengths
 
 
 def compute_length_array(trkfile=None, streams=None, savefname="lengths.npy"):
@@ -48,21 +48,16 @@ def compute_length_array(trkfile=None, streams=None, savefname="lengths.npy"):
     """
     if streams is None and trkfile is not None:
         print(f'Compute length array for fibers in {trkfile}')
-        streams, hdr = tv.read(trkfile, as_generator=True)
-        n_fibers = hdr["n_count"]
-        if n_fibers == 0:
+        streams = load(trkfile).streamlines
+        if len(streams) == 0:
             msg = (
-                f'Header field n_count of trackfile {trkfile} is set to 0. '
+                f'Trackfile {trkfile} does not contain any streamline. '
                 "No track seem to exist in this file."
             )
             print(msg)
             raise Exception(msg)
-    else:
-        n_fibers = len(streams)
 
-    fibers_length = np.zeros(n_fibers, dtype=np.float)
-    for i, fib in enumerate(streams):
-        fibers_length[i] = length(fib[0])
+    fibers_length = compute_lengths(streams)
 
     # store length array
     np.save(savefname, fibers_length)
@@ -98,29 +93,25 @@ def filter_fibers(intrk, outtrk="", fiber_cutoff_lower=20, fiber_cutoff_upper=50
         base, ext = os.path.splitext(filename)
         outtrk = os.path.abspath(base + "_cutfiltered" + ext)
 
+    # load trackfile (downside, needs everything in memory)
+    trk_file = load(intrk)
+
     # compute length array
-    le = compute_length_array(intrk)
+    le = compute_length_array(streams=trk_file.streamlines)
 
     # cut the fibers smaller than value
     reducedidx = np.where((le > fiber_cutoff_lower) & (le < fiber_cutoff_upper))[0]
 
-    # load trackfile (downside, needs everything in memory)
-    fibold, hdrold = tv.read(intrk)
-
     # rewrite the track vis file with the reduced number of fibers
-    outstreams = []
-    for i in reducedidx:
-        outstreams.append(fibold[i])
-
-    n_fib_out = len(outstreams)
-    hdrnew = hdrold.copy()
-    hdrnew["n_count"] = n_fib_out
+    tractogram = trk_file.tractogram[reducedidx]
+    hdrnew = trk_file.header.copy()
+    hdrnew["nb_streamlines"] = len(tractogram)
 
     # print("Compute length array for cutted fibers")
     # le = compute_length_array(streams=outstreams)
     print(f'Write out file: {outtrk}')
-    print(f'Number of fibers out : {hdrnew["n_count"]}')
-    tv.write(outtrk, outstreams, hdrnew)
+    print(f'Number of fibers out : {hdrnew["nb_streamlines"]}')
+    nib.streamlines.save(tractogram, outtrk, header=hdrnew)
     print(f'File wrote : {os.path.exists(outtrk)}')
 
     # ----
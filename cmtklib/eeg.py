@@ -7,11 +7,9 @@
 """Module that defines CMTK utility functions for the EEG pipeline."""
 
 import os
-import copy
-import csv
-import networkx as nx
 import numpy as np
-import scipy.io as sio
+
+from .network import Connectome, save_connectomes_hdf5
 
 
 def save_eeg_connectome_file(output_dir, output_basename, con_res, roi_labels, output_types=None):
@@ -32,7 +30,7 @@ def save_eeg_connectome_file(output_dir, output_basename, con_res, roi_labels, o
     roi_labels : list
         List of parcellation roi labels extracted from the epo.pkl file generated with MNE
 
-    output_types : ['tsv', 'gpickle', 'mat', 'graphml']
+    output_types : ['tsv', 'gpickle', 'mat', 'graphml', 'h5']
         List of output format in which to save the connectome files.
         (Default: `None`)
     """
@@ -41,11 +39,11 @@ def save_eeg_connectome_file(output_dir, output_basename, con_res, roi_labels, o
 
     con_methods = list(con_res.keys())
 
-    # Create a graph of n_nodes = shape of the connectivity matrix estimated by MNE
-    G = nx.Graph(np.ones(con_res[con_methods[0]].shape))
-
-    # Update node information
-    for u, d in G.nodes(data=True):
+    # Nodes of the connectome (shape of the connectivity matrix estimated by MNE)
+    nodes = list(range(con_res[con_methods[0]].shape[0]))
+    node_data = []
+    for u in nodes:
+        d = {}
         if ' ' in roi_labels[u]:  # Cortical-only labels generated by MNE
             label_split = roi_labels[u].split(' ')
             label_name = f'ctx{label_split[1]}-{label_split[0]}'
@@ -53,40 +51,28 @@ def save_eeg_connectome_file(output_dir, output_basename, con_res, roi_labels, o
             label_name = roi_labels[u]
 
         if "ctx" in label_name:
-            G.nodes[u]["dn_region"] = 'cortical'
-            G.nodes[u]["dn_hemisphere"] = 'left' if "-lh" in roi_labels[u] else "right"
+            d["dn_region"] = 'cortical'
+            d["dn_hemisphere"] = 'left' if "-lh" in roi_labels[u] else "right"
         else:
-            G.nodes[u]["dn_region"] = 'subcortical'
-            G.nodes[u]["dn_hemisphere"] = 'left' if "left" in roi_labels[u] else "right"
+            d["dn_region"] = 'subcortical'
+            d["dn_hemisphere"] = 'left' if "left" in roi_labels[u] else "right"
 
-        G.nodes[u]["dn_fsname"] = label_name
-        G.nodes[u]["dn_name"] = label_name
-        G.nodes[u]["dn_multiscaleID"] = int(u)
+        d["dn_fsname"] = label_name
+        d["dn_name"] = label_name
+        d["dn_multiscaleID"] = int(u)
         # TODO: Set position for the node based on the mean position of the
         #   ROI in voxel coordinates (segmentation volume )
-        # G.nodes[u]["dn_position_x"] = ...
-        # G.nodes[u]["dn_position_y"] = ...
-        # G.nodes[u]["dn_position_z"] = ...
- 
-    # Update edge weights
-    G_out = copy.deepcopy(G)
-    for u, v, d in G.edges(data=True):
-        G_out.remove_edge(u, v)
-
-        edge = {}
-        for method in con_methods:
-            val = float(con_res[method][int(v), int(u)])
-            edge[method] = val
-
-        G_out.add_edge(u, v)
-        for key in edge:
-            G_out[u][v][key] = float(edge[key])
-
-    # Change w.r.t networkx2
-    edge_keys = []
-    for u, v, d in G_out.edges(data=True):
-        edge_keys = list(d.keys())
-        break
+        # d["dn_position"] = ...
+        node_data.append(d)
+
+    # Edge weights between all pairs of nodes, taken from the lower
+    # triangle of the connectivity matrices estimated by MNE
+    connectome = Connectome.from_matrices(
+        nodes=nodes,
+        matrices={method: np.asarray(con_res[method], dtype=np.float64) for method in con_methods},
+        node_data=node_data,
+        lower=True,
+    )
 
     # Save the connectome file
     con_basepath = os.path.join(
@@ -95,79 +81,11 @@ def save_eeg_connectome_file(output_dir, output_basename, con_res, roi_labels, o
     )
 
     # In TSV format by default to be BIDS compliant
-    print(f"Save {con_basepath}.tsv...")
-
-    # Write header fields
-    with open(f"{con_basepath}.tsv", "w") as out_file:
-        tsv_writer = csv.writer(out_file, delimiter="\t")
-        header = ["source", "target"]
-        header = header + [key for key in edge_keys]
-        tsv_writer.writerow(header)
-    # Write list of graph edges with all connectivity metrics (edge_keys)
-    with open(f"{con_basepath}.tsv", "ab") as out_file:
-        nx.write_edgelist(
-            G_out,
-            out_file,
-            comments="#",
-            delimiter="\t",
-            data=edge_keys,
-            encoding="utf-8",
-        )
-
-    # In GPickle format
-    if "gpickle" in output_types:
-        # Storing network/graph in gpickle that might be prefered by the user
-        print(f"Save {con_basepath}.gpickle...")
-        nx.write_gpickle(G_out, f"{con_basepath}.gpickle")
-
-    # In MAT format
-    if "mat" in output_types:
-        edge_struct = {}
-        for edge_key in edge_keys:
-            edge_struct[edge_key] = nx.to_numpy_matrix(G_out, weight=edge_key)
-
-        # nodes
-        size_nodes = len(list(G_out.nodes(data=True)))
-
-        # Get the node attributes/keys from the first node and then break.
-        # Change w.r.t networkx2
-        for u, d in G_out.nodes(data=True):
-            node_keys = list(d.keys())
-            break
-
-        node_struct = {}
-        for node_key in node_keys:
-            if node_key == "dn_position":
-                node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-            else:
-                node_arr = np.zeros(size_nodes, dtype=np.object_)
-                
-                node_n = 0
-                for _, node_data in G_out.nodes(data=True):
-                    node_arr[node_n] = node_data[node_key]
-                    node_n += 1
-                node_struct[node_key] = node_arr
-        
-        print(f"Save {con_basepath}.mat...")
-        sio.savemat(
-            f"{con_basepath}.mat",
-            long_field_names=True,
-            mdict={"fc": edge_struct, "nodes": node_struct},
-        )
-
-    # In GRAPHML format
-    if "graphml" in output_types:
-        g2 = nx.Graph()
-        for u_gml, v_gml, d_gml in G_out.edges(data=True):
-            g2.add_edge(u_gml, v_gml)
-            for key in d_gml:
-                g2[u_gml][v_gml][key] = d_gml[key]
-        for u_gml, d_gml in G_out.nodes(data=True):
-            g2.add_node(u_gml)
-            g2.nodes[u_gml]["dn_multiscaleID"] = d_gml["dn_multiscaleID"]
-            g2.nodes[u_gml]["dn_fsname"] = d_gml["dn_fsname"]
-            g2.nodes[u_gml]["dn_hemisphere"] = d_gml["dn_hemisphere"]
-            g2.nodes[u_gml]["dn_name"] = d_gml["dn_name"]
-            g2.nodes[u_gml]["dn_region"] = d_gml["dn_region"]
-        print(f"Save {con_basepath}.graphml...")
-        nx.write_graphml(g2, f"{con_basepath}.graphml")
+    # and in the other formats that might be prefered by the user
+    print(f"Save {con_basepath}...")
+    connectome.save(con_basepath, output_types=output_types, matrix_key="fc")
+
+    # In HDF5 format with all the metrics in a single compressed file
+    if "h5" in output_types:
+        print(f"Save {con_basepath}.h5...")
+        save_connectomes_hdf5(f"{con_basepath}.h5", {"connectome": connectome})
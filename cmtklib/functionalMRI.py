@@ -17,8 +17,187 @@ from nipype.interfaces.base import (
     BaseInterfaceInputSpec,
     TraitedSpec,
     InputMultiPath,
+    isdefined,
 )
 
+from cmtklib.volumes import VoxelBlockReader, VoxelBlockWriter
+
+
+def regress_out(signals, design, block_size=10000, return_betas=False):
+    """Regress a design matrix out of voxel time-series by ordinary least squares.
+
+    The design matrix is the same for all the voxels, so its pseudo-inverse
+    is computed once and all the voxels are fitted with matrix products,
+    by blocks of ``block_size`` voxels to bound the memory overhead.
+
+    Parameters
+    ----------
+    signals : numpy.ndarray
+        Array of size [#voxels, #timepoints] with the voxel time-series,
+        replaced in place by the residuals of the fit
+
+    design : numpy.ndarray
+        Design matrix of size [#timepoints, #regressors]
+
+    block_size : int
+        Number of voxels fitted at once (Default: 10000)
+
+    return_betas : bool
+        If True, return the fitted coefficients (Default: False)
+
+    Returns
+    -------
+    betas : numpy.ndarray
+        Array of size [#voxels, #regressors] with the coefficients fitted
+        for each voxel, only if ``return_betas`` is True
+    """
+    design = np.asarray(design, dtype=np.float64).reshape(signals.shape[1], -1)
+    pinv_design = np.linalg.pinv(design)
+    if return_betas:
+        betas = np.zeros((signals.shape[0], design.shape[1]))
+
+    block_size = max(1, int(block_size))
+    for start in range(0, signals.shape[0], block_size):
+        block = slice(start, start + block_size)
+        block_betas = signals[block] @ pinv_design.T
+        signals[block] -= block_betas @ design.T
+        if return_betas:
+            betas[block] = block_betas
+
+    if return_betas:
+        return betas
+
+
+def polynomial_basis(n_timepoints, order):
+    """Return a basis of the polynomials of degree up to ``order`` sampled in time.
+
+    Legendre polynomials of the time rescaled to [-1, 1] are used, which are
+    far better conditioned than the powers of the time (Vandermonde matrix).
+
+    Parameters
+    ----------
+    n_timepoints : int
+        Number of time points
+
+    order : int
+        Maximal degree of the polynomials
+
+    Returns
+    -------
+    basis : numpy.ndarray
+        Matrix of size [n_timepoints, order + 1], the first column being constant
+    """
+    t = np.linspace(-1, 1, int(n_timepoints))
+    return np.polynomial.legendre.legvander(t, int(order))
+
+
+def bandpass_filter(signals, tr, highpass=0.0, lowpass=0.0, design=None, block_size=10000):
+    """Band-pass filter voxel time-series by zeroing the stopband of their FFT.
+
+    The voxels are filtered by blocks of ``block_size`` voxels to bound the
+    memory used by their spectrum. If a nuisance design matrix is given, it is
+    filtered with the same filter and regressed out of the filtered time-series,
+    so that the band-pass filtering and the nuisance regression do not
+    reintroduce in the signal what the other step removed.
+
+    Parameters
+    ----------
+    signals : numpy.ndarray
+        Array of size [#voxels, #timepoints] with the voxel time-series,
+        replaced in place by the filtered time-series
+
+    tr : float
+        Repetition time in seconds
+
+    highpass : float
+        Frequency (Hz) below which the signal is removed, 0 to keep
+        the low frequencies and the mean (Default: 0)
+
+    lowpass : float
+        Frequency (Hz) above which the signal is removed, 0 to keep
+        the high frequencies (Default: 0)
+
+    design : numpy.ndarray
+        Optional nuisance design matrix of size [#timepoints, #regressors]
+        to filter and regress out of the filtered time-series (Default: None)
+
+    block_size : int
+        Number of voxels filtered at once (Default: 10000)
+    """
+    n_timepoints = signals.shape[1]
+    freqs = np.fft.rfftfreq(n_timepoints, d=tr)
+    stopband = np.zeros(freqs.size, dtype=bool)
+    if highpass > 0:
+        stopband |= freqs < highpass
+    if lowpass > 0:
+        stopband |= freqs > lowpass
+
+    if np.any(stopband):
+        block_size = max(1, int(block_size))
+        for start in range(0, signals.shape[0], block_size):
+            block = slice(start, start + block_size)
+            spectrum = np.fft.rfft(signals[block], axis=1)
+            spectrum[:, stopband] = 0
+            signals[block] = np.fft.irfft(spectrum, n=n_timepoints, axis=1)
+
+    if design is not None:
+        design = np.array(design, dtype=np.float64).reshape(n_timepoints, -1)
+        if np.any(stopband):
+            spectrum = np.fft.rfft(design, axis=0)
+            spectrum[stopband] = 0
+            design = np.fft.irfft(spectrum, n=n_timepoints, axis=0)
+        regress_out(signals, design, block_size=block_size)
+
+
+def get_repetition_time(img):
+    """Return the repetition time in seconds of a 4D NIfTI image.
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image
+        4D image
+
+    Returns
+    -------
+    tr : float
+        Repetition time in seconds
+    """
+    tr = float(img.header.get_zooms()[3])
+    if img.header.get_xyzt_units()[1] == "msec":
+        tr /= 1000.0
+    return tr
+
+
+def get_motion_regressors(move, nb_reg=6):
+    """Return the motion regressors of the nuisance regression.
+
+    Parameters
+    ----------
+    move : numpy.ndarray
+        Array of size [#timepoints, 6] with the motion parameters
+
+    nb_reg : {6, 12, 24, 36}
+        Number of regressors: the 6 demeaned parameters, plus their squares (12),
+        plus their values shifted by one time point and the squares (24),
+        plus their values shifted by two time points and the squares (36)
+
+    Returns
+    -------
+    regressors : numpy.ndarray
+        Array of size [#timepoints, nb_reg] with the demeaned regressors
+    """
+    move = np.asarray(move, dtype=np.float64)
+    move = move - np.mean(move, 0)
+    regressors = [move]
+    if nb_reg >= 12:
+        regressors.append(np.square(move))
+    for shift in [1, 2]:
+        if nb_reg >= 12 * (shift + 1):
+            shifted = np.concatenate((np.zeros([shift, 6]), move[0:-shift, :]), axis=0)
+            regressors += [shifted, np.square(shifted)]
+    regressors = np.hstack(regressors)
+    return regressors - np.mean(regressors, 0)
+
 
 class DiscardTPInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc="Input 4D fMRI image")
@@ -104,10 +283,37 @@ class NuisanceRegressionInputSpec(BaseInterfaceInputSpec):
         desc="Number of volumes discarded from the fMRI sequence during preprocessing"
     )
 
+    save_betas = Bool(
+        False,
+        usedefault=True,
+        desc="If `True` save the coefficients fitted for each voxel "
+             "(constant first, then the nuisance regressors)",
+    )
+
+    save_design = Bool(
+        False,
+        usedefault=True,
+        desc="If `True` save the design matrix of the regression "
+             "(used by the orthogonalized band-pass filtering)",
+    )
+
+    block_size = Int(
+        0,
+        usedefault=True,
+        desc="Maximal number of voxels read at once (0: whole volume)",
+    )
+
 
 class NuisanceRegressionOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="Output fMRI Volume")
 
+    betas_file = File(desc="Coefficients fitted for each voxel (one volume per regressor)")
+
+    design_file = File(
+        desc="Design matrix of the regression (constant first, then the nuisance regressors) "
+             "in `.npy` format"
+    )
+
     averageGlobal_npy = File(desc="Output of global regression in `.npy` format")
 
     averageCSF_npy = File(desc="Output of CSF regression in `.npy` format")
@@ -155,14 +361,32 @@ class NuisanceRegression(BaseInterface):
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
+        block_size = self.inputs.block_size
+        reader = VoxelBlockReader(ref_path, block_size)
+        tp = reader.n_timepoints
+
+        # Average signals of the masks, accumulated over the blocks of voxels
+        masks = {}
+        if self.inputs.global_nuisance:
+            masks["Global"] = self.inputs.brainfile  # eroded whole brain mask
+        if self.inputs.csf_nuisance:
+            masks["CSF"] = self.inputs.csf_file  # eroded CSF mask
+        if self.inputs.wm_nuisance:
+            masks["WM"] = self.inputs.wm_file  # eroded WM mask
+        for key, fname in masks.items():
+            masks[key] = (nib.load(fname).get_fdata().astype(np.uint32) == 1).ravel()
+        averages = {key: np.zeros(tp) for key in masks}
+        if masks:
+            union = np.any(list(masks.values()), axis=0)
+            for voxels, signals in reader.iter_blocks(union):
+                for key, mask in masks.items():
+                    averages[key] += signals[mask[voxels]].sum(axis=0, dtype=np.float64)
+            for key, mask in masks.items():
+                averages[key] /= np.count_nonzero(mask)
+
         # Extract whole brain average signal
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_fdata()
-        tp = data.shape[3]
         if self.inputs.global_nuisance:
-            brainfile = self.inputs.brainfile  # load eroded whole brain mask
-            brain = nib.load(brainfile).get_fdata().astype(np.uint32)
-            global_values = data[brain == 1].mean(axis=0)
+            global_values = averages["Global"]
             global_values = global_values - np.mean(global_values)
             np.save(os.path.abspath("averageGlobal.npy"), global_values)
             sio.savemat(
@@ -171,62 +395,29 @@ class NuisanceRegression(BaseInterface):
 
         # Extract CSF average signal
         if self.inputs.csf_nuisance:
-            csffile = self.inputs.csf_file  # load eroded CSF mask
-            csf = nib.load(csffile).get_fdata().astype(np.uint32)
-            csf_values = data[csf == 1].mean(axis=0)
+            csf_values = averages["CSF"]
             csf_values = csf_values - np.mean(csf_values)
             np.save(os.path.abspath("averageCSF.npy"), csf_values)
             sio.savemat(os.path.abspath("averageCSF.mat"), {"avgCSF": csf_values})
 
         # Extract WM average signal
         if self.inputs.wm_nuisance:
-            WMfile = self.inputs.wm_file  # load eroded WM mask
-            WM = nib.load(WMfile).get_fdata().astype(np.uint32)
-            wm_values = data[WM == 1].mean(axis=0)
+            wm_values = averages["WM"]
             wm_values = wm_values - np.mean(wm_values)
             np.save(os.path.abspath("averageWM.npy"), wm_values)
             sio.savemat(os.path.abspath("averageWM.mat"), {"avgWM": wm_values})
 
         # Import parameters from head motion estimation
         if self.inputs.motion_nuisance:
-            move = np.genfromtxt(self.inputs.motion_file)
-            move = move - np.mean(move, 0)
-
-            # Update
-            move_der1 = np.concatenate((np.zeros([1, 6]), move[0:-1, :]), axis=0)
-            move_der2 = np.concatenate((np.zeros([2, 6]), move[0:-2, :]), axis=0)
-            move_sq = np.square(move)
-            move_der1_sq = np.square(move_der1)
-            move_der2_sq = np.square(move_der2)
-
-            move_der1 = move_der1 - np.mean(move_der1)
-            move_der2 = move_der2 - np.mean(move_der2)
-            move_der1_sq = move_der1_sq - np.mean(move_der1_sq)
-            move_der2_sq = move_der2_sq - np.mean(move_der2_sq)
-            move_sq = move_sq - np.mean(move_sq)
-
-            if (
-                self.inputs.nuisance_motion_nb_reg == "12"
-                or self.inputs.nuisance_motion_nb_reg == "24"
-                or self.inputs.nuisance_motion_nb_reg == "36"
-            ):
-                move = np.hstack((move, move_sq))
-            if (
-                self.inputs.nuisance_motion_nb_reg == "24"
-                or self.inputs.nuisance_motion_nb_reg == "36"
-            ):
-                move = np.hstack((move, move_der1))
-                move = np.hstack((move, move_der1_sq))
-            if self.inputs.nuisance_motion_nb_reg == "36":
-                move = np.hstack((move, move_der2))
-                move = np.hstack((move, move_der2_sq))
+            nb_reg = 6
+            if isdefined(self.inputs.nuisance_motion_nb_reg):
+                nb_reg = int(self.inputs.nuisance_motion_nb_reg)
+            move = get_motion_regressors(np.genfromtxt(self.inputs.motion_file), nb_reg)
 
         # GLM: regress out nuisance covariates
-        new_data = data.copy()
 
         # s = gconf.parcellation.keys()[0]
 
-        gm = nib.load(self.inputs.gm_file[0]).get_fdata().astype(np.uint32)
         # if float(self.inputs.n_discard) > 0:
         #     n_discard = int(self.inputs.n_discard) - 1
         #     if self.inputs.motion_nuisance:
@@ -285,30 +476,41 @@ class NuisanceRegression(BaseInterface):
             X = move
             print("> Detrend motion average signals")
 
-        import statsmodels.api as sm
-
-        X = sm.add_constant(X)
-        # print('Shape X GLM')
-        # print(X.shape)
-
-        # loop throughout all GM voxels
-        for index, _ in np.ndenumerate(gm):
-            Y = data[index[0], index[1], index[2], :].reshape(tp, 1)
-            gls_model = sm.GLS(Y, X)
-            gls_results = gls_model.fit()
-            # new_data[index[0],index[1],index[2],:] = gls_results.resid
-            new_data[
-                index[0], index[1], index[2], :
-            ] = gls_results.resid  # + gls_results.params[8]
-
-        img = nib.Nifti1Image(new_data, affine=dataimg.affine, header=dataimg.header)
-        nib.save(img, os.path.abspath("fMRI_nuisance.nii.gz"))
+        X = np.column_stack((np.ones(tp), X.reshape(tp, -1)))
+        if self.inputs.save_design:
+            np.save(os.path.abspath("nuisance_design.npy"), X)
+
+        # Fit all the voxels with a signal of each block at once (the residuals
+        # of the voxels without any signal are zero)
+        if self.inputs.save_betas:
+            betas_data = np.zeros((int(np.prod(reader.shape[:3])), X.shape[1]))
+        with reader, VoxelBlockWriter(
+            "fMRI_nuisance.nii.gz", reader, memmap=block_size > 0
+        ) as writer:
+            for voxels, signals in reader.iter_blocks():
+                rows = np.flatnonzero(np.any(signals != 0, axis=1))
+                fitted = signals[rows]
+                betas = regress_out(fitted, X, return_betas=self.inputs.save_betas)
+                signals[rows] = fitted
+                writer.write(voxels, signals)
+                if self.inputs.save_betas:
+                    betas_data[voxels[rows]] = betas
+
+        if self.inputs.save_betas:
+            betas_img = nib.Nifti1Image(
+                betas_data.reshape(reader.shape[:3] + (X.shape[1],)), affine=reader.affine
+            )
+            nib.save(betas_img, os.path.abspath("fMRI_nuisance_betas.nii.gz"))
 
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs["out_file"] = os.path.abspath("fMRI_nuisance.nii.gz")
+        if self.inputs.save_design:
+            outputs["design_file"] = os.path.abspath("nuisance_design.npy")
+        if self.inputs.save_betas:
+            outputs["betas_file"] = os.path.abspath("fMRI_nuisance_betas.nii.gz")
         if self.inputs.global_nuisance:
             outputs["averageGlobal_npy"] = os.path.abspath("averageGlobal.npy")
             outputs["averageGlobal_mat"] = os.path.abspath("averageGlobal.mat")
@@ -330,6 +532,19 @@ class DetrendingInputSpec(BaseInterfaceInputSpec):
 
     mode = Enum(["linear", "quadratic", "cubic"], desc="Detrending order")
 
+    polynomial_order = Int(
+        0,
+        usedefault=True,
+        desc="Order of the polynomial trend removed from the signal. "
+             "If strictly positive, it overrides the order set by `mode`",
+    )
+
+    block_size = Int(
+        0,
+        usedefault=True,
+        desc="Maximal number of voxels read at once (0: whole volume)",
+    )
+
 
 class DetrendingOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="Detrended fMRI volume")
@@ -358,77 +573,133 @@ class Detrending(BaseInterface):
     output_spec = DetrendingOutputSpec
 
     def _run_interface(self, runtime):
-        print("Linear detrending")
+        order = self.inputs.polynomial_order
+        if order <= 0:
+            order = {"linear": 1, "quadratic": 2, "cubic": 3}[self.inputs.mode]
+        print("Polynomial detrending (order %i)" % order)
         print("=================")
 
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
-        # Load data
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_fdata()
-        tp = data.shape[3]
+        # Load data by blocks of voxels
+        block_size = self.inputs.block_size
+        reader = VoxelBlockReader(ref_path, block_size)
+        tp = reader.n_timepoints
+        gm = nib.load(self.inputs.gm_file[0]).get_fdata().astype(np.uint32).ravel()
+
+        # GLM: regress out the polynomial trend of all the GM voxels of each block at once
+        basis = polynomial_basis(tp, order)
+        with reader, VoxelBlockWriter(
+            "fMRI_detrending.nii.gz", reader, memmap=block_size > 0
+        ) as writer:
+            for voxels, signals in reader.iter_blocks():
+                rows = np.flatnonzero(gm[voxels])
+                gm_signals = signals[rows]
+                regress_out(gm_signals, basis)
+                signals[rows] = gm_signals
+                writer.write(voxels, signals)
 
-        # GLM: regress out nuisance covariates
-        new_data_det = data.copy()
-        gm = nib.load(self.inputs.gm_file[0]).get_fdata().astype(np.uint32)
+        print("[ DONE ]")
+        return runtime
 
-        from scipy import signal
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["out_file"] = os.path.abspath("fMRI_detrending.nii.gz")
+        return outputs
 
-        for index, value in np.ndenumerate(gm):
-            if value == 0:
-                continue
 
-            Ydet = signal.detrend(
-                data[index[0], index[1], index[2], :].reshape(tp, 1), axis=0
-            )
-            new_data_det[index[0], index[1], index[2], :] = Ydet[:, 0]
-
-        img = nib.Nifti1Image(new_data_det, affine=dataimg.affine, header=dataimg.header)
-        nib.save(img, os.path.abspath("fMRI_detrending.nii.gz"))
-
-        if self.inputs.mode == "quadratic":
-            print("Quadratic detrending")
-            print("=================")
-            from obspy.signal.detrend import polynomial
-
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = polynomial(
-                    new_data_det2[index[0], index[1], index[2], :], order=2
-                )
+class BandpassFilterInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="Input 4D fMRI image")
 
-            img = nib.Nifti1Image(
-                new_data_det2, affine=dataimg.affine, header=dataimg.header
-            )
-            nib.save(img, os.path.abspath("fMRI_detrending.nii.gz"))
-
-        if self.inputs.mode == "cubic":
-            print("Cubic-spline detrending")
-            print("=================")
-            from obspy.signal.detrend import spline
-
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = spline(new_data_det2[index[0], index[1], index[2], :], order=3)
-
-            img = nib.Nifti1Image(
-                new_data_det2, affine = dataimg.affine, header = dataimg.header
-            )
-            nib.save(img, os.path.abspath("fMRI_detrending.nii.gz"))
+    mask_file = File(
+        exists=True,
+        desc="Mask of the voxels to filter, the other voxels being set to zero "
+             "(Default: all the voxels with a signal)",
+    )
+
+    design_file = File(
+        exists=True,
+        desc="Design matrix of the nuisance regression in `.npy` format, "
+             "filtered and regressed out of the filtered signals if given",
+    )
+
+    highpass = Float(0.0, usedefault=True, desc="Frequency (Hz) below which the signal is removed")
+
+    lowpass = Float(0.0, usedefault=True, desc="Frequency (Hz) above which the signal is removed")
+
+    tr = Float(desc="Repetition time in seconds (Default: from the image header)")
+
+    block_size = Int(
+        0,
+        usedefault=True,
+        desc="Maximal number of voxels read at once (0: whole volume)",
+    )
+
+
+class BandpassFilterOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="Band-pass filtered fMRI volume")
+
+
+class BandpassFilter(BaseInterface):
+    """Band-pass filter the voxel time-series of a 4D fMRI image with FFT.
+
+    The masked voxels are read and filtered as (voxels x time) matrices,
+    by blocks of voxels, and the voxels outside the mask are set to zero.
+    If the design matrix of the nuisance regression is given, the nuisance
+    regressors are filtered with the same filter and regressed out of the
+    filtered signals (orthogonalized band-pass filtering).
+
+    Examples
+    --------
+    >>> from cmtklib.functionalMRI import BandpassFilter
+    >>> bandpass = BandpassFilter()
+    >>> bandpass.inputs.in_file = 'fMRI_nuisance.nii.gz'
+    >>> bandpass.inputs.design_file = 'nuisance_design.npy'
+    >>> bandpass.inputs.highpass = 0.01
+    >>> bandpass.inputs.lowpass = 0.1
+    >>> bandpass.run()  # doctest: +SKIP
+
+    """
+
+    input_spec = BandpassFilterInputSpec
+    output_spec = BandpassFilterOutputSpec
+
+    def _run_interface(self, runtime):
+        block_size = self.inputs.block_size
+        reader = VoxelBlockReader(self.inputs.in_file, block_size)
+
+        mask = None
+        if isdefined(self.inputs.mask_file):
+            mask = nib.load(self.inputs.mask_file).get_fdata() > 0
+
+        design = None
+        if isdefined(self.inputs.design_file):
+            design = np.load(self.inputs.design_file)
+        tr = self.inputs.tr if isdefined(self.inputs.tr) else get_repetition_time(reader.img)
+        print(
+            "> Band-pass filtering [%g, %g] Hz (TR = %g s)"
+            % (self.inputs.highpass, self.inputs.lowpass, tr)
+        )
+
+        with reader, VoxelBlockWriter(
+            "fMRI_bandpass.nii.gz", reader, memmap=block_size > 0
+        ) as writer:
+            for voxels, signals in reader.iter_blocks(mask):
+                # Filter only the voxels with a signal
+                rows = np.flatnonzero(np.any(signals != 0, axis=1))
+                filtered = signals[rows]
+                bandpass_filter(
+                    filtered, tr, self.inputs.highpass, self.inputs.lowpass, design=design
+                )
+                signals[rows] = filtered
+                writer.write(voxels, signals)
 
-        print("[ DONE ]")
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs["out_file"] = os.path.abspath("fMRI_detrending.nii.gz")
+        outputs["out_file"] = os.path.abspath("fMRI_bandpass.nii.gz")
         return outputs
 
 
@@ -445,6 +716,27 @@ class ScrubbingInputSpec(BaseInterfaceInputSpec):
         exists=True, desc="Motion parameters from preprocessing stage"
     )
 
+    fd_formula = Enum(
+        "sum",
+        ["sum", "power"],
+        usedefault=True,
+        desc="Framewise displacement formula: sum of the absolute differences "
+             "of the raw motion parameters (sum), or with the rotations converted "
+             "to displacements on a sphere of radius `head_radius` (power)",
+    )
+
+    head_radius = Float(
+        50.0,
+        usedefault=True,
+        desc="Radius (mm) of the sphere used to convert rotations to displacements",
+    )
+
+    block_size = Int(
+        0,
+        usedefault=True,
+        desc="Maximal number of voxels read at once (0: whole volume)",
+    )
+
 
 class ScrubbingOutputSpec(TraitedSpec):
     fd_mat = File(exists=True, desc="FD matrix for scrubbing")
@@ -455,6 +747,101 @@ class ScrubbingOutputSpec(TraitedSpec):
 
     dvars_npy = File(exists=True, desc="DVARS in .npy format")
 
+    dvars_std_mat = File(exists=True, desc="Standardized DVARS matrix for scrubbing")
+
+    dvars_std_npy = File(exists=True, desc="Standardized DVARS in .npy format")
+
+
+def compute_framewise_displacement(motion, formula="sum", head_radius=50.0):
+    """Compute the framewise displacement from the motion parameters.
+
+    Parameters
+    ----------
+    motion : numpy.ndarray
+        Array of size [#timepoints, 6] with the motion parameters, the three
+        rotations (in radians) first and then the three translations (in mm),
+        as saved by FSL MCFLIRT
+
+    formula : {'sum', 'power'}
+        'sum' adds the absolute differences of the raw parameters while
+        'power' first converts the rotations to displacements on a sphere
+        of radius ``head_radius`` (Power et al., 2012) (Default: 'sum')
+
+    head_radius : float
+        Radius of the sphere in mm (Default: 50)
+
+    Returns
+    -------
+    fd : numpy.ndarray
+        Array of size [#timepoints - 1] with the displacement between each
+        time point and the next one
+    """
+    motion = np.asarray(motion, dtype=np.float64)
+    if formula not in ["sum", "power"]:
+        raise ValueError("Invalid framewise displacement formula '%s' (sum or power)" % formula)
+    diff = np.abs(np.diff(motion, axis=0))
+    if formula == "power":
+        diff[:, :3] *= head_radius
+    return diff.sum(axis=1)
+
+
+def compute_dvars(signals):
+    """Compute the DVARS and the standardized DVARS of voxel time-series.
+
+    The standardized DVARS divides the DVARS by its expected value under
+    stationarity, estimated from the robust standard deviation and the
+    lag-1 autocorrelation of each voxel (Nichols, 2013).
+
+    Parameters
+    ----------
+    signals : numpy.ndarray or iterable of numpy.ndarray
+        Array of size [#voxels, #timepoints] with the voxel time-series,
+        or blocks of voxel time-series which are accumulated one at a time
+
+    Returns
+    -------
+    dvars : numpy.ndarray
+        Array of size [#timepoints - 1] with the root mean square over voxels
+        of the signal difference between each time point and the next one
+
+    dvars_std : numpy.ndarray
+        Array of size [#timepoints - 1] with the standardized DVARS
+    """
+    if isinstance(signals, np.ndarray):
+        signals = [signals]
+
+    sum_squares = 0
+    sum_expected = 0
+    n_voxels = 0
+    for block in signals:
+        block = np.asarray(block, dtype=np.float64)
+        sum_squares = sum_squares + (np.diff(block, axis=1) ** 2).sum(axis=0)
+
+        # Robust standard deviation and AR(1) coefficient of each voxel
+        q25, q75 = np.percentile(block, [25, 75], axis=1)
+        robust_sd = (q75 - q25) / 1.349
+        centered = block - block.mean(axis=1, keepdims=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ar1 = (centered[:, :-1] * centered[:, 1:]).sum(axis=1) / (centered ** 2).sum(axis=1)
+        ar1 = np.nan_to_num(ar1)
+        sum_expected += np.sum(np.sqrt(2 * (1 - ar1)) * robust_sd)
+        n_voxels += block.shape[0]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dvars = np.sqrt(sum_squares / n_voxels)
+        dvars_std = dvars / (sum_expected / n_voxels)
+    return dvars, dvars_std
+
+
+def _save_scrubbing_measures(fd, dvars, dvars_std, tp):
+    """Save the FD, DVARS and standardized DVARS used for scrubbing in `.npy` and `.mat` formats."""
+    for name, values in [("FD", fd), ("DVARS", dvars), ("DVARS_std", dvars_std)]:
+        # Measures between the time points i - 1 and i are stored at index i
+        measure = np.zeros((tp - 1, 1))
+        measure[1:, 0] = values[: tp - 2]
+        np.save(os.path.abspath("%s.npy" % name), measure)
+        sio.savemat(os.path.abspath("%s.mat" % name), {name: measure})
+
 
 class Scrubbing(BaseInterface):
     """Computes scrubbing parameters: `FD` and `DVARS`.
@@ -483,48 +870,30 @@ class Scrubbing(BaseInterface):
     def _run_interface(self, runtime):
         print("Precompute FD and DVARS for scrubbing")
         print("=====================================")
-        import scipy.io as sio
 
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_fdata()
-        tp = data.shape[3]
+        reader = VoxelBlockReader(ref_path, self.inputs.block_size)
+        tp = reader.n_timepoints
         WMfile = self.inputs.wm_mask
         WM = nib.load(WMfile).get_fdata().astype(np.uint32)
         GM = nib.load(self.inputs.gm_file[0]).get_fdata().astype(np.uint32)
         mask = WM + GM
         move = np.genfromtxt(self.inputs.motion_parameters)
 
-        # initialize motion measures
-        FD = np.zeros((tp - 1, 1))
-        DVARS = np.zeros((tp - 1, 1))
-
-        # loop throughout all the time points
-        FD[0] = 0
-        DVARS[0] = 0
-        for i in range(1, tp - 1):
-            # FD
-            move0 = move[i - 1, :]
-            move1 = move[i, :]
-            this_move = move1 - move0
-            this_move = np.absolute(this_move)
-            FD[i] = this_move.sum()
-
-            # DVARS
-            # extract current and following time points
-            temp0 = data[:, :, :, i - 1]
-            temp1 = data[:, :, :, i]
-            temp = temp1 - temp0
-            temp = np.power(temp, 2)
-            temp = temp[mask > 0]
-            DVARS[i] = np.power(temp.mean(), 0.5)
-
-        np.save(os.path.abspath("FD.npy"), FD)
-        np.save(os.path.abspath("DVARS.npy"), DVARS)
-        sio.savemat(os.path.abspath("FD.mat"), {"FD": FD})
-        sio.savemat(os.path.abspath("DVARS.mat"), {"DVARS": DVARS})
+        # FD from the differences of the motion parameters
+        fd = compute_framewise_displacement(
+            move, self.inputs.fd_formula, self.inputs.head_radius
+        )
+
+        # DVARS from the differences of the masked voxel time-series
+        with reader:
+            dvars, dvars_std = compute_dvars(
+                signals for _, signals in reader.iter_blocks(mask > 0)
+            )
+
+        _save_scrubbing_measures(fd, dvars, dvars_std, tp)
 
         print("[ DONE ]")
         return runtime
@@ -535,4 +904,272 @@ class Scrubbing(BaseInterface):
         outputs["dvars_mat"] = os.path.abspath("DVARS.mat")
         outputs["fd_npy"] = os.path.abspath("FD.npy")
         outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
+        outputs["dvars_std_mat"] = os.path.abspath("DVARS_std.mat")
+        outputs["dvars_std_npy"] = os.path.abspath("DVARS_std.npy")
+        return outputs
+
+
+class FunctionalDenoisingInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="Input 4D fMRI image")
+
+    gm_file = InputMultiPath(
+        File(exists=True), mandatory=True, desc="GM atlas files registered to fMRI space"
+    )
+
+    wm_file = File(
+        exists=True,
+        desc="WM mask registered to fMRI space (DVARS computed over the GM only if not provided)",
+    )
+
+    csf_file = File(exists=True, desc="Eroded CSF mask registered to fMRI space")
+
+    brainfile = File(exists=True, desc="Eroded brain mask registered to fMRI space")
+
+    motion_file = File(exists=True, desc="Motion parameters from preprocessing stage")
+
+    block_size = Int(
+        0,
+        usedefault=True,
+        desc="Maximal number of voxels read at once (0: whole volume)",
+    )
+
+    detrending = Bool(False, usedefault=True, desc="If `True` perform detrending")
+
+    detrending_mode = Enum(["linear", "quadratic", "cubic"], desc="Detrending order")
+
+    polynomial_order = Int(
+        0,
+        usedefault=True,
+        desc="Order of the polynomial trend, which overrides `detrending_mode` "
+             "if strictly positive",
+    )
+
+    global_nuisance = Bool(False, usedefault=True, desc="If `True` perform global nuisance regression")
+
+    csf_nuisance = Bool(False, usedefault=True, desc="If `True` perform CSF nuisance regression")
+
+    wm_nuisance = Bool(False, usedefault=True, desc="If `True` perform WM nuisance regression")
+
+    motion_nuisance = Bool(False, usedefault=True, desc="If `True` perform motion nuisance regression")
+
+    nuisance_motion_nb_reg = Enum(
+        6, [6, 12, 24, 36], usedefault=True, desc="Number of motion regressors"
+    )
+
+    save_betas = Bool(
+        False, usedefault=True, desc="If `True` save the coefficients of the nuisance regression"
+    )
+
+    bandpass_filtering = Bool(False, usedefault=True, desc="If `True` perform band-pass filtering")
+
+    highpass = Float(0.0, usedefault=True, desc="Frequency (Hz) below which the signal is removed")
+
+    lowpass = Float(0.0, usedefault=True, desc="Frequency (Hz) above which the signal is removed")
+
+    tr = Float(desc="Repetition time in seconds (Default: from the image header)")
+
+    orthogonalize = Bool(
+        False,
+        usedefault=True,
+        desc="If `True` regress the band-pass filtered nuisance regressors "
+             "out of the band-pass filtered signals",
+    )
+
+    scrubbing = Bool(False, usedefault=True, desc="If `True` compute FD and DVARS for scrubbing")
+
+    fd_formula = Enum(
+        "sum", ["sum", "power"], usedefault=True, desc="Framewise displacement formula"
+    )
+
+    head_radius = Float(
+        50.0,
+        usedefault=True,
+        desc="Radius (mm) of the sphere used to convert rotations to displacements",
+    )
+
+
+class FunctionalDenoisingOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="Denoised fMRI volume")
+
+    betas_file = File(desc="Coefficients of the nuisance regression fitted for each voxel")
+
+    averageGlobal_npy = File(desc="Global average signal in `.npy` format")
+
+    averageCSF_npy = File(desc="CSF average signal in `.npy` format")
+
+    averageWM_npy = File(desc="WM average signal in `.npy` format")
+
+    fd_npy = File(desc="FD in .npy format")
+
+    dvars_npy = File(desc="DVARS in .npy format")
+
+    dvars_std_npy = File(desc="Standardized DVARS in .npy format")
+
+
+class FunctionalDenoising(BaseInterface):
+    """Apply detrending, nuisance regression and band-pass filtering in memory.
+
+    The 4D fMRI image is read once (by blocks of ``block_size`` voxels) as a single
+    precision matrix of the voxels with a signal or in one of the masks, the enabled steps are applied in the same order and
+    with the same definitions as the :class:`Detrending`, :class:`NuisanceRegression`,
+    band-pass filtering and :class:`Scrubbing` nodes of the functional stage, and
+    only the denoised image and the side outputs (average signals, FD, DVARS) are written.
+
+    Examples
+    --------
+    >>> from cmtklib.functionalMRI import FunctionalDenoising
+    >>> denoise = FunctionalDenoising()
+    >>> denoise.inputs.in_file = '/path/to/sub-01_task-rest_desc-preproc_bold.nii.gz'
+    >>> denoise.inputs.gm_file = ['/path/to/sub-01_space-meanBOLD_atlas-L2018_desc-scale1_dseg.nii.gz']
+    >>> denoise.inputs.wm_file = '/path/to/sub-01_space-meanBOLD_label-WM_dseg.nii.gz'
+    >>> denoise.inputs.csf_file = '/path/to/sub-01_space-meanBOLD_desc-eroded_label-CSF_dseg.nii.gz'
+    >>> denoise.inputs.motion_file = '/path/to/sub-01_motion.par'
+    >>> denoise.inputs.detrending = True
+    >>> denoise.inputs.detrending_mode = 'linear'
+    >>> denoise.inputs.csf_nuisance = True
+    >>> denoise.inputs.wm_nuisance = True
+    >>> denoise.inputs.motion_nuisance = True
+    >>> denoise.inputs.bandpass_filtering = True
+    >>> denoise.inputs.highpass = 0.01
+    >>> denoise.inputs.lowpass = 0.1
+    >>> denoise.inputs.scrubbing = True
+    >>> denoise.run()  # doctest: +SKIP
+
+    """
+
+    input_spec = FunctionalDenoisingInputSpec
+    output_spec = FunctionalDenoisingOutputSpec
+
+    def _load_mask(self, fname):
+        return nib.load(fname).get_fdata().astype(np.uint32)
+
+    def _run_interface(self, runtime):
+        print("In-memory functional MRI denoising")
+        print("==================================")
+
+        block_size = self.inputs.block_size
+        reader = VoxelBlockReader(self.inputs.in_file, block_size)
+        tp = reader.n_timepoints
+        gm = self._load_mask(self.inputs.gm_file[0])
+
+        masks = {}
+        if self.inputs.global_nuisance:
+            masks["Global"] = self._load_mask(self.inputs.brainfile) == 1
+        if self.inputs.csf_nuisance:
+            masks["CSF"] = self._load_mask(self.inputs.csf_file) == 1
+        if self.inputs.wm_nuisance:
+            masks["WM"] = self._load_mask(self.inputs.wm_file) == 1
+        if self.inputs.scrubbing:
+            if isdefined(self.inputs.wm_file):
+                masks["scrubbing"] = (self._load_mask(self.inputs.wm_file) + gm) > 0
+            else:
+                print("  ... WM mask not provided: DVARS computed over the GM voxels")
+                masks["scrubbing"] = gm > 0
+
+        # Matrix of the voxels with a signal or in one of the masks (voxels x time),
+        # gathered block by block in single precision
+        in_masks = np.zeros(gm.size, dtype=bool)
+        for mask in masks.values():
+            in_masks |= mask.ravel()
+        block_voxels = []
+        block_signals = []
+        for voxels, signals in reader.iter_blocks():
+            selected = np.any(signals != 0, axis=1) | in_masks[voxels]
+            block_voxels.append(voxels[selected])
+            block_signals.append(signals[selected])
+            del signals
+        voxels = np.concatenate(block_voxels)
+        signals = block_signals[0] if len(block_signals) == 1 else np.concatenate(block_signals)
+        del block_voxels, block_signals
+        rows = {key: np.flatnonzero(mask.ravel()[voxels]) for key, mask in masks.items()}
+
+        if self.inputs.scrubbing:
+            print("> Compute FD and DVARS")
+            move = np.genfromtxt(self.inputs.motion_file)
+            fd = compute_framewise_displacement(
+                move, self.inputs.fd_formula, self.inputs.head_radius
+            )
+            dvars, dvars_std = compute_dvars(signals[rows["scrubbing"]])
+            _save_scrubbing_measures(fd, dvars, dvars_std, tp)
+
+        if self.inputs.detrending:
+            order = self.inputs.polynomial_order
+            if order <= 0:
+                order = {"linear": 1, "quadratic": 2, "cubic": 3}[self.inputs.detrending_mode]
+            print("> Polynomial detrending (order %i)" % order)
+            gm_rows = np.flatnonzero(gm.ravel()[voxels])
+            gm_signals = signals[gm_rows]
+            regress_out(gm_signals, polynomial_basis(tp, order))
+            signals[gm_rows] = gm_signals
+
+        regressors = []
+        for key in ["Global", "CSF", "WM"]:
+            if key in masks:
+                print("> Regress out %s average signal" % key)
+                # Average over all the voxels of the mask, with or without signal
+                values = signals[rows[key]].sum(axis=0) / np.count_nonzero(masks[key])
+                values = values - np.mean(values)
+                np.save(os.path.abspath("average%s.npy" % key), values)
+                sio.savemat(os.path.abspath("average%s.mat" % key), {"avg%s" % key: values})
+                regressors.append(values.reshape(tp, 1))
+        if self.inputs.motion_nuisance:
+            print("> Regress out motion signals")
+            regressors.append(
+                get_motion_regressors(
+                    np.genfromtxt(self.inputs.motion_file), self.inputs.nuisance_motion_nb_reg
+                )
+            )
+        X = None
+        if regressors:
+            X = np.hstack([np.ones((tp, 1))] + regressors)
+            betas = regress_out(signals, X, return_betas=self.inputs.save_betas)
+            if self.inputs.save_betas:
+                betas_data = np.zeros((gm.size, X.shape[1]))
+                betas_data[voxels] = betas
+                nib.save(
+                    nib.Nifti1Image(betas_data.reshape(gm.shape + (X.shape[1],)), affine=reader.affine),
+                    os.path.abspath("fMRI_nuisance_betas.nii.gz"),
+                )
+
+        if self.inputs.bandpass_filtering:
+            tr = self.inputs.tr if isdefined(self.inputs.tr) else get_repetition_time(reader.img)
+            print(
+                "> Band-pass filtering [%g, %g] Hz (TR = %g s)"
+                % (self.inputs.highpass, self.inputs.lowpass, tr)
+            )
+            design = X if self.inputs.orthogonalize else None
+            if design is not None:
+                print("> Regress out band-pass filtered nuisance signals")
+            bandpass_filter(
+                signals, tr, self.inputs.highpass, self.inputs.lowpass, design=design
+            )
+
+        with reader, VoxelBlockWriter(
+            "fMRI_denoised.nii.gz", reader, memmap=block_size > 0
+        ) as writer:
+            writer.write(voxels, signals)
+
+        print("[ DONE ]")
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["out_file"] = os.path.abspath("fMRI_denoised.nii.gz")
+        if self.inputs.save_betas and (
+            self.inputs.global_nuisance
+            or self.inputs.csf_nuisance
+            or self.inputs.wm_nuisance
+            or self.inputs.motion_nuisance
+        ):
+            outputs["betas_file"] = os.path.abspath("fMRI_nuisance_betas.nii.gz")
+        if self.inputs.global_nuisance:
+            outputs["averageGlobal_npy"] = os.path.abspath("averageGlobal.npy")
+        if self.inputs.csf_nuisance:
+            outputs["averageCSF_npy"] = os.path.abspath("averageCSF.npy")
+        if self.inputs.wm_nuisance:
+            outputs["averageWM_npy"] = os.path.abspath("averageWM.npy")
+        if self.inputs.scrubbing:
+            outputs["fd_npy"] = os.path.abspath("FD.npy")
+            outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
+            outputs["dvars_std_npy"] = os.path.abspath("DVARS_std.npy")
         return outputs
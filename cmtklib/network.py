@@ -0,0 +1,587 @@
+# Copyright (C) 2009-2022, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module that defines the array-backed connectome container of CMTK and its writers."""
+
+import csv
+
+import networkx as nx
+import numpy as np
+import scipy.io as sio
+
+try:
+    import h5py
+except ImportError:  # pragma: no cover
+    h5py = None
+
+# Node attributes saved in GraphML format, ``dn_position`` being split in x, y, z
+GRAPHML_NODE_KEYS = [
+    "dn_multiscaleID",
+    "dn_fsname",
+    "dn_hemisphere",
+    "dn_name",
+    "dn_position",
+    "dn_region",
+]
+
+# Identifier of the single-file HDF5 connectome format
+HDF5_FORMAT = "cmp3-connectome"
+HDF5_FORMAT_VERSION = 1
+
+
+def _check_h5py():
+    if h5py is None:  # pragma: no cover
+        raise ImportError("h5py is required to save and read connectomes in HDF5 format")
+
+
+def _node_column(values):
+    """Convert the values of a node attribute into an array that can be stored in HDF5."""
+    if all(isinstance(value, str) for value in values):
+        return np.array(values, dtype=object), h5py.string_dtype()
+    column = np.asarray(values)
+    if column.dtype.kind not in "biuf":
+        return np.array([str(value) for value in values], dtype=object), h5py.string_dtype()
+    return column, column.dtype
+
+
+class Connectome(object):
+    """Connectome stored as a node table and one array per edge metric.
+
+    Edges are stored once for each pair of connected nodes, as (source, target)
+    positions in the node table with ``source <= target``, in the order in which
+    networkx iterates over the edges of an undirected graph with the same nodes.
+    The files of the different output formats are written directly from the arrays.
+
+    Parameters
+    ----------
+    nodes : list of int
+        Node IDs, in the order of the node table
+
+    sources : numpy.ndarray
+        Node ID of the first node of each edge
+
+    targets : numpy.ndarray
+        Node ID of the second node of each edge
+
+    edge_metrics : dict
+        Dictionary of metric name / array of size [#edges] pairs.
+        NaN values are considered missing and are not stored as edge
+        attributes in the graph formats (gpickle, GraphML)
+
+    node_data : list of dict
+        Attributes of each node (Default: no attributes)
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from cmtklib.network import Connectome
+    >>> con = Connectome(
+    ...     nodes=[1, 2, 3],
+    ...     sources=np.array([1, 3]),
+    ...     targets=np.array([2, 1]),
+    ...     edge_metrics={"number_of_fibers": np.array([10, 4])},
+    ... )
+    >>> con.to_matrix("number_of_fibers")
+    array([[ 0., 10.,  4.],
+           [10.,  0.,  0.],
+           [ 4.,  0.,  0.]])
+    """
+
+    def __init__(self, nodes, sources, targets, edge_metrics, node_data=None):
+        self.nodes = [int(u) for u in nodes]
+        if node_data is None:
+            node_data = [{} for _ in self.nodes]
+        if len(node_data) != len(self.nodes):
+            raise ValueError("The node table and node data must have the same length")
+        self.node_data = [dict(d) for d in node_data]
+
+        # Position of the edge nodes in the node table
+        node_ids = np.asarray(self.nodes, dtype=np.int64)
+        lookup = np.full(node_ids.max() + 1 if node_ids.size else 0, -1, dtype=np.int64)
+        lookup[node_ids] = np.arange(node_ids.size)
+
+        def _positions(ids):
+            ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+            known = (ids >= 0) & (ids < lookup.size)
+            pos = np.full(ids.size, -1, dtype=np.int64)
+            pos[known] = lookup[ids[known]]
+            if np.any(pos < 0):
+                raise ValueError(
+                    "Edge node %i is not in the node table of the connectome" % ids[pos < 0][0]
+                )
+            return pos
+
+        pos_s = _positions(sources)
+        pos_t = _positions(targets)
+        if pos_s.size != pos_t.size:
+            raise ValueError("Edge sources and targets must have the same length")
+
+        # Each edge is listed by networkx from the node that comes first in the node table
+        edge_order = np.argsort(np.minimum(pos_s, pos_t), kind="stable")
+        self.sources = np.minimum(pos_s, pos_t)[edge_order]
+        self.targets = np.maximum(pos_s, pos_t)[edge_order]
+
+        self.edge_metrics = {}
+        for key, values in edge_metrics.items():
+            values = np.asarray(values).reshape(-1)
+            if values.size != edge_order.size:
+                raise ValueError("Edge metric %s does not have one value per edge" % key)
+            self.edge_metrics[key] = values[edge_order]
+
+    @classmethod
+    def from_matrices(cls, nodes, matrices, node_data=None, lower=False):
+        """Create a connectome connecting all pairs of nodes from dense matrices.
+
+        Parameters
+        ----------
+        nodes : list of int
+            Node IDs, in the order of the matrix rows and columns
+
+        matrices : dict
+            Dictionary of metric name / matrix of size [#nodes, #nodes] pairs
+
+        node_data : list of dict
+            Attributes of each node
+
+        lower : bool
+            If True, take the values from the lower triangle of the matrices
+            instead of the upper triangle (Default: False)
+
+        Returns
+        -------
+        connectome : Connectome
+            Connectome with one edge for each pair of nodes, self-connections included
+        """
+        rows, cols = np.triu_indices(len(nodes))
+        if lower:
+            rows, cols = cols, rows
+        node_ids = np.asarray(nodes, dtype=np.int64)
+        return cls(
+            nodes=nodes,
+            sources=node_ids[rows],
+            targets=node_ids[cols],
+            edge_metrics={
+                key: np.asarray(matrix)[rows, cols] for key, matrix in matrices.items()
+            },
+            node_data=node_data,
+        )
+
+    @property
+    def edge_keys(self):
+        """List of the names of the edge metrics."""
+        return list(self.edge_metrics.keys())
+
+    @property
+    def number_of_edges(self):
+        """Number of edges of the connectome."""
+        return int(self.sources.size)
+
+    def to_matrix(self, key):
+        """Return the dense symmetric matrix of an edge metric.
+
+        Parameters
+        ----------
+        key : string
+            Name of the edge metric
+
+        Returns
+        -------
+        matrix : numpy.ndarray
+            Matrix of size [#nodes, #nodes] in the order of the node table,
+            with zeros for nodes that are not connected
+        """
+        n = len(self.nodes)
+        matrix = np.zeros((n, n), dtype=np.float64)
+        values = self.edge_metrics[key].astype(np.float64)
+        matrix[self.sources, self.targets] = values
+        matrix[self.targets, self.sources] = values
+        return matrix
+
+    def _edge_columns(self):
+        """Return the edge metrics as lists of Python scalars."""
+        return [self.edge_metrics[key].tolist() for key in self.edge_keys]
+
+    def _edge_tuples(self):
+        """Return the list of (u, v, attributes) of the edges, missing values omitted."""
+        keys = self.edge_keys
+        columns = self._edge_columns()
+        node_ids = np.asarray(self.nodes, dtype=np.int64)
+        edges = []
+        for edge_n, (u, v) in enumerate(
+            zip(node_ids[self.sources].tolist(), node_ids[self.targets].tolist())
+        ):
+            d = {}
+            for key, column in zip(keys, columns):
+                value = column[edge_n]
+                if value == value:  # not NaN
+                    d[key] = value
+            edges.append((u, v, d))
+        return edges
+
+    def to_networkx(self):
+        """Convert the connectome to a :class:`networkx.Graph`.
+
+        Returns
+        -------
+        G : networkx.Graph
+            Graph with the node table as node attributes and the
+            edge metrics as edge attributes (missing values omitted)
+        """
+        G = nx.Graph()
+        G.add_nodes_from(zip(self.nodes, [dict(d) for d in self.node_data]))
+        G.add_edges_from(self._edge_tuples())
+        return G
+
+    def write_tsv(self, fname):
+        """Save the list of edges with all the metrics in a TSV file.
+
+        Parameters
+        ----------
+        fname : string
+            Output filename
+        """
+        node_ids = np.asarray(self.nodes, dtype=np.int64)
+        columns = [
+            node_ids[self.sources].tolist(),
+            node_ids[self.targets].tolist(),
+        ] + self._edge_columns()
+
+        with open(fname, "w", newline="") as out_file:
+            tsv_writer = csv.writer(out_file, delimiter="\t")
+            tsv_writer.writerow(["source", "target"] + self.edge_keys)
+            out_file.writelines(
+                "\t".join(map(str, row)) + "\n" for row in zip(*columns)
+            )
+
+    def write_gpickle(self, fname):
+        """Save the connectome as a networkx graph in gpickle format.
+
+        Parameters
+        ----------
+        fname : string
+            Output filename
+        """
+        nx.write_gpickle(self.to_networkx(), fname)
+
+    def write_mat(self, fname, matrix_key="sc", exclude_keys=None):
+        """Save the dense matrix of each metric and the node table in a MATLAB file.
+
+        Parameters
+        ----------
+        fname : string
+            Output filename
+
+        matrix_key : string
+            Name of the MATLAB structure storing the matrices (Default: "sc")
+
+        exclude_keys : list
+            Edge metrics that are not saved
+        """
+        if exclude_keys is None:
+            exclude_keys = []
+        edge_struct = {
+            key: self.to_matrix(key) for key in self.edge_keys if key not in exclude_keys
+        }
+
+        size_nodes = len(self.nodes)
+        node_keys = list(self.node_data[0].keys()) if size_nodes else []
+        node_struct = {}
+        for node_key in node_keys:
+            if node_key == "dn_position":
+                node_arr = np.zeros([size_nodes, 3], dtype=np.float64)
+            else:
+                node_arr = np.zeros(size_nodes, dtype=object)
+            for node_n, node_data in enumerate(self.node_data):
+                node_arr[node_n] = node_data[node_key]
+            node_struct[node_key] = node_arr
+
+        sio.savemat(
+            fname,
+            long_field_names=True,
+            mdict={matrix_key: edge_struct, "nodes": node_struct},
+        )
+
+    def write_graphml(self, fname):
+        """Save the connectome in GraphML format.
+
+        Only the node attributes listed in ``GRAPHML_NODE_KEYS`` are saved.
+
+        Parameters
+        ----------
+        fname : string
+            Output filename
+        """
+        g2 = nx.Graph()
+        for u, d in zip(self.nodes, self.node_data):
+            attrs = {}
+            for key in GRAPHML_NODE_KEYS:
+                if key not in d:
+                    continue
+                if key == "dn_position":
+                    attrs["dn_position_x"] = d[key][0]
+                    attrs["dn_position_y"] = d[key][1]
+                    attrs["dn_position_z"] = d[key][2]
+                else:
+                    attrs[key] = d[key]
+            g2.add_node(u, **attrs)
+        g2.add_edges_from(self._edge_tuples())
+        nx.write_graphml(g2, fname)
+
+    def to_hdf5_group(self, group, compression="gzip"):
+        """Store the connectome in a group of an open HDF5 file.
+
+        The node table is stored in the ``nodes`` subgroup and the edges
+        in the ``edges`` subgroup, with one chunked and compressed dataset
+        per edge metric in ``edges/metrics``, so that each metric can be
+        read without loading the others.
+
+        Parameters
+        ----------
+        group : h5py.Group
+            HDF5 group in which the connectome is stored
+
+        compression : string
+            Compression filter of the datasets (Default: "gzip")
+        """
+        _check_h5py()
+        nodes = group.create_group("nodes", track_order=True)
+        nodes.create_dataset("ids", data=np.asarray(self.nodes, dtype=np.int64))
+        node_keys = list(self.node_data[0].keys()) if self.node_data else []
+        attributes = nodes.create_group("attributes", track_order=True)
+        for key in node_keys:
+            column, dtype = _node_column([d.get(key) for d in self.node_data])
+            attributes.create_dataset(key, data=column, dtype=dtype)
+
+        edges = group.create_group("edges", track_order=True)
+        kwargs = {"compression": compression, "shuffle": True} if self.number_of_edges else {}
+        edges.create_dataset("source_index", data=self.sources.astype(np.int32), **kwargs)
+        edges.create_dataset("target_index", data=self.targets.astype(np.int32), **kwargs)
+        metrics = edges.create_group("metrics", track_order=True)
+        for key, values in self.edge_metrics.items():
+            metrics.create_dataset(key, data=values, **kwargs)
+
+    @classmethod
+    def from_hdf5_group(cls, group, metrics=None):
+        """Load a connectome stored with :meth:`to_hdf5_group`.
+
+        Parameters
+        ----------
+        group : h5py.Group
+            HDF5 group in which the connectome is stored
+
+        metrics : list of string
+            Edge metrics to load (Default: all the metrics)
+
+        Returns
+        -------
+        connectome : Connectome
+            The loaded connectome
+        """
+        _check_h5py()
+        node_ids = group["nodes/ids"][()]
+        node_data = [{} for _ in node_ids]
+        for key, dataset in group["nodes/attributes"].items():
+            if h5py.check_string_dtype(dataset.dtype) is not None:
+                column = list(dataset.asstr()[()])
+            else:
+                column = dataset[()]
+                column = [tuple(row) for row in column] if column.ndim > 1 else column.tolist()
+            for d, value in zip(node_data, column):
+                d[key] = value
+
+        edges = group["edges"]
+        if metrics is None:
+            metrics = list(edges["metrics"].keys())
+        missing = [key for key in metrics if key not in edges["metrics"]]
+        if missing:
+            raise KeyError("Edge metric %s not found in %s" % (missing[0], group.name))
+        sources = edges["source_index"][()]
+        targets = edges["target_index"][()]
+        return cls(
+            nodes=node_ids,
+            sources=node_ids[sources],
+            targets=node_ids[targets],
+            edge_metrics={key: edges["metrics"][key][()] for key in metrics},
+            node_data=node_data,
+        )
+
+    def save(self, basepath, output_types=None, matrix_key="sc"):
+        """Save the connectome in TSV format and in the other requested formats.
+
+        Parameters
+        ----------
+        basepath : string
+            Output path without extension
+
+        output_types : ['tsv', 'gpickle', 'mat', 'graphml']
+            List of additional output formats. The TSV file is always saved
+            to be BIDS compliant
+
+        matrix_key : string
+            Name of the MATLAB structure storing the matrices (Default: "sc")
+        """
+        if output_types is None:
+            output_types = []
+
+        print("    - %s.tsv" % basepath)
+        self.write_tsv("%s.tsv" % basepath)
+
+        if "gpickle" in output_types:
+            print("    - %s.gpickle" % basepath)
+            self.write_gpickle("%s.gpickle" % basepath)
+
+        if "mat" in output_types:
+            print("    - %s.mat" % basepath)
+            self.write_mat("%s.mat" % basepath, matrix_key=matrix_key)
+
+        if "graphml" in output_types:
+            print("    - %s.graphml" % basepath)
+            self.write_graphml("%s.graphml" % basepath)
+
+
+def save_connectomes_hdf5(fname, connectomes, arrays=None, compression="gzip"):
+    """Save the connectomes of several scales in a single compressed HDF5 file.
+
+    Each scale is stored in its own group, with its node table, edge metrics
+    and optional additional arrays (such as fiber labels or ROI time-series),
+    each of them in a separate chunked and compressed dataset.
+
+    Parameters
+    ----------
+    fname : string
+        Output filename
+
+    connectomes : dict
+        Dictionary of scale name / :class:`Connectome` pairs
+
+    arrays : dict
+        Dictionary of scale name / dictionary of array name / array pairs
+        to store with the connectome of each scale
+
+    compression : string
+        Compression filter of the datasets (Default: "gzip")
+
+    See Also
+    --------
+    load_connectome_hdf5
+    """
+    _check_h5py()
+    if arrays is None:
+        arrays = {}
+    with h5py.File(fname, "w", track_order=True) as h5_file:
+        h5_file.attrs["format"] = HDF5_FORMAT
+        h5_file.attrs["format_version"] = HDF5_FORMAT_VERSION
+        for scale, connectome in connectomes.items():
+            group = h5_file.create_group(scale, track_order=True)
+            connectome.to_hdf5_group(group, compression=compression)
+            scale_arrays = group.create_group("arrays", track_order=True)
+            for name, array in arrays.get(scale, {}).items():
+                array = np.asarray(array)
+                kwargs = {"compression": compression, "shuffle": True} if array.size else {}
+                scale_arrays.create_dataset(name, data=array, **kwargs)
+
+
+def _get_scale_group(h5_file, scale):
+    """Return the group of a scale, or of the only scale of the file if ``scale`` is None."""
+    if scale is None:
+        scales = list(h5_file.keys())
+        if len(scales) != 1:
+            raise ValueError(
+                "The file contains %i scales (%s), please specify one"
+                % (len(scales), ", ".join(scales))
+            )
+        scale = scales[0]
+    if scale not in h5_file:
+        raise KeyError("Scale %s not found in %s" % (scale, h5_file.filename))
+    return h5_file[scale]
+
+
+def list_connectome_hdf5(fname):
+    """List the scales, edge metrics and arrays stored in a HDF5 connectome file.
+
+    Parameters
+    ----------
+    fname : string
+        HDF5 connectome file
+
+    Returns
+    -------
+    content : dict
+        Dictionary of scale name / dictionary with the list of ``metrics``
+        and the list of ``arrays`` of the scale
+    """
+    _check_h5py()
+    with h5py.File(fname, "r") as h5_file:
+        return {
+            scale: {
+                "metrics": list(group["edges/metrics"].keys()),
+                "arrays": list(group["arrays"].keys()) if "arrays" in group else [],
+            }
+            for scale, group in h5_file.items()
+        }
+
+
+def load_connectome_hdf5(fname, scale=None, metrics=None):
+    """Load the connectome of one scale from a HDF5 connectome file.
+
+    Only the datasets of the requested scale and metrics are read.
+
+    Parameters
+    ----------
+    fname : string
+        HDF5 connectome file
+
+    scale : string
+        Name of the scale to load. Can be None if the file contains a single scale
+
+    metrics : list of string
+        Edge metrics to load (Default: all the metrics)
+
+    Returns
+    -------
+    connectome : Connectome
+        The loaded connectome
+
+    Examples
+    --------
+    >>> from cmtklib.network import load_connectome_hdf5
+    >>> con = load_connectome_hdf5(
+    ...     'sub-01_atlas-L2018_conndata-network_connectivity.h5',
+    ...     scale='scale1',
+    ...     metrics=['number_of_fibers']
+    ... )  # doctest: +SKIP
+    >>> matrix = con.to_matrix('number_of_fibers')  # doctest: +SKIP
+    """
+    _check_h5py()
+    with h5py.File(fname, "r") as h5_file:
+        return Connectome.from_hdf5_group(_get_scale_group(h5_file, scale), metrics=metrics)
+
+
+def load_connectome_array_hdf5(fname, name, scale=None):
+    """Load an additional array of one scale from a HDF5 connectome file.
+
+    Parameters
+    ----------
+    fname : string
+        HDF5 connectome file
+
+    name : string
+        Name of the array (e.g. ``final_fiberlabels``)
+
+    scale : string
+        Name of the scale. Can be None if the file contains a single scale
+
+    Returns
+    -------
+    array : numpy.ndarray
+        The loaded array
+    """
+    _check_h5py()
+    with h5py.File(fname, "r") as h5_file:
+        group = _get_scale_group(h5_file, scale)
+        if "arrays" not in group or name not in group["arrays"]:
+            raise KeyError("Array %s not found in %s" % (name, group.name))
+        return group["arrays"][name][()]
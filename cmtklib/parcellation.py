@@ -14,7 +14,7 @@ from pathlib import Path
 import pkg_resources
 import subprocess
 import shutil
-import math
+from concurrent.futures import ThreadPoolExecutor
 
 import nibabel as ni
 import networkx as nx
@@ -48,6 +48,15 @@ class ComputeParcellationRoiVolumesInputSpec(BaseInterfaceInputSpec):
 
     roi_graphMLs (files): list
         GraphML description of ROI volumes (Lausanne2018)
+
+    compute_centroids : traits.Bool
+        Add the centroid of each ROI to the TSV files
+
+    compute_bounding_boxes : traits.Bool
+        Add the bounding box of each ROI to the TSV files
+
+    number_of_threads : traits.Int
+        Number of scales processed concurrently
     """
     roi_volumes = InputMultiPath(File(
         exists=True), desc='ROI volumes registered to diffusion space', mandatory=True)
@@ -62,6 +71,21 @@ class ComputeParcellationRoiVolumesInputSpec(BaseInterfaceInputSpec):
                                   desc='GraphML description of ROI volumes (Lausanne2018)',
                                   mandatory=True)
 
+    compute_centroids = traits.Bool(
+        False, usedefault=True,
+        desc="Add the centroid of each ROI (in voxel coordinates) to the TSV files"
+    )
+
+    compute_bounding_boxes = traits.Bool(
+        False, usedefault=True,
+        desc="Add the bounding box of each ROI (first and last voxel indices "
+             "along each axis) to the TSV files"
+    )
+
+    number_of_threads = traits.Int(
+        1, usedefault=True, desc="Number of scales processed concurrently"
+    )
+
 
 class ComputeParcellationRoiVolumesOutputSpec(TraitedSpec):
     """This is a class for the definition of outputs of the `ComputeParcellationRoiVolumes` Nipype interface.
@@ -109,6 +133,7 @@ class ComputeParcellationRoiVolumes(BaseInterface):
         else:
             resolutions = get_parcellation(self.inputs.parcellation_scheme)
 
+            scales = []
             for parkey, _ in list(resolutions.items()):
 
                 for roi in self.inputs.roi_volumes:
@@ -121,13 +146,29 @@ class ComputeParcellationRoiVolumes(BaseInterface):
                         roi_info_graphml = graphml
                         break
 
+                scales.append((roi_fname, roi_info_graphml, parkey))
+
+            n_threads = max(1, min(self.inputs.number_of_threads, len(scales)))
+            if n_threads > 1:
                 iflogger.info(
-                    "-------------------------------------------------------")
-                iflogger.info(
-                    "Processing {} parcellation - {}".format(self.inputs.parcellation_scheme, parkey))
-                iflogger.info(
-                    "-------------------------------------------------------")
-                self._compute_and_save_volumetry(roi_fname, roi_info_graphml, parkey)
+                    "Processing {} parcellation - {} scales with {} threads".format(
+                        self.inputs.parcellation_scheme, len(scales), n_threads))
+                with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                    futures = [
+                        executor.submit(self._compute_and_save_volumetry, *scale)
+                        for scale in scales
+                    ]
+                    for future in futures:
+                        future.result()
+            else:
+                for roi_fname, roi_info_graphml, parkey in scales:
+                    iflogger.info(
+                        "-------------------------------------------------------")
+                    iflogger.info(
+                        "Processing {} parcellation - {}".format(self.inputs.parcellation_scheme, parkey))
+                    iflogger.info(
+                        "-------------------------------------------------------")
+                    self._compute_and_save_volumetry(roi_fname, roi_info_graphml, parkey)
 
         iflogger.info('  [Done]')
 
@@ -136,7 +177,17 @@ class ComputeParcellationRoiVolumes(BaseInterface):
     def _compute_and_save_volumetry(self, roi_fname, roi_info_graphml, parkey):
         iflogger.info("  > Load {}...".format(roi_fname))
         roiImg = ni.load(roi_fname)
-        roiData = roiImg.get_fdata()
+        # Read the labels as integers instead of float64
+        roiData = np.asanyarray(roiImg.dataobj)
+        if not np.issubdtype(roiData.dtype, np.integer):
+            roiData = np.rint(roiData)
+        if roiData.size and roiData.min() < 0:
+            raise ValueError(
+                "Negative label {} in {}".format(int(roiData.min()), roi_fname)
+            )
+        # uint16 covers the labels of all the atlases, wider labels are kept as int64
+        label_dtype = np.uint16 if roiData.size == 0 or roiData.max() <= 65535 else np.int64
+        roiData = roiData.astype(label_dtype, copy=False)
 
         # Compute the volume of the voxel
         voxel_dimX, voxel_dimY, voxel_dimZ = roiImg.header.get_zooms()
@@ -152,9 +203,16 @@ class ComputeParcellationRoiVolumes(BaseInterface):
 
         # Format the TSV file according to BIDS Extension Proposal 11 (BEP011):
         # The structural preprocessing derivatives.
-        hdr_lines = [
-            '{:<4}, {:<55}, {:<10}, {:>10} \n'.format("index", "name", "type", "volume-mm3")
-        ]
+        hdr_columns = ["index", "name", "type", "volume-mm3"]
+        row_format = '{:<4}, {:<55}, {:<10}, {:>10}'
+        if self.inputs.compute_centroids:
+            hdr_columns += ["centroid-x", "centroid-y", "centroid-z"]
+            row_format += ', {:>10}' * 3
+        if self.inputs.compute_bounding_boxes:
+            hdr_columns += ["bbox-xmin", "bbox-ymin", "bbox-zmin", "bbox-xmax", "bbox-ymax", "bbox-zmax"]
+            row_format += ', {:>10}' * 6
+        row_format += ' \n'
+        hdr_lines = [row_format.format(*hdr_columns)]
 
         f_volumetry.writelines(hdr_lines)
         del hdr_lines
@@ -164,6 +222,20 @@ class ComputeParcellationRoiVolumes(BaseInterface):
         gp = nx.read_graphml(roi_info_graphml)
         n_nodes = len(gp)
 
+        if self.inputs.parcellation_scheme in ["Custom", "Lausanne2018"]:
+            label_key = "dn_multiscaleID"
+        else:
+            label_key = "dn_correspondence_id"
+
+        # Count the voxels (and locate the voxels) of all the parcels in one pass
+        n_labels = max([int(d[label_key]) for _, d in gp.nodes(data=True)] + [0]) + 1
+        if self.inputs.compute_bounding_boxes:
+            roi_voxel_counts, roi_centroids, roi_bboxes = compute_roi_statistics(
+                roiData, n_labels, bounding_boxes=True
+            )
+        else:
+            roi_voxel_counts, roi_centroids = compute_roi_statistics(roiData, n_labels)
+
         iflogger.info("  > Processing parcels...")
         # variables used by the percent counter
         pc = -1
@@ -178,10 +250,7 @@ class ComputeParcellationRoiVolumes(BaseInterface):
                 iflogger.info('%4.0f%%' % pc)
 
             # Get the label number
-            if self.inputs.parcellation_scheme in ["Custom", "Lausanne2018"]:
-                parcel_label = d["dn_multiscaleID"]
-            else:
-                parcel_label = d["dn_correspondence_id"]
+            parcel_label = d[label_key]
 
             # Get if the parcel is cortical or subcortical
             parcel_type = d["dn_region"]
@@ -190,11 +259,20 @@ class ComputeParcellationRoiVolumes(BaseInterface):
             parcel_name = d["dn_name"]
 
             # Compute the parcel/ROI volume
-            parcel_volumetry = np.sum(roiData == int(
-                    parcel_label)) * voxel_volume
-
-            f_volumetry.write(
-                    '{:<4}, {:<55}, {:<10}, {:>10} \n'.format(parcel_label, parcel_name, parcel_type, parcel_volumetry))
+            parcel_volumetry = roi_voxel_counts[int(parcel_label)] * voxel_volume
+
+            row = [parcel_label, parcel_name, parcel_type, parcel_volumetry]
+            if self.inputs.compute_centroids:
+                row += [
+                    'n/a' if np.isnan(x) else '{:.2f}'.format(x)
+                    for x in roi_centroids[int(parcel_label)]
+                ]
+            if self.inputs.compute_bounding_boxes:
+                row += [
+                    'n/a' if x < 0 else x
+                    for x in roi_bboxes[int(parcel_label)]
+                ]
+            f_volumetry.write(row_format.format(*row))
 
         f_volumetry.close()
 
@@ -706,8 +784,8 @@ class CombineParcellations(BaseInterface):
             print(proc_stdout)
 
         tmp = ni.load(third_vent_dil)
-        indrhypothal = np.where((tmp == 1) & (img_data == right_ventral))
-        indlhypothal = np.where((tmp == 1) & (img_data == left_ventral))
+        indrhypothal = np.flatnonzero((tmp == 1) & (img_data == right_ventral))
+        indlhypothal = np.flatnonzero((tmp == 1) & (img_data == left_ventral))
         del tmp
 
         f_color_lut = None
@@ -715,57 +793,15 @@ class CombineParcellations(BaseInterface):
 
         print("create color look up table : ", self.inputs.create_colorLUT)
 
-        for _, roi in enumerate(self.inputs.input_rois):
-            # colorLUT creation if enabled
-            if self.inputs.create_colorLUT:
-                outprefix_name = Path(roi).name.split(".")[0]
-                color_lut_file = op.abspath(
-                    '{}_FreeSurferColorLUT.txt'.format(outprefix_name))
-                print("Create colorLUT file as %s" % color_lut_file)
-                f_color_lut = open(color_lut_file, 'w+')
-                time_now = strftime("%a, %d %b %Y %H:%M:%S", localtime())
-                hdr_lines = ['#$Id: {}_FreeSurferColorLUT.txt {} \n \n'.format(outprefix_name, time_now),
-                             '{:<4} {:<55} {:>3} {:>3} {:>3} {} \n \n'.format("#No.", "Label Name:", "R", "G", "B",
-                                                                              "A")]
-                f_color_lut.writelines(hdr_lines)
-                del hdr_lines
-
-            # Create GraphML if enabled
-            if self.inputs.create_graphml:
-                outprefix_name = Path(roi).name.split(".")[0]
-                graphml_file = op.abspath('{}.graphml'.format(outprefix_name))
-                print("Create graphml_file as %s" % graphml_file)
-                f_graphml = open(graphml_file, 'w+')
-
-                hdr_lines = ['{} \n'.format('<?xml version="1.0" encoding="utf-8"?>'),
-                             '{} \n'.format(
-                                 '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
-                                 'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_region" attr.type="string" for="node" id="d0" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_fsname" attr.type="string" for="node" id="d1" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_hemisphere" attr.type="string" for="node" id="d2" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_multiscaleID" attr.type="int" for="node" id="d3" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_name" attr.type="string" for="node" id="d4" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_fsID" attr.type="int" for="node" id="d5" />'),
-                             '{} \n'.format('  <graph edgedefault="undirected" id="">'), ]
-                f_graphml.writelines(hdr_lines)
-                del hdr_lines
-
-            # Reading Cortical Parcellation
-            img_v = ni.load(roi)
-            img_data = img_v.get_fdata()
-
-            # Replacing the brain stem (Stem is replaced by its own parcellation.
-            # Mismatch between both global volumes, mainly due to partial volume
-            # effect in the global stem parcellation)
-            indrep = np.where(img_data == 16)
-            img_data[indrep] = 0
+        # Voxels and labels of the extra segmentations relabeled in each scale
+        if thalamus_nuclei_defined:
+            thal_voxels, thal_labels = _get_label_voxels(img_data_thal)
+        if rh_subfield_defined:
+            subrh_voxels, subrh_labels = _get_label_voxels(img_data_subrh)
+        if lh_subfield_defined:
+            sublh_voxels, sublh_labels = _get_label_voxels(img_data_sublh)
+        if brainstem_defined:
+            stem_voxels, stem_labels = _get_label_voxels(img_data_stem)
 
         for _, roi in sorted(enumerate(self.inputs.input_rois)):
             # colorLUT creation if enabled
@@ -814,20 +850,20 @@ class CombineParcellations(BaseInterface):
 
             # Reading Cortical Parcellation
             img_v = ni.load(roi)
-            img_data = img_v.get_fdata()
+            roi_voxels, roi_labels = _get_label_voxels(img_v.dataobj)
 
             # Replacing the brain stem (Stem is replaced by its own parcellation.
             # Mismatch between both global volumes, mainly due to partial volume
             # effect in the global stem parcellation)
-            indrep = np.where(img_data == 16)
-            img_data[indrep] = 0
+            indrep = roi_voxels[roi_labels == 16]
 
             # Processing Right Hemisphere
 
             # Relabelling Right hemisphere
-            img_data_out = np.zeros(img_data.shape, dtype=np.int16)
-            ind = np.where((img_data >= 2000) & (img_data < 3000))
-            img_data_out[ind] = (img_data[ind] - 2000)
+            img_data_out = np.zeros(img_v.shape, dtype=np.int16)
+            # Flat view of the output, in which the labels are overlaid in priority order
+            img_data_flat = img_data_out.reshape(-1)
+            _overlay_labels(img_data_flat, roi_voxels, roi_labels, np.arange(2000, 3000), np.arange(0, 1000))
             nlabel = img_data_out.max()
 
             # ColorLUT (cortical)
@@ -920,9 +956,8 @@ class CombineParcellations(BaseInterface):
                                       '{} \n'.format('    </node>')]
                         f_graphml.writelines(node_lines)
 
-                    ind = np.where(img_data_thal == lab)
-                    img_data_out[ind] = new_labels[i]
                     i += 1
+                _overlay_labels(img_data_flat, thal_voxels, thal_labels, right_thalNuclei, new_labels)
                 nlabel = img_data_out.max()
 
                 if self.inputs.create_colorLUT:
@@ -966,9 +1001,8 @@ class CombineParcellations(BaseInterface):
                                   '{} \n'.format('    </node>')]
                     f_graphml.writelines(node_lines)
 
-                ind = np.where(img_data == lab)
-                img_data_out[ind] = new_labels[i]
                 i += 1
+            _overlay_labels(img_data_flat, roi_voxels, roi_labels, right_subc_labels, new_labels)
             nlabel = img_data_out.max()
 
             if self.inputs.create_colorLUT:
@@ -1014,9 +1048,8 @@ class CombineParcellations(BaseInterface):
                                       '{} \n'.format('    </node>')]
                         f_graphml.writelines(node_lines)
 
-                    ind = np.where(img_data_subrh == lab)
-                    img_data_out[ind] = new_labels[i]
                     i += 1
+                _overlay_labels(img_data_flat, subrh_voxels, subrh_labels, hippo_subf, new_labels)
                 nlabel = img_data_out.max()
 
                 if self.inputs.create_colorLUT:
@@ -1028,8 +1061,7 @@ class CombineParcellations(BaseInterface):
                 if self.inputs.verbose_level == 2:
                     iflogger.info(
                         "  > Update right ventral DC label ({} -> {})".format(right_ventral, new_labels[0]))
-                ind = np.where(img_data == right_ventral)
-                img_data_out[ind] = new_labels[0]
+                _overlay_labels(img_data_flat, roi_voxels, roi_labels, [right_ventral], new_labels)
                 nlabel = img_data_out.max()
 
                 # ColorLUT (right ventral DC)
@@ -1067,7 +1099,7 @@ class CombineParcellations(BaseInterface):
                 if self.inputs.verbose_level == 2:
                     iflogger.info(
                         "  > Update right hypothalamus label ({} -> {})".format(right_ventral, new_labels[0]))
-                img_data_out[indrhypothal] = new_labels[0]
+                img_data_flat[indrhypothal] = new_labels[0]
                 nlabel = img_data_out.max()
 
                 # ColorLUT (right hypothalamus)
@@ -1100,8 +1132,8 @@ class CombineParcellations(BaseInterface):
 
             # Processing Left Hemisphere
             # Relabelling Left hemisphere
-            ind = np.where((img_data > 1000) & (img_data < 2000))
-            img_data_out[ind] = (img_data[ind] - 1000 + nlabel)
+            _overlay_labels(img_data_flat, roi_voxels, roi_labels,
+                            np.arange(1001, 2000), np.arange(1, 1000) + nlabel)
             old_nlabel = nlabel
             nlabel = img_data_out.max()
 
@@ -1194,9 +1226,8 @@ class CombineParcellations(BaseInterface):
                                       '{} \n'.format('    </node>')]
                         f_graphml.writelines(node_lines)
 
-                    ind = np.where(img_data_thal == lab)
-                    img_data_out[ind] = new_labels[i]
                     i += 1
+                _overlay_labels(img_data_flat, thal_voxels, thal_labels, left_thalNuclei, new_labels)
                 nlabel = img_data_out.max()
 
                 if self.inputs.create_colorLUT:
@@ -1239,9 +1270,8 @@ class CombineParcellations(BaseInterface):
                                   '{} \n'.format('    </node>')]
                     f_graphml.writelines(node_lines)
 
-                ind = np.where(img_data == lab)
-                img_data_out[ind] = new_labels[i]
                 i += 1
+            _overlay_labels(img_data_flat, roi_voxels, roi_labels, left_subc_labels, new_labels)
             nlabel = img_data_out.max()
 
             if self.inputs.create_colorLUT:
@@ -1286,9 +1316,8 @@ class CombineParcellations(BaseInterface):
                                       '{} \n'.format('    </node>')]
                         f_graphml.writelines(node_lines)
 
-                    ind = np.where(img_data_sublh == lab)
-                    img_data_out[ind] = new_labels[i]
                     i += 1
+                _overlay_labels(img_data_flat, sublh_voxels, sublh_labels, hippo_subf, new_labels)
                 nlabel = img_data_out.max()
                 # newIds_LH_subFields = new_labels
 
@@ -1301,8 +1330,7 @@ class CombineParcellations(BaseInterface):
                 if self.inputs.verbose_level == 2:
                     iflogger.info(
                         "  > Update left ventral DC label ({} -> {})".format(left_ventral, new_labels[0]))
-                ind = np.where(img_data == left_ventral)
-                img_data_out[ind] = new_labels[0]
+                _overlay_labels(img_data_flat, roi_voxels, roi_labels, [left_ventral], new_labels)
                 nlabel = img_data_out.max()
                 # newIds_LH_ventralDC = new_labels
 
@@ -1340,7 +1368,7 @@ class CombineParcellations(BaseInterface):
                 if self.inputs.verbose_level == 2:
                     iflogger.info(
                         "  > Update left hypothalamus label ({} -> {})".format(-1, new_labels[0]))
-                img_data_out[indlhypothal] = new_labels[0]
+                img_data_flat[indlhypothal] = new_labels[0]
                 nlabel = img_data_out.max()
 
                 # ColorLUT (right hypothalamus)
@@ -1409,9 +1437,8 @@ class CombineParcellations(BaseInterface):
                                       '{} \n'.format('    </node>')]
                         f_graphml.writelines(node_lines)
 
-                    ind = np.where(img_data_stem == lab)
-                    img_data_out[ind] = new_labels[i]
                     i += 1
+                _overlay_labels(img_data_flat, stem_voxels, stem_labels, brainstem, new_labels)
                 # nlabel = img_data_out.max()
 
                 if self.inputs.create_colorLUT:
@@ -1421,7 +1448,7 @@ class CombineParcellations(BaseInterface):
                     f_color_lut.write("# Brain Stem \n")
 
                 new_labels = np.arange(nlabel + 1, nlabel + 2)
-                img_data_out[indrep] = new_labels[0]
+                img_data_flat[indrep] = new_labels[0]
 
                 if self.inputs.verbose_level == 2:
                     iflogger.info(
@@ -1516,18 +1543,10 @@ class CombineParcellations(BaseInterface):
             # Thalamus (aparc+aseg labels: 10 and 49)
             if thalamus_nuclei_defined:
 
-                ind = np.where(img_data_aparcaseg == 10)
-                mask_aparc_lh = np.zeros(img_data_aparcaseg.shape)
-                mask_aparc_lh[ind] = 1
+                mask_aparc_lh = (img_data_aparcaseg == 10).astype(np.float64)
+                mask_aparc_rh = (img_data_aparcaseg == 49).astype(np.float64)
 
-                ind = np.where(img_data_aparcaseg == 49)
-                mask_aparc_rh = np.zeros(img_data_aparcaseg.shape)
-                mask_aparc_rh[ind] = 1
-
-                mask_thal_lh = np.zeros(img_data_aparcaseg.shape)
-                for lab in left_thalNuclei:
-                    ind = np.where(img_data_thal == lab)
-                    mask_thal_lh[ind] = 1
+                mask_thal_lh = np.isin(img_data_thal, left_thalNuclei).astype(np.float64)
 
                 # Identify voxels not included by thalamic Nuclei - should set to 2 (Gm) or 0
                 tmp = mask_aparc_lh - mask_thal_lh
@@ -1545,10 +1564,7 @@ class CombineParcellations(BaseInterface):
                     tmp, affine=img_aparcaseg.affine, header=img_aparcaseg.header)
                 ni.save(img_tmp, out_tmp)
 
-                mask_thal_rh = np.zeros(img_data_aparcaseg.shape)
-                for lab in right_thalNuclei:
-                    ind = np.where(img_data_thal == lab)
-                    mask_thal_rh[ind] = 1
+                mask_thal_rh = np.isin(img_data_thal, right_thalNuclei).astype(np.float64)
 
                 # Identify voxels not included by thalamic Nuclei - should set to 41 (Gm) or 0
                 tmp = mask_aparc_rh - mask_thal_rh
@@ -2009,6 +2025,19 @@ class ParcellateInputSpec(BaseInterfaceInputSpec):
 
     erode_masks = traits.Bool(False, desc="If `True` erode the masks")
 
+    dilation_distance = traits.Int(
+        12, usedefault=True,
+        desc="Maximal distance in voxels along each axis between a cortical voxel "
+             "and the labeled voxels whose label it can take when the 'Lausanne2018' "
+             "cortical regions are dilated"
+    )
+
+    number_of_threads = traits.Int(
+        1, usedefault=True,
+        desc="Maximal number of FreeSurfer commands run concurrently "
+             "to create the 'Lausanne2018' parcellation"
+    )
+
 
 class ParcellateOutputSpec(TraitedSpec):
     white_matter_mask_file = File(desc='White matter (WM) mask file')
@@ -2077,7 +2106,9 @@ class Parcellate(BaseInterface):
             print("Parcellation scheme : Lausanne2018")
             create_T1_and_Brain(self.inputs.subject_id, self.inputs.subjects_dir)
             # create_annot_label(self.inputs.subject_id, self.inputs.subjects_dir)
-            create_roi(self.inputs.subject_id, self.inputs.subjects_dir)
+            create_roi(self.inputs.subject_id, self.inputs.subjects_dir,
+                       dilation_distance=self.inputs.dilation_distance,
+                       number_of_threads=self.inputs.number_of_threads)
             create_wm_mask(self.inputs.subject_id, self.inputs.subjects_dir)
             if self.inputs.erode_masks:
                 erode_mask(fsdir, op.join(fsdir, 'mri', 'fsmask_1mm.nii.gz'))
@@ -2269,6 +2300,262 @@ def extract(Z, shape, position, fill):
     return R
 
 
+def _get_neighbourhood_label(labels, position, dist):
+    """Return the label of the closest labeled voxels in the neighbourhood of a voxel.
+
+    The neighbourhood has the shape of ``dist``, the array of the distances
+    to its center. If several labels are equally close, the most frequent one
+    is returned.
+    """
+    local = extract(labels, dist.shape, position=position, fill=0)
+    mask = local.copy()
+    mask[np.nonzero(local > 0)] = 1
+    thisdist = np.multiply(dist, mask)
+    thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
+    value = np.int_(local[np.nonzero(thisdist == np.amin(thisdist))])
+    if value.size > 1:
+        counts = np.bincount(value)
+        value = np.argmax(counts)
+    return value
+
+
+def find_nearest_labels(labels, coords, half_width=12):
+    """Find the label of the closest labeled voxels of a set of voxels.
+
+    For each voxel, the labeled voxels are searched in the cubic neighbourhood
+    of ``2 * half_width + 1`` voxels of side centered on it, and the label of the
+    closest ones is returned. If several labels are equally close, the most
+    frequent one (and then the smallest one) is returned. This reproduces the
+    neighbourhood search of :func:`extract` used by :func:`create_roi` (including
+    its returning 0 when all the labeled voxels of the neighbourhood are at the
+    same distance) without a loop over the voxels:
+
+    * the distance of each voxel to its closest labeled voxel is computed with
+      a single Euclidean distance transform of the volume,
+
+    * the labels of all the voxels at exactly this distance are gathered for all
+      the voxels at once, by groups of voxels sharing the same distance.
+
+    The distance to the closest labeled voxels of the neighbourhood is searched
+    shell by shell for the voxels which are labeled themselves (closest other
+    labeled voxels) and for the voxels whose closest labeled voxel is farther than
+    ``half_width`` voxels (it may then be outside the neighbourhood while others are
+    in its corners).
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        3D parcellation volume
+
+    coords : tuple of numpy.ndarray
+        Coordinates of the voxels, as returned by ``numpy.where``
+
+    half_width : int
+        Half width of the cubic neighbourhood in voxels (Default: 12)
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Label assigned to each voxel (0 if there is no labeled voxel in its neighbourhood)
+    """
+    labels = np.asarray(labels)
+    coords = np.stack([np.asarray(c, dtype=np.int64) for c in coords], axis=1)
+    values = np.zeros(coords.shape[0], dtype=np.int64)
+    if coords.shape[0] == 0:
+        return values
+    half_width = int(half_width)
+    cube_size = (2 * half_width + 1) ** 3
+
+    # Crop the volume to the neighbourhoods of the voxels
+    start = np.maximum(coords.min(axis=0) - half_width, 0)
+    stop = np.minimum(coords.max(axis=0) + half_width + 1, labels.shape)
+    crop = np.asarray(
+        labels[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+    ).astype(np.int64)
+    local_coords = coords - start
+    labeled = crop > 0
+    if not np.any(labeled):
+        return values
+
+    # Squared distance to the closest labeled voxel and number of labeled voxels
+    # in the neighbourhood of each voxel
+    distances = ndimage.distance_transform_edt(~labeled)
+    sq_dist = np.rint(distances[tuple(local_coords.T)] ** 2).astype(np.int64)
+    n_labeled = np.rint(
+        ndimage.uniform_filter(labeled.astype(np.float64), size=2 * half_width + 1, mode="constant")[
+            tuple(local_coords.T)
+        ]
+        * cube_size
+    ).astype(np.int64)
+
+    # Offsets of the neighbourhood grouped by squared distance to its center
+    grid = np.arange(-half_width, half_width + 1)
+    offsets = np.stack(np.meshgrid(grid, grid, grid, indexing="ij"), axis=-1).reshape(-1, 3)
+    offsets_sq_dist = (offsets ** 2).sum(axis=1)
+
+    def gather(rows, d):
+        """Return the labels of the voxels at squared distance d of the voxels (0 outside)."""
+        positions = local_coords[rows, None, :] + offsets[offsets_sq_dist == d][None, :, :]
+        inside = np.all((positions >= 0) & (positions < crop.shape), axis=2)
+        positions = np.where(inside[:, :, None], positions, 0)
+        return np.where(inside, crop[tuple(np.moveaxis(positions, 2, 0))], 0)
+
+    # The distance to the closest labeled voxel of the neighbourhood is searched
+    # shell by shell for the labeled voxels (closest other labeled voxel) and
+    # for the voxels whose closest labeled voxel is beyond the inscribed sphere
+    self_labeled = sq_dist == 0
+    lower_bound = np.maximum(sq_dist, 1)
+    pending = np.flatnonzero(self_labeled | (sq_dist > half_width ** 2))
+    sq_dist[pending] = 0
+    for d in np.unique(offsets_sq_dist[offsets_sq_dist > 0]):
+        if pending.size == 0:
+            break
+        active = pending[lower_bound[pending] <= d]
+        if active.size == 0:
+            continue
+        found = np.any(gather(active, d) > 0, axis=1)
+        sq_dist[active[found]] = d
+        pending = pending[sq_dist[pending] == 0]
+    n_other = n_labeled - self_labeled
+
+    # Voxels without (other) labeled voxel in their neighbourhood keep 0
+    resolved = sq_dist > 0
+    fallback = []
+    for d in np.unique(sq_dist[resolved]):
+        rows = np.flatnonzero(resolved & (sq_dist == d))
+        candidates = gather(rows, d)
+
+        # Voxels whose closest labeled voxels all have the same label
+        first = candidates.max(axis=1)
+        unique = np.all((candidates == 0) | (candidates == first[:, None]), axis=1)
+        n_closest = np.count_nonzero(candidates, axis=1)
+        equidistant = n_other[rows] == n_closest
+        unique_rows = unique & ~equidistant
+        values[rows[unique_rows]] = first[unique_rows]
+
+        # Ties between labels, or all the labeled voxels of the neighbourhood at
+        # the same distance (the unlabeled voxels are then counted as label 0)
+        for k in np.flatnonzero(~unique_rows):
+            if equidistant[k] and self_labeled[rows[k]]:
+                fallback.append(rows[k])
+                continue
+            counts = np.bincount(candidates[k][candidates[k] > 0])
+            if equidistant[k]:
+                counts[0] = cube_size - n_labeled[rows[k]]
+            values[rows[k]] = np.argmax(counts)
+
+    # Labeled voxels whose closest other labeled voxels are all the labeled voxels of
+    # the neighbourhood (their own label is then counted with the unlabeled voxels)
+    if fallback:
+        dist = np.sqrt(
+            grid[:, None, None] ** 2 + grid[None, :, None] ** 2 + grid[None, None, :] ** 2
+        ).astype("float32")
+        for k in fallback:
+            values[k] = _get_neighbourhood_label(labels, tuple(coords[k]), dist)
+
+    return values
+
+
+def compute_roi_statistics(roi_data, n_labels=None, bounding_boxes=False):
+    """Compute the volume and the mean voxel position of all the ROIs in one pass.
+
+    Parameters
+    ----------
+    roi_data : numpy.array
+        3D parcellation volume
+
+    n_labels : int
+        Minimal length of the output arrays (labels ``0`` to ``n_labels - 1``).
+        If None, the maximal label of ``roi_data`` plus one is used.
+
+    bounding_boxes : bool
+        If True, also return the bounding box of each label (Default: False)
+
+    Returns
+    -------
+    volumes : numpy.array
+        Number of voxels of each label, indexed by label
+
+    positions : numpy.array
+        Array of size [#labels, 3] with the mean position of each label
+        in voxel coordinates (NaN for the background and labels without voxels)
+
+    bboxes : numpy.array
+        Array of size [#labels, 6] with the first (x, y, z) and last (x, y, z)
+        voxel indices of each label (-1 for the background and labels without voxels).
+        Only returned if ``bounding_boxes`` is True.
+    """
+    labels = np.asarray(roi_data).astype(np.int64)
+    if n_labels is None:
+        n_labels = 0
+    coords = np.nonzero(labels)
+    roi_labels = labels[coords]
+    volumes = np.bincount(labels.ravel(), minlength=n_labels)
+
+    positions = np.empty((volumes.size, 3))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for axis in range(3):
+            positions[:, axis] = np.bincount(
+                roi_labels, weights=coords[axis], minlength=volumes.size
+            ) / volumes
+    # Background position is not computed
+    positions[0, :] = np.nan
+
+    if bounding_boxes:
+        bboxes = np.full((volumes.size, 6), -1, dtype=np.int64)
+        for label, slices in enumerate(ndimage.find_objects(labels), start=1):
+            if slices is not None:
+                bboxes[label, :3] = [s.start for s in slices]
+                bboxes[label, 3:] = [s.stop - 1 for s in slices]
+        return volumes, positions, bboxes
+
+    return volumes, positions
+
+
+def _get_label_voxels(label_data):
+    """Return the flat indices (C order) and the integer labels of the labeled voxels of a label image.
+
+    Voxels with a non-integer value are left out, as they cannot match any label.
+    """
+    label_data = np.asarray(label_data).reshape(-1)
+    voxels = np.flatnonzero(label_data > 0)
+    values = label_data[voxels]
+    labels = values.astype(np.int64)
+    integer = labels == values
+    return voxels[integer], labels[integer]
+
+
+def _overlay_labels(out, voxels, labels, old_labels, new_labels):
+    """Write ``new_labels[k]`` in the voxels of ``out`` labeled ``old_labels[k]`` in a label image.
+
+    The label image is remapped with a lookup table in a single gather
+    over its labeled voxels, as returned by :func:`_get_label_voxels`.
+
+    Parameters
+    ----------
+    out : numpy.ndarray
+        Flat (C order) output label volume, updated in place
+
+    voxels : numpy.ndarray
+        Flat indices of the labeled voxels of the label image
+
+    labels : numpy.ndarray
+        Integer labels of these voxels
+
+    old_labels : array_like
+        Labels of the label image to write in the output
+
+    new_labels : array_like
+        Labels written in the output for each label of ``old_labels``
+    """
+    old_labels = np.asarray(old_labels, dtype=np.int64)
+    lut = np.full(max(labels.max(initial=0), old_labels.max(initial=0)) + 1, -1, dtype=np.int64)
+    lut[old_labels] = np.asarray(new_labels)[:old_labels.size]
+    values = lut[labels]
+    selected = values >= 0
+    out[voxels[selected]] = values[selected]
+
+
 def create_T1_and_Brain(subject_id, subjects_dir):
     """Generates T1, T1 masked and aseg+aparc Freesurfer images in NIFTI format.
 
@@ -2314,7 +2601,21 @@ def create_T1_and_Brain(subject_id, subjects_dir):
     print("[DONE]")
 
 
-def create_roi(subject_id, subjects_dir, v=True):
+def _call_command(cmd, v, fnull):
+    """Run a shell command, showing its outputs only in the very verbose mode (``v == 2``)."""
+    if v == 2:
+        return subprocess.call(cmd, shell=True)
+    return subprocess.call(cmd, shell=True, stdout=fnull, stderr=subprocess.STDOUT)
+
+
+def _call_commands_after(futures, cmd, v, fnull):
+    """Run a shell command once the commands of ``futures`` have completed."""
+    for future in futures:
+        future.result()
+    return _call_command(cmd, v, fnull)
+
+
+def create_roi(subject_id, subjects_dir, v=True, dilation_distance=12, number_of_threads=1):
     """Iteratively creates the ROI_%s.nii.gz files using the given Lausanne2018 parcellation information from networks.
 
     Parameters
@@ -2328,6 +2629,17 @@ def create_roi(subject_id, subjects_dir, v=True):
 
     v : Boolean
         Verbose mode
+
+    dilation_distance : int
+        Maximal distance in voxels along each axis between a cortical voxel
+        and the labeled voxels whose label it can take when the cortical
+        regions are dilated (Default: 12, i.e. a 25x25x25 neighbourhood)
+
+    number_of_threads : int
+        Maximal number of FreeSurfer commands run concurrently. If larger than 1,
+        the annotations of all the scales are resampled and converted to volumes
+        in parallel, and each scale is relabeled as soon as its volume is ready
+        (Default: 1)
     """
 
     freesurfer_subj = os.path.abspath(subjects_dir)
@@ -2372,29 +2684,12 @@ def create_roi(subject_id, subjects_dir, v=True):
     asegd = aseg.get_fdata()  # numpy.ndarray
 
     # identify cortical voxels, right (3) and left (42) hemispheres
-    idxr = np.where(asegd == 3)
-    idxl = np.where(asegd == 42)
-    xx = np.concatenate((idxr[0], idxl[0]))
-    yy = np.concatenate((idxr[1], idxl[1]))
-    zz = np.concatenate((idxr[2], idxl[2]))
-
-    # initialize variables necessary for cortical ROIs dilation
-    # dimensions of the neighbourhood for rois labels assignment (choose odd dimensions!)
-    shape = (25, 25, 25)
-    center = np.array(shape) // 2
-    # dist: distances from the center of the neighbourhood
-    dist = np.zeros(shape, dtype='float32')
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            for z in range(shape[2]):
-                distxyz = center - [x, y, z]
-                dist[x, y, z] = math.sqrt(
-                    np.sum(np.multiply(distxyz, distxyz)))
-
-        # Check existence of tmp folder in input subject folder
-        this_dir = os.path.join(subject_dir, 'tmp')
-        if not (os.path.isdir(this_dir)):
-            os.makedirs(this_dir)
+    cortex = (asegd == 3) | (asegd == 42)
+
+    # Check existence of tmp folder in input subject folder
+    this_dir = os.path.join(subject_dir, 'tmp')
+    if not (os.path.isdir(this_dir)):
+        os.makedirs(this_dir)
 
     # Loop over parcellation scales
     if v:  # pragma: no cover
@@ -2417,159 +2712,153 @@ def create_roi(subject_id, subjects_dir, v=True):
 
     FNULL = open(os.devnull, 'w')
 
-    for i in reversed(list(range(0, nscales))):
-
-        if v:  # pragma: no cover
-            print(' ... working on multiscale parcellation, SCALE {}'.format(i + 1))
-
-        # 1. Resample fsaverage CorticalSurface onto SUBJECT_ID CorticalSurface and map annotation for current scale
-        # Left hemisphere
-        if v:  # pragma: no cover
-            print(
-                '     > resample fsaverage CorticalSurface to individual CorticalSurface')
-        mri_cmd = fs_string + '; mri_surf2surf --srcsubject fsaverage --trgsubject %s --hemi lh --sval-annot %s --tval %s' % (
-            subject_id,
-            pkg_resources.resource_filename('cmtklib',
-                                            op.join('data', 'parcellation', 'lausanne2018', lh_annot_files[i])),
-            os.path.join(subject_dir, 'label', lh_annot_files[i])
-        )
-        if v == 2:
-            subprocess.call(mri_cmd, shell=True)
-        else:
-            subprocess.call(mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-
-        # Right hemisphere
-        mri_cmd = fs_string + '; mri_surf2surf --srcsubject fsaverage --trgsubject %s --hemi rh --sval-annot %s --tval %s' % (
-            subject_id,
-            pkg_resources.resource_filename('cmtklib',
-                                            op.join('data', 'parcellation', 'lausanne2018', rh_annot_files[i])),
-            os.path.join(subject_dir, 'label', rh_annot_files[i])
-        )
-        if v == 2:
-            subprocess.call(mri_cmd, shell=True)
-        else:
-            subprocess.call(mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-
-        # 2. Generate Nifti volume from annotation
-        #    Note: change here --wmparc-dmax (FS default 5mm) to dilate cortical regions toward the WM
-        if v:  # pragma: no cover
-            print('     > generate Nifti volume from annotation')
-        mri_cmd = fs_string + '; mri_aparc2aseg --s %s --annot %s --wmparc-dmax 0 --labelwm --hypo-as-wm --new-ribbon --o %s' % (
-            subject_id,
-            annot[i],
-            os.path.join(subject_dir, 'tmp', rois_output[i])
+    # FreeSurfer commands of each scale
+    # 1. Resample fsaverage CorticalSurface onto SUBJECT_ID CorticalSurface and map annotation for current scale
+    # 2. Generate Nifti volume from annotation
+    #    Note: change here --wmparc-dmax (FS default 5mm) to dilate cortical regions toward the WM
+    surf2surf_cmds = []
+    aparc2aseg_cmds = []
+    for i in range(nscales):
+        surf2surf_cmds.append([
+            fs_string + '; mri_surf2surf --srcsubject fsaverage --trgsubject %s --hemi %s --sval-annot %s --tval %s' % (
+                subject_id,
+                hemi,
+                pkg_resources.resource_filename('cmtklib',
+                                                op.join('data', 'parcellation', 'lausanne2018', annot_file)),
+                os.path.join(subject_dir, 'label', annot_file)
+            )
+            for hemi, annot_file in [('lh', lh_annot_files[i]), ('rh', rh_annot_files[i])]
+        ])
+        aparc2aseg_cmds.append(
+            fs_string + '; mri_aparc2aseg --s %s --annot %s --wmparc-dmax 0 --labelwm --hypo-as-wm --new-ribbon --o %s' % (
+                subject_id,
+                annot[i],
+                os.path.join(subject_dir, 'tmp', rois_output[i])
+            )
         )
-        if v == 2:
-            subprocess.call(mri_cmd, shell=True)
-        else:
-            subprocess.call(mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
 
-        # 3. Update numerical IDs of cortical and subcortical regions
-        # Load Nifti volume
-        if v:  # pragma: no cover
-            print('     > relabel cortical and subcortical regions'
-                  ' for consistency between resolutions')
-        this_nifti = ni.load(os.path.join(subject_dir, 'tmp', rois_output[i]))
-        vol = this_nifti.get_fdata()  # numpy.ndarray
-        hdr = this_nifti.header
-        # Initialize output
-        hdr2 = hdr.copy()
-        hdr2.set_data_dtype(np.uint16)
-
-        newrois = vol.copy()
-        # store scale5 volume for correction on multi-resolution consistency
-        if i == (nscales - 1):
-            print("     ... storing ROIs volume maximal resolution")
-            roisMax = vol.copy()
-            idxMax = np.where(roisMax > 0)
-            xxMax = idxMax[0]
-            yyMax = idxMax[1]
-            zzMax = idxMax[2]
-        # correct cortical surfaces using as reference the roisMax volume (for consistency between resolutions)
-        else:
-            print("     > adapt cortical surfaces")
-
-            idxRois = np.where(vol > 0)
-            xxRois = idxRois[0]
-            yyRois = idxRois[1]
-            zzRois = idxRois[2]
-            # correct voxels labeled in current resolution, but not labeled in highest resolution
-            for j in range(xxRois.size):
-                if roisMax[xxRois[j], yyRois[j], zzRois[j]] == 0:
-                    newrois[xxRois[j], yyRois[j], zzRois[j]] = 0
-            # correct voxels not labeled in current resolution, but labeled in highest resolution
-            for j in range(xxMax.size):
-                if newrois[xxMax[j], yyMax[j], zzMax[j]] == 0:
-                    local = extract(vol, shape, position=(
-                        xxMax[j], yyMax[j], zzMax[j]), fill=0)
-                    mask = local.copy()
-                    mask[np.nonzero(local > 0)] = 1
-                    thisdist = np.multiply(dist, mask)
-                    thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                    value = np.int_(
-                        local[np.nonzero(thisdist == np.amin(thisdist))])
-                    if value.size > 1:
-                        counts = np.bincount(value)
-                        value = np.argmax(counts)
-                    newrois[xxMax[j], yyMax[j], zzMax[j]] = value
+    # Scales are processed from the highest resolution, used as reference for the others
+    scales = list(reversed(list(range(0, nscales))))
 
-        if v:  # pragma: no cover
-            print('     ... save output volumes')
-        this_out = os.path.join(subject_dir, 'mri', rois_output[i])
-        img = ni.Nifti1Image(newrois, this_nifti.affine, header=hdr2)
-        ni.save(img, this_out)
-        del img
-
-        # 4. Dilate cortical regions
-        if v:  # pragma: no cover
-            print("     > dilating cortical regions")
-        # loop throughout all the voxels belonging to the aseg GM volume
-        for j in range(xx.size):
-            if newrois[xx[j], yy[j], zz[j]] == 0:
-                local = extract(vol, shape, position=(
-                    xx[j], yy[j], zz[j]), fill=0)
-                mask = local.copy()
-                mask[np.nonzero(local > 0)] = 1
-                thisdist = np.multiply(dist, mask)
-                thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                value = np.int_(
-                    local[np.nonzero(thisdist == np.amin(thisdist))])
-                if value.size > 1:
-                    counts = np.bincount(value)
-                    value = np.argmax(counts)
-                newrois[xx[j], yy[j], zz[j]] = value
-
-        # 5. Save Nifti and mgz volumes
-        if v:  # pragma: no cover
-            print('     ... save output volumes ')
-        this_out = os.path.join(subject_dir, 'mri', roivs_output[i])
-        img = ni.Nifti1Image(newrois, this_nifti.affine, header=hdr2)
-        ni.save(img, this_out)
-        del img
+    executor = None
+    volume_futures = {}
+    convert_futures = []
+    try:
+        if number_of_threads > 1:
+            if v:  # pragma: no cover
+                print('     > resample fsaverage CorticalSurface to individual CorticalSurface'
+                      ' and generate Nifti volumes from annotations with {} threads'.format(number_of_threads))
+            executor = ThreadPoolExecutor(max_workers=number_of_threads)
+            # All the surface resamplings are queued before the volume generations waiting
+            # for them, so that these never wait for commands that did not start yet
+            surf2surf_futures = {
+                i: [executor.submit(_call_command, mri_cmd, v, FNULL) for mri_cmd in surf2surf_cmds[i]]
+                for i in scales
+            }
+            for i in scales:
+                volume_futures[i] = executor.submit(
+                    _call_commands_after, surf2surf_futures[i], aparc2aseg_cmds[i], v, FNULL
+                )
+
+        for i in scales:
+
+            if v:  # pragma: no cover
+                print(' ... working on multiscale parcellation, SCALE {}'.format(i + 1))
+
+            if executor is None:
+                if v:  # pragma: no cover
+                    print(
+                        '     > resample fsaverage CorticalSurface to individual CorticalSurface')
+                for mri_cmd in surf2surf_cmds[i]:
+                    _call_command(mri_cmd, v, FNULL)
+
+                if v:  # pragma: no cover
+                    print('     > generate Nifti volume from annotation')
+                _call_command(aparc2aseg_cmds[i], v, FNULL)
+            else:
+                volume_futures[i].result()
+
+            # 3. Update numerical IDs of cortical and subcortical regions
+            # Load Nifti volume
+            if v:  # pragma: no cover
+                print('     > relabel cortical and subcortical regions'
+                      ' for consistency between resolutions')
+            this_nifti = ni.load(os.path.join(subject_dir, 'tmp', rois_output[i]))
+            vol = this_nifti.get_fdata()  # numpy.ndarray
+            hdr = this_nifti.header
+            # Initialize output
+            hdr2 = hdr.copy()
+            hdr2.set_data_dtype(np.uint16)
+
+            newrois = vol.copy()
+            # store scale5 volume for correction on multi-resolution consistency
+            if i == (nscales - 1):
+                print("     ... storing ROIs volume maximal resolution")
+                roisMax = vol.copy()
+            # correct cortical surfaces using as reference the roisMax volume (for consistency between resolutions)
+            else:
+                print("     > adapt cortical surfaces")
+
+                # correct voxels labeled in current resolution, but not labeled in highest resolution
+                newrois[(vol > 0) & (roisMax == 0)] = 0
+                # correct voxels not labeled in current resolution, but labeled in highest resolution,
+                # assigning them the label of the closest labeled voxels in a 25x25x25 neighbourhood
+                idxMissing = np.where((roisMax > 0) & (newrois == 0))
+                newrois[idxMissing] = find_nearest_labels(vol, idxMissing, half_width=12)
+
+            if v:  # pragma: no cover
+                print('     ... save output volumes')
+            this_out = os.path.join(subject_dir, 'mri', rois_output[i])
+            img = ni.Nifti1Image(newrois, this_nifti.affine, header=hdr2)
+            ni.save(img, this_out)
+            del img
 
-        mri_cmd = fs_string + '; mri_convert -i %s -o %s' % (
-            this_out,
-            os.path.join(subject_dir, 'mri', roivs_output[i][0:-4] + '.mgz'))
-        if v == 2:
-            _ = subprocess.call(mri_cmd, shell=True)
-        else:
-            _ = subprocess.call(
-                mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-
-        # Create Gray Matter mask
-        if i == 0:
-            print("     ... Creating gray matter mask from SCALE {}...".format(i + 1))
-            gmMask = newrois.copy()
-            # Keep only GM labels (between 1000 and 3000)
-            gmMask[newrois < 1000] = 0
-            gmMask[newrois >= 3000] = 0
-            gmMask[gmMask > 0] = 1
-            out_mask = op.join(subject_dir, 'mri', 'gmmask.nii.gz')
-            print("         Save gray matter mask to %s" % out_mask)
-            img = ni.Nifti1Image(gmMask, this_nifti.affine, header=hdr2)
-            ni.save(img, out_mask)
+            # 4. Dilate cortical regions
+            if v:  # pragma: no cover
+                print("     > dilating cortical regions")
+            # assign to the unlabeled voxels belonging to the aseg GM volume the label
+            # of the closest labeled voxels in their neighbourhood
+            idxDilate = np.where(cortex & (newrois == 0))
+            newrois[idxDilate] = find_nearest_labels(vol, idxDilate, half_width=dilation_distance)
+
+            # 5. Save Nifti and mgz volumes
+            if v:  # pragma: no cover
+                print('     ... save output volumes ')
+            this_out = os.path.join(subject_dir, 'mri', roivs_output[i])
+            img = ni.Nifti1Image(newrois, this_nifti.affine, header=hdr2)
+            ni.save(img, this_out)
             del img
 
+            mri_cmd = fs_string + '; mri_convert -i %s -o %s' % (
+                this_out,
+                os.path.join(subject_dir, 'mri', roivs_output[i][0:-4] + '.mgz'))
+            if executor is None:
+                _ = _call_command(mri_cmd, v, FNULL)
+            else:
+                convert_futures.append(executor.submit(_call_command, mri_cmd, v, FNULL))
+
+            # Create Gray Matter mask
+            if i == 0:
+                print("     ... Creating gray matter mask from SCALE {}...".format(i + 1))
+                gmMask = newrois.copy()
+                # Keep only GM labels (between 1000 and 3000)
+                gmMask[newrois < 1000] = 0
+                gmMask[newrois >= 3000] = 0
+                gmMask[gmMask > 0] = 1
+                out_mask = op.join(subject_dir, 'mri', 'gmmask.nii.gz')
+                print("         Save gray matter mask to %s" % out_mask)
+                img = ni.Nifti1Image(gmMask, this_nifti.affine, header=hdr2)
+                ni.save(img, out_mask)
+                del img
+
+        # Wait for the remaining conversions (no-op without executor)
+        for future in convert_futures:
+            future.result()
+    finally:
+        # Stop the worker threads even if one of the scales failed
+        if executor is not None:
+            executor.shutdown(wait=True)
+
     mri_cmd = ['mri_convert', '-i', op.join(subject_dir, 'mri', 'ribbon.mgz'), '-o',
                op.join(subject_dir, 'mri', 'ribbon.nii.gz')]
     subprocess.check_call(mri_cmd)
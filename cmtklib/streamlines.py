@@ -0,0 +1,306 @@
+# Copyright (C) 2009-2022, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module that defines CMTK functions for batched streamline geometry.
+
+The functions of this module work directly on the point buffer and
+the offsets of a :class:`nibabel.streamlines.ArraySequence` and compute
+the geometry of all the streamlines at once instead of iterating
+over the streamlines in Python.
+"""
+
+import numpy as np
+import nibabel as nib
+from nibabel.streamlines import ArraySequence
+
+
+def get_streamline_buffers(streamlines):
+    """Return the packed point buffer of a set of streamlines.
+
+    Parameters
+    ----------
+    streamlines : nibabel.streamlines.ArraySequence or list of arrays
+        The fibers data. Each fiber is a 2D array where rows represent 3D points.
+
+    Returns
+    -------
+    data : numpy.ndarray
+        Array of size [#points, 3] with the points of all the streamlines
+
+    offsets : numpy.ndarray
+        Index in ``data`` of the first point of each streamline
+
+    lengths : numpy.ndarray
+        Number of points of each streamline
+    """
+    if not isinstance(streamlines, ArraySequence):
+        arrays = [np.asarray(s).reshape(-1, 3) for s in streamlines]
+        lengths = np.array([a.shape[0] for a in arrays], dtype=np.int64)
+        offsets = np.zeros_like(lengths)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        data = np.concatenate(arrays) if arrays else np.zeros((0, 3))
+        return data, offsets, lengths
+
+    lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+    offsets = np.asarray(streamlines._offsets, dtype=np.int64)
+    data = streamlines._data
+    # Streamlines of a sliced or indexed sequence are not necessarily stored
+    # one after the other in the buffer. Pack them in that case.
+    packed_offsets = np.zeros_like(lengths)
+    np.cumsum(lengths[:-1], out=packed_offsets[1:])
+    if not np.array_equal(offsets, packed_offsets):
+        streamlines = streamlines.copy()
+        data = streamlines._data
+        offsets = packed_offsets
+
+    return np.asarray(data)[: lengths.sum()], offsets, lengths
+
+
+def pack_streamlines(streamlines, dtype=np.float32):
+    """Pack a list of streamlines into a :class:`nibabel.streamlines.ArraySequence`.
+
+    Contrary to the constructor of ``ArraySequence``, streamlines without
+    any point are kept so that the streamline indices are preserved.
+
+    Parameters
+    ----------
+    streamlines : list of arrays
+        The fibers data. Each fiber is a 2D array where rows represent 3D points.
+
+    dtype : numpy.dtype
+        Data type of the point buffer (Default: float32, as in TRK files)
+
+    Returns
+    -------
+    packed : nibabel.streamlines.ArraySequence
+        The packed streamlines
+    """
+    data, offsets, lengths = get_streamline_buffers(streamlines)
+    packed = ArraySequence()
+    packed._data = np.ascontiguousarray(data, dtype=dtype)
+    packed._offsets = offsets
+    packed._lengths = lengths
+    return packed
+
+
+def iter_streamline_chunks(tractogram_file, chunk_size):
+    """Read a tractogram file by chunks of a fixed number of streamlines.
+
+    The tractogram is loaded lazily with nibabel so that only one chunk
+    of streamlines is held in memory at a time.
+
+    Parameters
+    ----------
+    tractogram_file : string
+        Path to the tractogram file (TRK or TCK)
+
+    chunk_size : int
+        Maximal number of streamlines of each chunk
+
+    Yields
+    ------
+    chunk : nibabel.streamlines.ArraySequence
+        The streamlines of the chunk, in millimeter coordinates
+    """
+    chunk_size = max(1, int(chunk_size))
+    tract = nib.streamlines.load(tractogram_file, lazy_load=True)
+    chunk = []
+    for streamline in tract.streamlines:
+        chunk.append(streamline)
+        if len(chunk) == chunk_size:
+            yield pack_streamlines(chunk)
+            chunk = []
+    if chunk:
+        yield pack_streamlines(chunk)
+
+
+def _reduce_per_streamline(values, offsets, lengths):
+    """Sum the per-point ``values`` of each streamline."""
+    out = np.zeros((lengths.size,) + values.shape[1:], dtype=np.float64)
+    nonempty = lengths > 0
+    if np.any(nonempty):
+        out[nonempty] = np.add.reduceat(values, offsets[nonempty], axis=0)
+    return out
+
+
+def _point_neighbours(offsets, lengths):
+    """Return the indices of the previous and next points used by finite differences."""
+    n_points = lengths.sum()
+    streamline_ids = np.repeat(np.arange(lengths.size), lengths)
+    first = offsets[streamline_ids]
+    last = first + lengths[streamline_ids] - 1
+    points = np.arange(n_points)
+    return np.maximum(points - 1, first), np.minimum(points + 1, last)
+
+
+def compute_lengths(streamlines):
+    """Compute the Euclidean length of all the streamlines.
+
+    Parameters
+    ----------
+    streamlines : nibabel.streamlines.ArraySequence or list of arrays
+        The fibers data
+
+    Returns
+    -------
+    lengths : numpy.ndarray
+        Array of size [#fibers] with the length of each fiber, 0 for fibers with less than 2 points
+
+    See Also
+    --------
+    cmtklib.util.length
+    """
+    data, offsets, n_points = get_streamline_buffers(streamlines)
+    data = data.astype(np.float64)
+
+    # Length of the segment between each point and the next one,
+    # the segment starting at the last point of a streamline is discarded
+    segments = np.zeros(data.shape[0])
+    if data.shape[0] > 1:
+        segments[:-1] = np.sqrt((np.diff(data, axis=0) ** 2).sum(axis=1))
+    last_points = offsets + n_points - 1
+    segments[last_points[n_points > 0]] = 0
+
+    return _reduce_per_streamline(segments, offsets, n_points)
+
+
+def compute_mean_curvatures(streamlines):
+    """Compute the mean curvature of all the streamlines.
+
+    The first and second derivatives are estimated with the same finite
+    differences as :func:`numpy.gradient` so that the result matches
+    :func:`cmtklib.util.mean_curvature` applied to each streamline.
+
+    Parameters
+    ----------
+    streamlines : nibabel.streamlines.ArraySequence or list of arrays
+        The fibers data
+
+    Returns
+    -------
+    meancurv : numpy.ndarray
+        Array of size [#fibers] with the mean curvature of each fiber,
+        NaN for fibers with less than 2 points
+
+    See Also
+    --------
+    cmtklib.util.mean_curvature
+    """
+    data, offsets, n_points = get_streamline_buffers(streamlines)
+    data = data.astype(np.float64)
+    eps = np.finfo(float).eps
+
+    prev_idx, next_idx = _point_neighbours(offsets, n_points)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        spacing = (next_idx - prev_idx)[:, None]
+        dxyz = (data[next_idx] - data[prev_idx]) / spacing
+        ddxyz = (dxyz[next_idx] - dxyz[prev_idx]) / spacing
+
+        # Magnitudes equal to zero are replaced by eps, as in cmtklib.util.magn
+        num = np.sqrt((np.cross(dxyz, ddxyz) ** 2).sum(axis=1))
+        num[num == 0] = eps
+        den = np.sqrt((dxyz ** 2).sum(axis=1))
+        den[den == 0] = eps
+        k = num / den ** 3
+
+        meancurv = _reduce_per_streamline(k, offsets, n_points) / n_points
+    meancurv[n_points < 2] = np.nan
+
+    return meancurv
+
+
+def compute_endpoints(streamlines, voxel_size):
+    """Compute the start and end point of all the streamlines.
+
+    Parameters
+    ----------
+    streamlines : nibabel.streamlines.ArraySequence or list of arrays
+        The fibers data
+
+    voxel_size : 3-tuple
+        Voxel size of the image in which the endpoints are voxelized
+
+    Returns
+    -------
+    endpoints : numpy.ndarray
+        Array of size [#fibers, 2, 3] with the index of the first and
+        last point of each fiber in the ``voxel_size`` volume
+
+    endpointsmm : numpy.ndarray
+        Array of size [#fibers, 2, 3] with the endpoints in millimeter coordinates
+    """
+    data, offsets, n_points = get_streamline_buffers(streamlines)
+
+    short = np.where(n_points < 2)[0]
+    if short.size > 0:
+        raise ValueError(
+            f"Fiber {short[0]} does not have enough points to determine endpoints"
+        )
+
+    endpointsmm = np.zeros((n_points.size, 2, 3))
+    endpointsmm[:, 0, :] = data[offsets]
+    endpointsmm[:, 1, :] = data[offsets + n_points - 1]
+
+    # Translate from mm to index
+    endpoints = np.trunc(
+        endpointsmm / np.asarray(voxel_size, dtype=np.float64)[:3]
+    )
+
+    return endpoints, endpointsmm
+
+
+def sample_scalar_map(streamlines, map_data, voxel_size, batch_size=100000):
+    """Sample a scalar map at every point of all the streamlines.
+
+    Points are mapped to voxels by truncating their coordinates divided
+    by ``voxel_size``. Streamlines with at least one point outside of the
+    volume are flagged so that they can be discarded.
+
+    Parameters
+    ----------
+    streamlines : nibabel.streamlines.ArraySequence or list of arrays
+        The fibers data
+
+    map_data : numpy.ndarray
+        3D scalar map
+
+    voxel_size : 3-tuple
+        Voxel size of the scalar map
+
+    batch_size : int
+        Number of points mapped to voxels at once, which bounds the
+        memory used by the voxel coordinates (Default: 100000)
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Value of the map at each point of the point buffer, in the data
+        type of ``map_data`` (0 for points outside of the volume)
+
+    inside : numpy.ndarray
+        Boolean array of size [#fibers], True for fibers entirely inside the volume
+    """
+    data, offsets, n_points = get_streamline_buffers(streamlines)
+    shape = np.asarray(map_data.shape[:3], dtype=np.int64)
+    voxel_size = np.asarray(voxel_size, dtype=np.float64)[:3]
+    batch_size = max(1, int(batch_size))
+
+    values = np.zeros(len(data), dtype=map_data.dtype)
+    point_outside = np.zeros(len(data), dtype=bool)
+    for start in range(0, len(data), batch_size):
+        stop = min(start + batch_size, len(data))
+        vox = np.trunc(data[start:stop] / voxel_size)
+        point_inside = np.all((vox >= 0) & (vox < shape), axis=1)
+        vox = vox[point_inside].astype(np.int32)
+        values[start:stop][point_inside] = map_data[vox[:, 0], vox[:, 1], vox[:, 2]]
+        point_outside[start:stop] = ~point_inside
+
+    inside = np.ones(n_points.size, dtype=bool)
+    nonempty = n_points > 0
+    if np.any(nonempty):
+        inside[nonempty] = ~np.logical_or.reduceat(point_outside, offsets[nonempty])
+
+    return values, inside
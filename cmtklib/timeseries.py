@@ -0,0 +1,481 @@
+# Copyright (C) 2009-2022, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module that defines CMTK functions for ROI time-series extraction and functional connectivity.
+
+The voxels of all the ROIs of a parcellation are gathered in a single
+pass over the 4D volume and the ROI signals are then reduced all at once,
+instead of scanning the whole volume for each ROI. Functional connectivity
+matrices are derived from one covariance matrix of all the ROI time-series
+instead of being computed for each pair of ROIs. The mean signals of the
+ROIs of nested parcellations (such as the scales of Lausanne2018) can be
+derived from a single reduction of the voxels shared by their ROIs.
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.signal import get_window
+
+from cmtklib.volumes import VoxelBlockReader
+
+
+def get_roi_voxels(labels, n_rois=None):
+    """Return the voxels of all the ROIs of a parcellation grouped by label.
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        3D parcellation volume
+
+    n_rois : int
+        Number of ROIs, labeled from 1 to ``n_rois``. Voxels with a label above
+        ``n_rois`` are ignored. If None, the maximal label is used.
+
+    Returns
+    -------
+    voxels : numpy.ndarray
+        Flat indices of the labeled voxels, sorted by label
+
+    offsets : numpy.ndarray
+        Array of size [n_rois + 1] with the offsets of each ROI in ``voxels``
+        (the voxels of ROI ``i`` are ``voxels[offsets[i - 1]:offsets[i]]``)
+    """
+    flat_labels = np.asarray(labels).astype(np.int64).ravel()
+    if n_rois is None:
+        n_rois = int(flat_labels.max()) if flat_labels.size else 0
+    n_rois = int(n_rois)
+
+    voxels = np.flatnonzero((flat_labels > 0) & (flat_labels <= n_rois))
+    voxels = voxels[np.argsort(flat_labels[voxels], kind="stable")]
+    counts = np.bincount(flat_labels[voxels] - 1, minlength=n_rois)
+    offsets = np.zeros(n_rois + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return voxels, offsets
+
+
+def _first_principal_component(signals, mean_signal):
+    """Return the time course of the first principal component of the voxel signals."""
+    centered = signals - signals.mean(axis=1, keepdims=True)
+    _, s, vt = np.linalg.svd(centered, full_matrices=False)
+    component = vt[0] * s[0] / np.sqrt(signals.shape[0])
+    # The sign of a principal component is arbitrary: orient it as the mean signal
+    if np.dot(component, mean_signal - mean_signal.mean()) < 0:
+        component = -component
+    return component
+
+
+def compute_roi_timeseries(data, labels, n_rois=None, summary="mean", dtype=np.float32):
+    """Compute the signal of all the ROIs of a parcellation in one pass over a 4D volume.
+
+    The labeled voxels are gathered once. ROI means are computed with a single
+    sparse label-indicator matrix product, and medians or principal components
+    are computed on the contiguous voxel blocks of each ROI.
+    If the 4D volume is read by blocks of voxels, the sums of the ROI means
+    are accumulated block by block, and only the labeled voxels are gathered
+    for the medians or principal components.
+
+    Parameters
+    ----------
+    data : numpy.ndarray or cmtklib.volumes.VoxelBlockReader
+        4D volume (x, y, z, time)
+
+    labels : numpy.ndarray
+        3D parcellation volume with the same spatial shape as ``data``
+
+    n_rois : int
+        Number of ROIs, labeled from 1 to ``n_rois``.
+        If None, the maximal label is used.
+
+    summary : {'mean', 'median', 'pca'}
+        Summary of the voxel signals of each ROI:
+        the mean signal, the median signal or the (zero-mean) time course of
+        the first principal component, oriented as the mean signal
+        (Default: 'mean')
+
+    dtype : numpy.dtype
+        Data type of the output (Default: float32)
+
+    Returns
+    -------
+    ts : numpy.ndarray
+        Array of size [n_rois, #timepoints] with the signal of each ROI
+        (NaN for ROIs without any voxel)
+    """
+    if summary not in ["mean", "median", "pca"]:
+        raise ValueError("Invalid ROI summary '%s' (mean, median or pca)" % summary)
+
+    if not isinstance(data, VoxelBlockReader):
+        data = np.asarray(data)
+    if data.shape[:3] != np.shape(labels)[:3]:
+        raise ValueError(
+            "Shape mismatch between the 4D volume %s and the parcellation %s"
+            % (data.shape[:3], np.shape(labels)[:3])
+        )
+    n_timepoints = data.shape[3] if len(data.shape) > 3 else 1
+    voxels, offsets = get_roi_voxels(labels, n_rois)
+    n_rois = offsets.size - 1
+    counts = np.diff(offsets)
+
+    if isinstance(data, VoxelBlockReader) and summary == "mean":
+        # Sum the voxel signals of all the ROIs block by block
+        roi_of_voxel = np.zeros(int(np.prod(data.shape[:3])), dtype=np.int64)
+        roi_of_voxel[voxels] = np.repeat(np.arange(n_rois), counts)
+        in_roi = np.zeros(roi_of_voxel.size, dtype=bool)
+        in_roi[voxels] = True
+        sums = np.zeros((n_rois, n_timepoints))
+        for block_voxels, block_signals in data.iter_blocks(in_roi):
+            indicator = sparse.csr_matrix(
+                (
+                    np.ones(block_voxels.size),
+                    (roi_of_voxel[block_voxels], np.arange(block_voxels.size)),
+                ),
+                shape=(n_rois, block_voxels.size),
+            )
+            sums += indicator @ block_signals.astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ts = sums / counts[:, None]
+        return ts.astype(dtype)
+
+    # Single gather of the labeled voxels, sorted by ROI
+    if isinstance(data, VoxelBlockReader):
+        signals = data.read_voxels(voxels).astype(np.float64)
+    else:
+        signals = data.reshape(-1, n_timepoints)[voxels].astype(np.float64)
+
+    # Sum the voxel signals of all the ROIs with one sparse matrix product
+    roi_ids = np.repeat(np.arange(n_rois), counts)
+    indicator = sparse.csr_matrix(
+        (np.ones(voxels.size), (roi_ids, np.arange(voxels.size))),
+        shape=(n_rois, voxels.size),
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ts = np.asarray(indicator @ signals) / counts[:, None]
+
+    if summary != "mean":
+        for i in np.flatnonzero(counts):
+            roi_signals = signals[offsets[i]:offsets[i + 1]]
+            if summary == "median":
+                ts[i] = np.median(roi_signals, axis=0)
+            else:
+                ts[i] = _first_principal_component(roi_signals, ts[i])
+
+    return ts.astype(dtype)
+
+
+def get_label_atoms(labels, n_rois=None):
+    """Partition the labeled voxels of nested parcellations into atoms.
+
+    An atom is a set of voxels sharing the same label in every parcellation.
+    If the parcellations are perfectly nested (as the scales of Lausanne2018),
+    the atoms are the ROIs of the finest parcellation and each ROI of a coarser
+    parcellation is the union of its children atoms. Otherwise, the voxels where
+    the nesting is broken form additional small atoms, so that the ROIs of each
+    parcellation are still exactly unions of atoms.
+
+    Parameters
+    ----------
+    labels : list of numpy.ndarray
+        3D parcellation volumes with the same shape
+
+    n_rois : list of int
+        Number of ROIs of each parcellation, labeled from 1 to ``n_rois``.
+        Voxels with a label above ``n_rois`` are ignored. If None, the maximal label is used.
+
+    Returns
+    -------
+    voxels : numpy.ndarray
+        Flat indices of the voxels labeled in at least one parcellation
+
+    atom_of_voxel : numpy.ndarray
+        Index of the atom of each voxel in ``voxels``
+
+    atom_labels : numpy.ndarray
+        Array of size [#atoms, #parcellations] with the label of each atom
+        in each parcellation (0 if unlabeled)
+    """
+    if n_rois is None:
+        n_rois = [None] * len(labels)
+    stacked = []
+    for label_volume, n in zip(labels, n_rois):
+        flat_labels = np.asarray(label_volume).astype(np.int64).ravel()
+        if n is not None:
+            flat_labels[flat_labels > int(n)] = 0
+        flat_labels[flat_labels < 0] = 0
+        stacked.append(flat_labels)
+    stacked = np.stack(stacked, axis=1)
+
+    voxels = np.flatnonzero(np.any(stacked > 0, axis=1))
+    atom_labels, atom_of_voxel = np.unique(stacked[voxels], axis=0, return_inverse=True)
+    return voxels, atom_of_voxel.ravel(), atom_labels
+
+
+def compute_multiscale_roi_timeseries(data, labels, n_rois=None, dtype=np.float32):
+    """Compute the mean signal of the ROIs of nested parcellations in one pass over a 4D volume.
+
+    The voxel signals are summed once per atom (voxels sharing the same label
+    in every parcellation, see :func:`get_label_atoms`) and the sums of the ROIs
+    of each parcellation are then derived by summing the sums of their atoms,
+    instead of reducing the voxels of the 4D volume again for each parcellation.
+
+    Parameters
+    ----------
+    data : numpy.ndarray or cmtklib.volumes.VoxelBlockReader
+        4D volume (x, y, z, time)
+
+    labels : list of numpy.ndarray
+        3D parcellation volumes with the same spatial shape as ``data``
+
+    n_rois : list of int
+        Number of ROIs of each parcellation, labeled from 1 to ``n_rois``.
+        If None, the maximal label of each parcellation is used.
+
+    dtype : numpy.dtype
+        Data type of the output (Default: float32)
+
+    Returns
+    -------
+    ts : list of numpy.ndarray
+        Arrays of size [n_rois, #timepoints] with the mean signal of each ROI
+        of each parcellation (NaN for ROIs without any voxel)
+    """
+    if not isinstance(data, VoxelBlockReader):
+        data = np.asarray(data)
+    for label_volume in labels:
+        if data.shape[:3] != np.shape(label_volume)[:3]:
+            raise ValueError(
+                "Shape mismatch between the 4D volume %s and the parcellation %s"
+                % (data.shape[:3], np.shape(label_volume)[:3])
+            )
+    if n_rois is None:
+        n_rois = [int(np.max(label_volume)) for label_volume in labels]
+    n_timepoints = data.shape[3] if len(data.shape) > 3 else 1
+    voxels, atom_of_voxel, atom_labels = get_label_atoms(labels, n_rois)
+    n_atoms = atom_labels.shape[0]
+    atom_counts = np.bincount(atom_of_voxel, minlength=n_atoms).astype(np.float64)
+
+    # Sum the voxel signals of each atom in a single pass over the volume
+    if isinstance(data, VoxelBlockReader):
+        atom_of = np.full(int(np.prod(data.shape[:3])), -1, dtype=np.int64)
+        atom_of[voxels] = atom_of_voxel
+        atom_sums = np.zeros((n_atoms, n_timepoints))
+        for block_voxels, block_signals in data.iter_blocks(atom_of >= 0):
+            indicator = sparse.csr_matrix(
+                (
+                    np.ones(block_voxels.size),
+                    (atom_of[block_voxels], np.arange(block_voxels.size)),
+                ),
+                shape=(n_atoms, block_voxels.size),
+            )
+            atom_sums += indicator @ block_signals.astype(np.float64)
+    else:
+        signals = data.reshape(-1, n_timepoints)[voxels].astype(np.float64)
+        indicator = sparse.csr_matrix(
+            (np.ones(voxels.size), (atom_of_voxel, np.arange(voxels.size))),
+            shape=(n_atoms, voxels.size),
+        )
+        atom_sums = np.asarray(indicator @ signals)
+
+    # Derive the ROI means of each parcellation from the sums of their atoms
+    ts = []
+    for i, n in enumerate(n_rois):
+        n = int(n)
+        atoms = np.flatnonzero(atom_labels[:, i] > 0)
+        children = sparse.csr_matrix(
+            (np.ones(atoms.size), (atom_labels[atoms, i] - 1, atoms)),
+            shape=(n, n_atoms),
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            roi_ts = np.asarray(children @ atom_sums) / (children @ atom_counts)[:, None]
+        ts.append(roi_ts.astype(dtype))
+    return ts
+
+
+FC_MEASURES = ["corr", "cov", "partial_corr", "fisher_z"]
+
+
+def compute_functional_connectivity(ts, measures=None):
+    """Compute functional connectivity matrices between all pairs of ROI time-series.
+
+    The covariance matrix of all the ROI time-series is computed with a single
+    matrix product and all the requested measures are derived from it.
+
+    Parameters
+    ----------
+    ts : numpy.ndarray
+        Array of size [#rois, #timepoints] with the signal of each ROI
+
+    measures : list of string
+        Measures to compute among:
+
+        * 'corr': Pearson's correlation coefficient
+
+        * 'cov': covariance (normalized by ``#timepoints - 1``)
+
+        * 'partial_corr': partial correlation obtained from the precision
+          (inverse covariance) matrix of the ROIs with a non-constant signal
+
+        * 'fisher_z': Fisher z-transform of the correlation (0 on the diagonal)
+
+        (Default: ['corr'])
+
+    Returns
+    -------
+    matrices : dict
+        Dictionary of measure / matrix of size [#rois, #rois] pairs.
+        Rows and columns of ROIs with a constant or undefined signal are NaN
+        (except the covariance).
+    """
+    if measures is None:
+        measures = ["corr"]
+    invalid = [m for m in measures if m not in FC_MEASURES]
+    if invalid:
+        raise ValueError(
+            "Invalid functional connectivity measure(s) %s (valid: %s)"
+            % (invalid, ", ".join(FC_MEASURES))
+        )
+
+    x = np.asarray(ts, dtype=np.float64)
+    x = x - x.mean(axis=1, keepdims=True)
+    cov = (x @ x.T) / max(x.shape[1] - 1, 1)
+
+    std = np.sqrt(np.diag(cov))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = cov / np.outer(std, std)
+    np.clip(corr, -1, 1, out=corr)
+
+    matrices = {}
+    if "corr" in measures:
+        matrices["corr"] = corr
+    if "cov" in measures:
+        matrices["cov"] = cov
+    if "partial_corr" in measures:
+        # Precision of the ROIs whose signal is defined and not constant
+        valid = np.isfinite(std) & (std > 0)
+        partial_corr = np.full_like(cov, np.nan)
+        if np.any(valid):
+            precision = np.linalg.pinv(cov[np.ix_(valid, valid)])
+            d = np.sqrt(np.diag(precision))
+            pcorr = -precision / np.outer(d, d)
+            np.fill_diagonal(pcorr, 1)
+            partial_corr[np.ix_(valid, valid)] = pcorr
+        matrices["partial_corr"] = partial_corr
+    if "fisher_z" in measures:
+        with np.errstate(divide="ignore"):
+            fisher_z = np.arctanh(corr)
+        np.fill_diagonal(fisher_z, 0)
+        fisher_z[np.isnan(np.diag(corr))] = np.nan
+        fisher_z[:, np.isnan(np.diag(corr))] = np.nan
+        matrices["fisher_z"] = fisher_z
+
+    return {m: matrices[m] for m in measures}
+
+
+def _covariance_to_correlation(cov):
+    """Normalize a covariance matrix into a correlation matrix."""
+    std = np.sqrt(np.clip(np.diag(cov), 0, None))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = cov / np.outer(std, std)
+    return np.clip(corr, -1, 1, out=corr)
+
+
+def compute_sliding_window_fc(
+    ts, window_length, step=1, taper="rectangular", upper_triangle=False, out_file=None
+):
+    """Compute the correlation matrices of the ROI time-series in sliding windows.
+
+    With a rectangular window, the sums and cross-products of the ROI signals
+    are updated incrementally from one window to the next by adding the
+    entering frames and removing the leaving ones, and are recomputed from
+    scratch each time the window has moved by its own length to avoid the
+    accumulation of rounding errors. With another taper, the weight of a frame
+    changes with its position in the window and the weighted cross-products
+    of each window are computed directly.
+
+    Parameters
+    ----------
+    ts : numpy.ndarray
+        Array of size [#rois, #timepoints] with the signal of each ROI
+
+    window_length : int
+        Number of time points of each window
+
+    step : int
+        Number of time points between the start of two consecutive windows (Default: 1)
+
+    taper : {'rectangular', 'hamming', 'hann'}
+        Weighting of the time points in each window (Default: 'rectangular')
+
+    upper_triangle : bool
+        If True, only the values above the diagonal of each matrix are stored,
+        in the order of ``numpy.triu_indices(#rois, k=1)`` (Default: False)
+
+    out_file : string
+        If given, the matrices are written in this ``.npy`` file
+        which can be memory-mapped with ``numpy.load(out_file, mmap_mode='r')``
+
+    Returns
+    -------
+    dfc : numpy.ndarray
+        Float32 array of size [#windows, #rois, #rois], or [#windows, #rois * (#rois - 1) / 2]
+        if ``upper_triangle`` is True, with the correlation matrix of each window
+    """
+    x = np.asarray(ts, dtype=np.float64)
+    n_rois, n_timepoints = x.shape
+    window_length = int(window_length)
+    step = int(step)
+    if window_length < 2 or window_length > n_timepoints:
+        raise ValueError(
+            "Invalid window length %i for %i time points" % (window_length, n_timepoints)
+        )
+    if step < 1:
+        raise ValueError("Invalid window step %i" % step)
+    if taper not in ["rectangular", "hamming", "hann"]:
+        raise ValueError("Invalid window taper '%s' (rectangular, hamming or hann)" % taper)
+
+    n_windows = (n_timepoints - window_length) // step + 1
+    if upper_triangle:
+        rows, cols = np.triu_indices(n_rois, k=1)
+        shape = (n_windows, rows.size)
+    else:
+        shape = (n_windows, n_rois, n_rois)
+    if out_file is not None:
+        dfc = np.lib.format.open_memmap(out_file, mode="w+", dtype=np.float32, shape=shape)
+    else:
+        dfc = np.zeros(shape, dtype=np.float32)
+
+    # Centering the signals reduces the cancellation in the covariance
+    x = x - x.mean(axis=1, keepdims=True)
+
+    if taper != "rectangular":
+        weights = get_window(taper, window_length, fftbins=False)
+        weights = weights / weights.sum()
+
+    s1 = s2 = None
+    anchor = 0
+    for k in range(n_windows):
+        start = k * step
+        frames = x[:, start:start + window_length]
+        if taper != "rectangular":
+            mean = frames @ weights
+            cov = (frames * weights) @ frames.T - np.outer(mean, mean)
+        else:
+            if s1 is None or start >= anchor + window_length:
+                # (Re)compute the sums of the whole window
+                anchor = start
+                s1 = frames.sum(axis=1)
+                s2 = frames @ frames.T
+            else:
+                leaving = x[:, start - step:start]
+                entering = x[:, start - step + window_length:start + window_length]
+                s1 += entering.sum(axis=1) - leaving.sum(axis=1)
+                s2 += entering @ entering.T - leaving @ leaving.T
+            cov = s2 - np.outer(s1, s1) / window_length
+        corr = _covariance_to_correlation(cov)
+        dfc[k] = corr[rows, cols] if upper_triangle else corr
+
+    if out_file is not None:
+        dfc.flush()
+    return dfc
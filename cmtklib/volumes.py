@@ -0,0 +1,232 @@
+# Copyright (C) 2009-2022, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module that defines CMTK classes to read and write 4D volumes by blocks of voxels.
+
+The voxel time-series of a 4D NIfTI image are read as float32 (voxels x time)
+matrices by blocks of slices from its data object, so that the memory needed
+to process a long fMRI run is bounded by the size of a block instead of the
+size of the whole run loaded as float64.
+"""
+
+import gzip
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+
+class VoxelBlockReader(object):
+    """Read the voxel time-series of a 4D NIfTI image by blocks of slices.
+
+    If the image is compressed and read by blocks, it is first decompressed
+    once in a temporary file which is then memory-mapped, so that each block
+    is read without decompressing the whole image again.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the 4D NIfTI image
+
+    block_size : int
+        Maximal number of voxels read at once, rounded down to a number of
+        whole slices (at least one). If 0, the whole image is read at once
+        (Default: 0)
+
+    tmp_dir : string
+        Directory of the temporary decompressed image
+        (Default: the current working directory)
+
+    Examples
+    --------
+    >>> from cmtklib.volumes import VoxelBlockReader
+    >>> with VoxelBlockReader('fMRI.nii.gz', block_size=100000) as reader:  # doctest: +SKIP
+    ...     for voxels, signals in reader.iter_blocks():
+    ...         print(voxels.shape, signals.shape)
+    """
+
+    def __init__(self, fname, block_size=0, tmp_dir=None):
+        self.fname = fname
+        self._tmp_file = None
+        self.img = nib.load(fname)
+        if len(self.img.shape) != 4:
+            raise ValueError("%s is not a 4D image" % fname)
+
+        self.block_size = int(block_size)
+        if self.block_size > 0 and fname.endswith(".gz"):
+            fd, self._tmp_file = tempfile.mkstemp(
+                suffix=".nii", prefix="blocks_", dir=tmp_dir or os.getcwd()
+            )
+            with os.fdopen(fd, "wb") as dst, gzip.open(fname, "rb") as src:
+                shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+            self.img = nib.load(self._tmp_file, mmap=True)
+
+        self.shape = self.img.shape
+        self.n_timepoints = self.shape[3]
+        self.affine = self.img.affine
+        self.header = self.img.header
+
+        slice_size = self.shape[0] * self.shape[1]
+        if self.block_size > 0:
+            self.n_slices = min(self.shape[2], max(1, self.block_size // slice_size))
+        else:
+            self.n_slices = self.shape[2]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Delete the temporary decompressed image (if any)."""
+        if self._tmp_file is not None:
+            # Drop the memory map before deleting the file
+            self.img = None
+            os.remove(self._tmp_file)
+            self._tmp_file = None
+
+    def iter_blocks(self, mask=None):
+        """Iterate over the blocks of voxel time-series.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray
+            Optional 3D mask of the voxels to read. Blocks without any
+            voxel of the mask are skipped (Default: all the voxels)
+
+        Yields
+        ------
+        voxels : numpy.ndarray
+            Flat indices (C order) of the voxels of the block in the 3D volume
+
+        signals : numpy.ndarray
+            Float32 array of size [#voxels, #timepoints] with their time-series
+        """
+        shape3d = self.shape[:3]
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool).reshape(shape3d)
+        for z0 in range(0, shape3d[2], self.n_slices):
+            z1 = min(z0 + self.n_slices, shape3d[2])
+            if mask is None:
+                block_mask = np.ones(shape3d[:2] + (z1 - z0,), dtype=bool)
+            else:
+                block_mask = mask[:, :, z0:z1]
+                if not block_mask.any():
+                    continue
+            block = np.asarray(self.img.dataobj[:, :, z0:z1, :], dtype=np.float32)
+            x, y, z = np.nonzero(block_mask)
+            voxels = np.ravel_multi_index((x, y, z + z0), shape3d)
+            yield voxels, block[block_mask]
+
+    def read_voxels(self, voxels):
+        """Read the time-series of a set of voxels.
+
+        Parameters
+        ----------
+        voxels : numpy.ndarray
+            Flat indices (C order) of the voxels in the 3D volume
+
+        Returns
+        -------
+        signals : numpy.ndarray
+            Float32 array of size [#voxels, #timepoints] with the time-series
+            of the voxels in the order of ``voxels``
+        """
+        voxels = np.asarray(voxels, dtype=np.int64)
+        mask = np.zeros(int(np.prod(self.shape[:3])), dtype=bool)
+        mask[voxels] = True
+        position = np.zeros(mask.size, dtype=np.int64)
+        position[voxels] = np.arange(voxels.size)
+
+        signals = np.zeros((voxels.size, self.n_timepoints), dtype=np.float32)
+        for block_voxels, block_signals in self.iter_blocks(mask):
+            signals[position[block_voxels]] = block_signals
+        return signals
+
+
+class VoxelBlockWriter(object):
+    """Write the voxel time-series of a 4D NIfTI image by blocks of voxels.
+
+    The voxels which are not written are set to zero.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the output 4D NIfTI image
+
+    reference : nibabel.Nifti1Image or VoxelBlockReader
+        Image whose shape, affine and header are used for the output
+
+    dtype : numpy.dtype
+        Data type of the output (Default: float32)
+
+    memmap : bool
+        If True, the volume is assembled in a temporary memory-mapped file
+        next to the output instead of in memory (Default: False)
+
+    Examples
+    --------
+    >>> from cmtklib.volumes import VoxelBlockReader, VoxelBlockWriter
+    >>> with VoxelBlockReader('fMRI.nii.gz', block_size=100000) as reader:  # doctest: +SKIP
+    ...     with VoxelBlockWriter('fMRI_scaled.nii.gz', reader, memmap=True) as writer:
+    ...         for voxels, signals in reader.iter_blocks():
+    ...             writer.write(voxels, 2 * signals)
+    """
+
+    def __init__(self, fname, reference, dtype=np.float32, memmap=False):
+        self.fname = os.path.abspath(fname)
+        self.shape = tuple(reference.shape)
+        self.affine = reference.affine
+        self.header = reference.header.copy()
+        self.header.set_data_dtype(dtype)
+        self._tmp_file = None
+        if memmap:
+            fd, self._tmp_file = tempfile.mkstemp(
+                suffix=".dat", prefix="blocks_", dir=os.path.dirname(self.fname)
+            )
+            os.close(fd)
+            self.data = np.memmap(
+                self._tmp_file, dtype=dtype, mode="w+", shape=self.shape, order="F"
+            )
+        else:
+            self.data = np.zeros(self.shape, dtype=dtype, order="F")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self._discard()
+
+    def write(self, voxels, signals):
+        """Write the time-series of a block of voxels.
+
+        Parameters
+        ----------
+        voxels : numpy.ndarray
+            Flat indices (C order) of the voxels in the 3D volume
+
+        signals : numpy.ndarray
+            Array of size [#voxels, #timepoints] with their time-series
+        """
+        x, y, z = np.unravel_index(voxels, self.shape[:3])
+        self.data[x, y, z, :] = signals
+
+    def close(self):
+        """Save the image and delete the temporary memory-mapped file (if any)."""
+        nib.save(nib.Nifti1Image(self.data, self.affine, self.header), self.fname)
+        self._discard()
+
+    def _discard(self):
+        self.data = None
+        if self._tmp_file is not None:
+            os.remove(self._tmp_file)
+            self._tmp_file = None
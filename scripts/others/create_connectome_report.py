@@ -58,12 +58,38 @@ except ImportError:
     print("BIDS not available. Can not read BIDS dataset")
 
 from cmtklib.bids.io import __cmp_directory__
+from cmtklib.network import load_connectome_hdf5
 
 """
 ====================End of Importing Libraries ===========================
 
 """
 
+# Atlas of the connectomes shown in the report (the HDF5 file and the gpickle
+# files of the same subject are built from it so that they are interchangeable)
+ATLAS_LABEL = 'L2018'
+SCALE = 'scale1'
+
+
+def get_connectome_files(conn_dir, prefix):
+    """ Return the paths of the HDF5 connectome file and of the gpickle file of the report scale"""
+    h5_fn = os.path.join(conn_dir, '%s_atlas-%s_conndata-network_connectivity.h5' % (prefix, ATLAS_LABEL))
+    gpickle_fn = os.path.join(conn_dir, '%s_atlas-%s_res-%s_conndata-network_connectivity.gpickle'
+                              % (prefix, ATLAS_LABEL, SCALE))
+    return h5_fn, gpickle_fn
+
+
+def load_connectivity_matrix(gpickle_fn, h5_fn, con_metric, scale):
+    """ Load a connectivity matrix from the HDF5 connectome file if it exists, otherwise from the gpickle file"""
+    if os.path.isfile(h5_fn):
+        print("  Load %s (%s) from %s" % (con_metric, scale, h5_fn))
+        # Only the requested scale and metric are read
+        connectome = load_connectome_hdf5(h5_fn, scale=scale, metrics=[con_metric])
+        return connectome.to_matrix(con_metric)
+    print("  Load %s from %s" % (con_metric, gpickle_fn))
+    G = nx.read_gpickle(gpickle_fn)
+    return nx.to_numpy_matrix(G, weight=con_metric, dtype=np.float64)
+
 
 def main(bids_dir):
     """ Extract CMP3 connectome in a bids dataset and create PDF report"""
@@ -105,14 +131,14 @@ def main(bids_dir):
         if len(sessions) > 0:
             print("Warning: multiple sessions")
             for ses in sessions:
-                gpickle_fn = os.path.join(bids_dir, 'derivatives', __cmp_directory__, 'sub-' + str(subj), 'ses-' + str(ses), 'dwi',
-                                          'sub-%s_ses-%s_label-L2008_res-scale1_conndata-snetwork_connectivity.gpickle' % (str(subj), str(ses)))
-                if os.path.isfile(gpickle_fn):
+                h5_fn, gpickle_fn = get_connectome_files(
+                    os.path.join(bids_dir, 'derivatives', __cmp_directory__, 'sub-' + str(subj), 'ses-' + str(ses), 'dwi'),
+                    'sub-%s_ses-%s' % (str(subj), str(ses)))
+                if os.path.isfile(h5_fn) or os.path.isfile(gpickle_fn):
                     # c.drawString(10,20+offset,'Subject: %s / Session: %s '%(str(subj),str(sess)))
-                    G = nx.read_gpickle(gpickle_fn)
                     con_metric = 'number_of_fibers'
-                    con = nx.to_numpy_matrix(
-                        G, weight=con_metric, dtype=np.float64)
+                    con = load_connectivity_matrix(
+                        gpickle_fn, h5_fn, con_metric, SCALE)
 
                     fig = figure(figsize=(8, 8))
                     suptitle('Subject: %s / Session: %s ' %
@@ -140,15 +166,14 @@ def main(bids_dir):
 
         else:
             print("No session")
-            gpickle_fn = os.path.join(bids_dir, 'derivatives', __cmp_directory__, 'sub-' + str(subj), 'connectivity',
-                                      'sub-%s_label-L2008_res-scale1_conndata-snetwork_connectivity.gpickle' % (
-                                          str(subj)))
-            if os.path.isfile(gpickle_fn):
+            h5_fn, gpickle_fn = get_connectome_files(
+                os.path.join(bids_dir, 'derivatives', __cmp_directory__, 'sub-' + str(subj), 'dwi'),
+                'sub-%s' % (str(subj)))
+            if os.path.isfile(h5_fn) or os.path.isfile(gpickle_fn):
                 # c.drawString(10,20+offset,'Subject : %s '%str(subj))
-                G = nx.read_gpickle(gpickle_fn)
                 con_metric = 'number_of_fibers'
-                con = nx.to_numpy_matrix(
-                    G, weight=con_metric, dtype=np.float64)
+                con = load_connectivity_matrix(
+                    gpickle_fn, h5_fn, con_metric, SCALE)
 
                 fig = figure(figsize=(8, 8))
                 suptitle('Subject: %s ' % (str(subj)), fontsize=11)
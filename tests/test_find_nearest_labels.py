@@ -0,0 +1,53 @@
+import numpy as np
+
+from cmtklib.parcellation import find_nearest_labels, _get_neighbourhood_label
+
+
+def _random_labels(rng, size=40, n_labels=6):
+    """Return a shell of random labels with holes, plus a few isolated labeled voxels."""
+    center = size // 2
+    r = np.sqrt(((np.indices((size,) * 3) - center) ** 2).sum(axis=0))
+    shell = (r > size / 5) & (r < size / 3)
+    # Few labels so that equally close voxels with different labels are frequent
+    seeds = rng.randint(0, size, (20, 3))
+    seed_labels = rng.randint(1, n_labels + 1, 20)
+    sq_dist = ((np.indices((size,) * 3).reshape(3, -1).T[:, None, :] - seeds[None]) ** 2).sum(-1)
+    labels = np.where(shell.ravel(), seed_labels[sq_dist.argmin(axis=1)], 0).reshape((size,) * 3)
+    labels[rng.rand(*labels.shape) < 0.3] = 0
+    for position in rng.randint(0, size, (6, 3)):
+        if r[tuple(position)] > size / 3 + 4:
+            labels[tuple(position)] = rng.randint(1, n_labels + 1)
+    return labels.astype(np.float64)
+
+
+def _neighbourhood_distances(half_width):
+    """Return the distances to the center of the neighbourhood as in create_roi."""
+    width = 2 * half_width + 1
+    offsets = np.indices((width,) * 3) - half_width
+    return np.sqrt((offsets ** 2).sum(axis=0)).astype(np.float32)
+
+
+def _check_against_neighbourhood_search(seed, half_width):
+    rng = np.random.RandomState(seed)
+    labels = _random_labels(rng)
+    # Labeled, unlabeled and isolated voxels (far from the shell)
+    coords = np.where(rng.rand(*labels.shape) < 0.01)
+
+    dist = _neighbourhood_distances(half_width)
+    expected = np.array([
+        _get_neighbourhood_label(labels, position, dist)
+        for position in zip(*coords)
+    ], dtype=np.int64)
+
+    values = find_nearest_labels(labels, coords, half_width=half_width)
+    np.testing.assert_array_equal(values, expected)
+
+
+def test_find_nearest_labels():
+    for seed in range(3):
+        _check_against_neighbourhood_search(seed, half_width=12)
+
+
+def test_find_nearest_labels_small_neighbourhood():
+    for seed in range(3):
+        _check_against_neighbourhood_search(seed, half_width=3)